@@ -1,10 +1,13 @@
+import uuid
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from database import get_db, Establishment
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_read_db, AsyncReadSessionLocal, Establishment
+from principal_cache import principal_cache
+from token_revocation import revocation_list
 import os
 from dotenv import load_dotenv
 
@@ -15,85 +18,157 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
 ALGORITHM = "HS256"
 
-# Срок жизни токена - 7 дней для тестирования
-ACCESS_TOKEN_EXPIRE_DAYS = 7
+# Срок жизни access-токена (минуты). Токен короткий: продлевается через
+# refresh-токен (POST /api/auth/refresh), отзывается через revocation_list
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
 
 # OAuth2 схема для получения токена из заголовка Authorization
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
 
-def create_access_token(establishment_id: int) -> str:
+class TokenClaims:
+    """
+    Данные пользователя из access-токена (без обращения к БД)
+
+    status и business_type - на момент выдачи токена, т.е. могут отставать
+    от БД не больше чем на ACCESS_TOKEN_EXPIRE_MINUTES.
+    """
+
+    def __init__(self, id: int, status: Optional[str], business_type: Optional[str],
+                 jti: Optional[str], session_id: Optional[str], expires_at: datetime):
+        self.id = id
+        self.status = status
+        self.business_type = business_type
+        self.jti = jti
+        self.session_id = session_id
+        self.expires_at = expires_at
+
+
+def create_access_token(establishment: Establishment, session_id: Optional[str] = None) -> str:
     """
     Создает JWT токен для пользователя
     
     Args:
-        establishment_id: ID заведения
+        establishment: Заведение (в токен попадают id, статус и тип бизнеса)
+        session_id: Цепочка refresh-токенов (вход), к которой относится токен
         
     Returns:
         JWT токен в виде строки
     """
-    expire = datetime.utcnow() + timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS)
+    now = datetime.utcnow()
     to_encode = {
-        "sub": str(establishment_id),  # subject - ID пользователя
-        "exp": expire,  # expiration time
-        "iat": datetime.utcnow()  # issued at
+        "sub": str(establishment.id),  # subject - ID пользователя
+        "exp": now + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),  # expiration time
+        "iat": now,  # issued at
+        "jti": uuid.uuid4().hex,  # ID токена - для отзыва
+        "typ": "access",
+        "status": establishment.status,
+        "business_type": establishment.business_type,
     }
+    if session_id:
+        to_encode["sid"] = session_id
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
-def get_current_establishment(
-    token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db)
-) -> Establishment:
-    """
-    Проверяет JWT токен и возвращает текущего пользователя
-    
-    Args:
-        token: JWT токен из заголовка Authorization
-        db: Сессия базы данных
-        
-    Returns:
-        Объект Establishment текущего пользователя
-        
-    Raises:
-        HTTPException: Если токен невалиден или пользователь не найден
-    """
-    credentials_exception = HTTPException(
+def credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+
+def decode_access_token(token: str) -> TokenClaims:
+    """
+    Проверяет подпись и срок JWT токена и возвращает его данные
     
+    Отзыв здесь не проверяется - это делают зависимости ниже.
+    
+    Raises:
+        HTTPException: Если токен невалиден
+    """
     try:
         # Декодируем токен с проверкой всех ошибок
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         establishment_id: str = payload.get("sub")
         
-        if establishment_id is None:
-            raise credentials_exception
+        # Старые 7-дневные токены (без typ) не принимаются: их нельзя отозвать
+        if establishment_id is None or payload.get("typ") != "access":
+            raise credentials_exception()
         
         # Проверяем что establishment_id можно преобразовать в int
         try:
             establishment_id_int = int(establishment_id)
         except (ValueError, TypeError):
-            raise credentials_exception
+            raise credentials_exception()
+        
+        claims = TokenClaims(
+            id=establishment_id_int,
+            status=payload.get("status"),
+            business_type=payload.get("business_type"),
+            jti=payload.get("jti"),
+            session_id=payload.get("sid"),
+            expires_at=datetime.utcfromtimestamp(payload["exp"])
+        )
         
+    except HTTPException:
+        raise
     except JWTError:
         # Любая JWT ошибка (невалидный токен, истекший, неправильный формат и т.д.)
-        raise credentials_exception
+        raise credentials_exception()
     except Exception as e:
         # Любая другая неожиданная ошибка
-        print(f"Unexpected error in get_current_establishment: {e}")
-        raise credentials_exception
+        print(f"Unexpected error in decode_access_token: {e}")
+        raise credentials_exception()
+    
+    return claims
+
+
+async def get_current_principal(token: str = Depends(oauth2_scheme)) -> TokenClaims:
+    """
+    Проверяет JWT токен и возвращает данные пользователя из него
+    
+    Для обработчиков, которым нужны только id/статус/тип бизнеса: БД не
+    читается (кроме редкого срабатывания фильтра отзыва).
+    
+    Raises:
+        HTTPException: Если токен невалиден или отозван
+    """
+    claims = decode_access_token(token)
+    if revocation_list.might_be_revoked(claims.jti, claims.session_id):
+        async with AsyncReadSessionLocal() as db:
+            if await revocation_list.is_revoked_async(db, claims.jti, claims.session_id):
+                raise credentials_exception()
+    return claims
+
+
+async def get_current_establishment_async(
+    token: str = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_async_read_db)
+) -> Establishment:
+    """
+    Проверяет JWT токен и возвращает текущего пользователя (читает из пула чтения)
+    
+    Returns:
+        Копия строки Establishment текущего пользователя из principal_cache
+        (только для чтения: для изменений строку нужно прочитать в своей сессии)
+        
+    Raises:
+        HTTPException: Если токен невалиден, отозван или пользователь не найден
+    """
+    claims = decode_access_token(token)
+    if await revocation_list.is_revoked_async(db, claims.jti, claims.session_id):
+        raise credentials_exception()
+    establishment_id = claims.id
     
-    # Ищем пользователя в БД
-    establishment = db.query(Establishment).filter(
-        Establishment.id == establishment_id_int
-    ).first()
+    cached = principal_cache.get(establishment_id)
+    if cached is not None:
+        return cached
     
+    establishment = await db.get(Establishment, establishment_id)
     if establishment is None:
-        raise credentials_exception
+        raise credentials_exception()
     
-    return establishment
+    return principal_cache.put(establishment)
 
@@ -1,24 +1,123 @@
+import math
+import os
+import threading
+import time
+from typing import Optional
+
 import bcrypt
 
+# Целевое время одного хеширования пароля на этом сервере (мс).
+# Стоимость bcrypt подбирается под него при первом хешировании (calibrate_rounds)
+PASSWORD_HASH_TARGET_MS = float(os.getenv("PASSWORD_HASH_TARGET_MS", "250"))
+
+# Границы стоимости bcrypt: ниже 10 - слишком дешевый перебор, выше 16 - секунды на вход
+BCRYPT_MIN_ROUNDS = 10
+BCRYPT_MAX_ROUNDS = 16
+
+# Прежняя фиксированная стоимость: калибровка ниже нее допускается (медленное
+# железо), но сопровождается предупреждением в логе
+BCRYPT_RECOMMENDED_ROUNDS = 12
+
+# Явно заданная стоимость отключает калибровку
+_rounds: Optional[int] = int(os.environ["PASSWORD_HASH_ROUNDS"]) if os.getenv("PASSWORD_HASH_ROUNDS") else None
+_rounds_lock = threading.Lock()
+
+
+def _password_bytes(password: str) -> bytes:
+    # Bcrypt ограничивает длину пароля до 72 байт
+    # Обрезаем до 72 байт если нужно
+    password_bytes = password.encode('utf-8')
+    if len(password_bytes) > 72:
+        password_bytes = password_bytes[:72]
+    return password_bytes
+
+
+def measure_hash_ms(rounds: int = BCRYPT_MIN_ROUNDS, samples: int = 3) -> float:
+    """Время одного хеширования с этой стоимостью на этом сервере (лучший из замеров, мс)"""
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        bcrypt.hashpw(b"calibration", bcrypt.gensalt(rounds))
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings)
+
+
+def rounds_for_target(measured_ms: float, target_ms: float, measured_rounds: int = BCRYPT_MIN_ROUNDS) -> int:
+    """
+    Наибольшая стоимость, при которой хеширование укладывается в target_ms
+
+    Время bcrypt удваивается с каждой единицей стоимости, поэтому к стоимости
+    замера прибавляется log2(цель / замер). Результат - в границах
+    BCRYPT_MIN_ROUNDS..BCRYPT_MAX_ROUNDS.
+    """
+    rounds = measured_rounds + math.floor(math.log2(max(target_ms / measured_ms, 1)))
+    return max(BCRYPT_MIN_ROUNDS, min(rounds, BCRYPT_MAX_ROUNDS))
+
+
+def calibrate_rounds(target_ms: float = PASSWORD_HASH_TARGET_MS) -> int:
+    """Подбирает стоимость bcrypt под целевое время хеширования на этом сервере"""
+    measured = measure_hash_ms(BCRYPT_MIN_ROUNDS)
+    rounds = rounds_for_target(measured, target_ms)
+    print(
+        f"bcrypt calibrated: {rounds} rounds (measured {measured:.0f} ms at {BCRYPT_MIN_ROUNDS} rounds, "
+        f"~{measured * 2 ** (rounds - BCRYPT_MIN_ROUNDS):.0f} ms per hash, target {target_ms:.0f} ms)"
+    )
+    if rounds < BCRYPT_RECOMMENDED_ROUNDS:
+        print(
+            f"WARNING: bcrypt cost {rounds} is below {BCRYPT_RECOMMENDED_ROUNDS}: "
+            f"{BCRYPT_RECOMMENDED_ROUNDS} rounds would take "
+            f"~{measured * 2 ** (BCRYPT_RECOMMENDED_ROUNDS - BCRYPT_MIN_ROUNDS):.0f} ms on this server. "
+            f"Set PASSWORD_HASH_ROUNDS or raise PASSWORD_HASH_TARGET_MS to keep the stronger cost"
+        )
+    return rounds
+
+
+def get_rounds() -> int:
+    """Текущая стоимость bcrypt (калибруется один раз на процесс)"""
+    global _rounds
+    if _rounds is None:
+        with _rounds_lock:
+            if _rounds is None:
+                _rounds = calibrate_rounds()
+    return _rounds
+
+
+def hash_rounds(hashed_password: str) -> Optional[int]:
+    """Стоимость, с которой получен хеш ($2b$12$... -> 12); None для нераспознанного формата"""
+    parts = hashed_password.split("$")
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """
+    Хеш получен с меньшей стоимостью, чем текущая - его стоит пересчитать при входе
+
+    Только вверх: сервер, откалибровавшийся ниже (медленнее железо, занятый
+    процессор при старте), не должен ослаблять уже сохраненные хеши.
+    """
+    rounds = hash_rounds(hashed_password)
+    return rounds is not None and rounds < get_rounds()
+
 
 def hash_password(password: str) -> str:
     """
     Хеширует пароль используя bcrypt
-    
+
+    Стоимость - текущая откалиброванная (get_rounds); она сохраняется в самом хеше.
+
     Args:
         password: Пароль в открытом виде
-        
+
     Returns:
         Хешированный пароль (строка)
     """
-    # Bcrypt ограничивает длину пароля до 72 байт
-    # Обрезаем до 72 байт если нужно
-    password_bytes = password.encode('utf-8')
-    if len(password_bytes) > 72:
-        password_bytes = password_bytes[:72]
+    password_bytes = _password_bytes(password)
+    if len(password_bytes) < len(password.encode('utf-8')):
         print(f"Password truncated from {len(password.encode('utf-8'))} bytes to 72 bytes")
-    
-    salt = bcrypt.gensalt()
+
+    salt = bcrypt.gensalt(get_rounds())
     hashed = bcrypt.hashpw(password_bytes, salt)
     return hashed.decode('utf-8')
 
@@ -26,19 +125,14 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """
     Проверяет соответствие пароля его хешу
-    
+
     Args:
         plain_password: Пароль в открытом виде
         hashed_password: Хешированный пароль из БД
-        
+
     Returns:
         True если пароль совпадает, False иначе
     """
-    # Bcrypt ограничивает длину пароля до 72 байт
-    # Обрезаем до 72 байт если нужно (как при хешировании)
-    password_bytes = plain_password.encode('utf-8')
-    if len(password_bytes) > 72:
-        password_bytes = password_bytes[:72]
-    
+    # Обрезаем до 72 байт так же, как при хешировании
     hashed_bytes = hashed_password.encode('utf-8')
-    return bcrypt.checkpw(password_bytes, hashed_bytes)
+    return bcrypt.checkpw(_password_bytes(plain_password), hashed_bytes)
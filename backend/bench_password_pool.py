@@ -0,0 +1,108 @@
+"""
+Бенчмарк: задержка остальных запросов во время волны логинов
+
+Внутри одного event loop одновременно работают:
+- "легкий эндпоинт" - корутина, которая каждые 10 мс просыпается и замеряет,
+  насколько позже положенного ее разбудили (столько же ждал бы любой другой
+  запрос воркера);
+- волна логинов - N проверок пароля bcrypt.
+
+Три режима: без логинов (базовая линия), bcrypt прямо в корутине (как было)
+и bcrypt в пуле password_pool. Сервер и БД не нужны.
+
+Запуск: python bench_password_pool.py [--logins 40] [--concurrency 20] [--workers N] [--max-queue N]
+"""
+import argparse
+import asyncio
+import time
+from typing import List, Optional
+
+from auth_utils import hash_password, verify_password
+from password_pool import PASSWORD_HASH_MAX_QUEUE, PASSWORD_HASH_WORKERS, PasswordHasherPool, PasswordPoolBusy
+
+PROBE_INTERVAL = 0.01
+PASSWORD = "benchmark-password"
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] * 1000
+
+
+async def probe(stop: asyncio.Event, lags: List[float]) -> None:
+    """Легкий эндпоинт: на сколько опаздывает пробуждение"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - started - PROBE_INTERVAL)
+
+
+async def run_scenario(
+    mode: str,
+    hashed: str,
+    logins: int,
+    concurrency: int,
+    pool: Optional[PasswordHasherPool]
+) -> dict:
+    lags: List[float] = []
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(stop, lags))
+    rejected = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def login():
+        nonlocal rejected
+        async with semaphore:
+            if mode == "inline":
+                verify_password(PASSWORD, hashed)
+            else:
+                try:
+                    await pool.verify(PASSWORD, hashed)
+                except PasswordPoolBusy:
+                    rejected += 1
+            await asyncio.sleep(0)
+
+    started = time.perf_counter()
+    if mode == "idle":
+        await asyncio.sleep(1)
+    else:
+        await asyncio.gather(*[login() for _ in range(logins)])
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe_task
+
+    return {
+        "mode": mode,
+        "elapsed_s": round(elapsed, 2),
+        "probe_lag_p50_ms": round(percentile(lags, 0.5), 1),
+        "probe_lag_p99_ms": round(percentile(lags, 0.99), 1),
+        "probe_lag_max_ms": round(max(lags) * 1000, 1),
+        "rejected": rejected,
+    }
+
+
+async def main(logins: int, concurrency: int, workers: int, max_queue: int) -> None:
+    hashed = hash_password(PASSWORD)
+    pool = PasswordHasherPool(workers=workers, max_queue=max_queue)
+    print(f"{logins} logins, concurrency {concurrency}, pool: {workers} worker(s), queue {max_queue}\n")
+    header = f"{'mode':<8}{'elapsed, s':>12}{'lag p50, ms':>14}{'lag p99, ms':>14}{'lag max, ms':>14}{'rejected':>10}"
+    print(header)
+    print("-" * len(header))
+    for mode in ("idle", "inline", "pool"):
+        result = await run_scenario(mode, hashed, logins, concurrency, pool)
+        print(
+            f"{result['mode']:<8}{result['elapsed_s']:>12}{result['probe_lag_p50_ms']:>14}"
+            f"{result['probe_lag_p99_ms']:>14}{result['probe_lag_max_ms']:>14}{result['rejected']:>10}"
+        )
+    print("\nPool metrics:", pool.stats())
+    pool.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Задержка event loop во время волны логинов")
+    parser.add_argument("--logins", type=int, default=40, help="Сколько проверок пароля")
+    parser.add_argument("--concurrency", type=int, default=20, help="Одновременных логинов")
+    parser.add_argument("--workers", type=int, default=PASSWORD_HASH_WORKERS, help="Потоков в пуле")
+    parser.add_argument("--max-queue", type=int, default=PASSWORD_HASH_MAX_QUEUE, help="Длина очереди пула")
+    args = parser.parse_args()
+    asyncio.run(main(args.logins, args.concurrency, args.workers, args.max_queue))
@@ -1,15 +1,115 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, Text
+from sqlalchemy import create_engine, event, Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import Session, column_property, sessionmaker, relationship
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from collections import defaultdict
+from typing import Callable
 from datetime import datetime
+import os
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./ebar.db"
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./ebar.db"
 
+# Профиль SQLite: PRAGMA, которые выставляются на каждом соединении.
+# WAL позволяет читать параллельно с записью; synchronous=NORMAL в режиме WAL
+# не теряет целостность, а fsync делается только при checkpoint;
+# busy_timeout - писатель ждет освобождения блокировки, а не падает с "database is locked".
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    # Отрицательное значение - размер в КиБ (64 МБ на соединение)
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-65536")),
+    "temp_store": "MEMORY",
+}
+
+# Размер пула соединений только для чтения
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "5"))
+
+# Размер пула синхронного писателя (очередь задач, обслуживание, скрипты)
+SQLITE_SYNC_POOL_SIZE = int(os.getenv("SQLITE_SYNC_POOL_SIZE", "4"))
+
+# Сколько запрос ждет освобождения соединения писателя (секунды)
+SQLITE_WRITER_TIMEOUT = float(os.getenv("SQLITE_WRITER_TIMEOUT", "30"))
+
+
+def apply_sqlite_profile(target_engine, read_only: bool = False):
+    """Выставляет PRAGMA профиля на каждом новом соединении движка"""
+    @event.listens_for(target_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        if read_only:
+            # Соединение пула чтения физически не может ничего изменить
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+        if not read_only:
+            # Транзакциями управляет SQLAlchemy (событие begin ниже), а не драйвер
+            dbapi_connection.isolation_level = None
+
+    if not read_only:
+        @event.listens_for(target_engine, "begin")
+        def begin_immediate(connection):
+            # Блокировка записи берется в начале транзакции: писатели ждут друг
+            # друга по busy_timeout, а не получают SQLITE_BUSY при повышении
+            # читающей транзакции до пишущей. Заодно работают SAVEPOINT.
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+# Синхронный писатель: очередь задач, периодическое обслуживание, скрипты.
+# Запросы API пишут через write_queue (асинхронный писатель ниже). Соединений
+# у синхронного писателя несколько: фоновые задачи не ждут друг друга в пуле,
+# а пишущие транзакции SQLite упорядочивает сама (BEGIN IMMEDIATE + busy_timeout).
+# Поэтому фоновые задачи держат транзакцию коротко - сессия на пачку.
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    pool_size=SQLITE_SYNC_POOL_SIZE,
+    max_overflow=0,
+    pool_timeout=SQLITE_WRITER_TIMEOUT
 )
+apply_sqlite_profile(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Синхронный пул только для чтения (обработчики def, которые только читают)
+read_engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    pool_size=SQLITE_READ_POOL_SIZE
+)
+apply_sqlite_profile(read_engine, read_only=True)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+# Асинхронный доступ к той же БД (aiosqlite): запросы не блокируют event loop.
+# У запросов API писатель один (write_queue объединяет их записи в пакеты):
+# SQLite все равно допускает только одну пишущую транзакцию, поэтому запросы
+# ждут своей очереди в пуле, а не крутятся на SQLITE_BUSY.
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=1,
+    max_overflow=0,
+    pool_timeout=SQLITE_WRITER_TIMEOUT
+)
+apply_sqlite_profile(async_engine.sync_engine)
+# expire_on_commit=False: после коммита объекты читаются без повторного запроса
+# (ленивой подгрузки атрибутов в асинхронной сессии нет)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+# Асинхронный пул только для чтения: списки документов, статистика, профиль
+async_read_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=SQLITE_READ_POOL_SIZE
+)
+apply_sqlite_profile(async_read_engine.sync_engine, read_only=True)
+AsyncReadSessionLocal = async_sessionmaker(bind=async_read_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 
@@ -38,6 +138,13 @@ class Establishment(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_establishments_inn", "inn"),
+        Index("ix_establishments_ogrn", "ogrn"),
+        # Сверка файлов логотипов сборщиком мусора
+        Index("ix_establishments_logo_path", "logo_path"),
+    )
+
     documents = relationship("Document", back_populates="establishment")
 
 
@@ -53,14 +160,83 @@ class Document(Base):
     file_name = Column(String)
     required = Column(Boolean, default=False)
     uploaded = Column(Boolean, default=False)
-    status = Column(String, default="pending")  # pending, verified, rejected
-    verification_status = Column(String, default="verified")  # verified, update_required, update_by_date, invalid
+    # active_history: прежнее значение загружается и при изменении просроченного
+    # (после коммита) объекта - без него update_document_counters не знает, откуда вычесть
+    status = column_property(Column(String, default="pending"), active_history=True)  # pending, verified, rejected
+    verification_status = column_property(
+        Column(String, default="verified"), active_history=True
+    )  # verified, update_required, update_by_date, invalid
     expiry_date = Column(DateTime, nullable=True)  # Дата окончания действия документа
     uploaded_at = Column(DateTime)
     created_at = Column(DateTime, default=datetime.utcnow)
 
     establishment = relationship("Establishment", back_populates="documents")
 
+    # Почти все запросы к документам начинаются с establishment_id.
+    # Для уже созданных баз индексы добавляет миграция 2 (migrations.py)
+    __table_args__ = (
+        # Списки с курсором по (uploaded_at, id), выгрузка, статистика
+        Index("ix_documents_establishment_uploaded", "establishment_id", "uploaded_at", "id"),
+        Index("ix_documents_establishment_required", "establishment_id", "required"),
+        Index("ix_documents_establishment_status", "establishment_id", "status"),
+        Index("ix_documents_establishment_expiry", "establishment_id", "expiry_date"),
+        # Проверка сроков действия по всем заведениям (document_expiry)
+        Index("ix_documents_expiry_date", "expiry_date"),
+        # Поиск ссылок на файл (хранилище, сборщик мусора)
+        Index("ix_documents_file_path", "file_path"),
+        # id не выдаются повторно: на них ссылаются история версий и задачи
+        # (для уже созданных баз таблицу перестраивает миграция 6)
+        {"sqlite_autoincrement": True},
+    )
+
+
+class CurrentDocument(Base):
+    """
+    Указатель на текущую версию документа каждого типа у заведения
+
+    В таблице documents лежат только текущие версии, замененные переносятся
+    в document_history. version - номер текущей версии (счетчик не сбрасывается,
+    даже если текущий документ удален: тогда document_id пустой).
+    """
+    __tablename__ = "current_documents"
+
+    establishment_id = Column(Integer, primary_key=True)
+    document_type = Column(String, primary_key=True)
+    document_id = Column(Integer, nullable=True, unique=True)
+    version = Column(Integer, nullable=False, default=1)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class DocumentHistory(Base):
+    """Замененная версия документа (копия строки documents на момент замены)"""
+    __tablename__ = "document_history"
+
+    id = Column(Integer, primary_key=True, index=True)
+    document_id = Column(Integer, nullable=False)  # id строки в documents, пока версия была текущей
+    establishment_id = Column(Integer, nullable=False)
+    document_type = Column(String, nullable=False)
+    version = Column(Integer, nullable=False)
+    document_group = Column(String, nullable=False)
+    document_name = Column(String, nullable=False)
+    file_path = Column(String)
+    file_name = Column(String)
+    required = Column(Boolean, default=False)
+    status = Column(String)
+    verification_status = Column(String)
+    expiry_date = Column(DateTime, nullable=True)
+    uploaded_at = Column(DateTime)
+    created_at = Column(DateTime)
+    superseded_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # История одного типа документа, новые версии первыми
+        Index("ix_document_history_type_version", "establishment_id", "document_type", "version"),
+        # Файлы старых версий тоже считаются используемыми
+        Index("ix_document_history_file_path", "file_path"),
+        # Удаление версий старше срока хранения (document_versions.prune_history)
+        Index("ix_document_history_superseded_at", "superseded_at"),
+    )
+
 
 class PasswordResetToken(Base):
     __tablename__ = "password_reset_tokens"
@@ -72,18 +248,210 @@ class PasswordResetToken(Base):
     expires_at = Column(DateTime, nullable=False)  # Токен живет 1 час
     used = Column(Boolean, default=False, nullable=False)  # Использован ли токен
 
+    __table_args__ = (
+        Index("ix_password_reset_tokens_expires_at", "expires_at"),
+        # Проверка токена при сбросе пароля читается из индекса, без обращения к строке
+        Index("ix_password_reset_tokens_lookup", "token", "used", "expires_at"),
+    )
+
     establishment = relationship("Establishment")
 
 
+class RefreshToken(Base):
+    """
+    Refresh-токен (в БД - только SHA-256 от него)
+
+    Токены одной цепочки ротаций (одного входа) объединены family_id.
+    Повторное предъявление уже замененного токена отзывает всю цепочку.
+    """
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True, index=True)
+    token_hash = Column(String(64), nullable=False, unique=True, index=True)
+    family_id = Column(String(32), nullable=False, index=True)
+    establishment_id = Column(Integer, ForeignKey("establishments.id"), nullable=False, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    rotated_at = Column(DateTime, nullable=True)  # Когда токен обменяли на следующий
+    revoked_at = Column(DateTime, nullable=True)
+
+
+class RevokedToken(Base):
+    """Отозванный access-токен (jti) или цепочка входа (sid) - до истечения последнего access-токена"""
+    __tablename__ = "revoked_tokens"
+
+    token_id = Column(String(32), primary_key=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class FileBlob(Base):
+    """Файл в контентно-адресуемом хранилище (один файл на уникальное содержимое)"""
+    __tablename__ = "file_blobs"
+
+    sha256 = Column(String(64), primary_key=True)  # SHA-256 содержимого
+    file_path = Column(String, nullable=False, unique=True, index=True)  # Путь к файлу на диске
+    size = Column(Integer, nullable=False)  # Размер в байтах
+    ref_count = Column(Integer, nullable=False, default=0)  # Сколько документов ссылается на файл
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class Job(Base):
+    """Фоновая задача (обработка документа после загрузки и т.п.)"""
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)  # Тип задачи: thumbnails, ...
+    document_id = Column(Integer, ForeignKey("documents.id"), nullable=True, index=True)
+    payload = Column(Text, nullable=True)  # Параметры задачи в JSON
+    status = Column(String, nullable=False, default="queued")  # queued, running, done, failed
+    attempts = Column(Integer, nullable=False, default=0)  # Сколько раз задача запускалась
+    max_attempts = Column(Integer, nullable=False, default=5)
+    run_after = Column(DateTime, nullable=False, default=datetime.utcnow)  # Не запускать раньше (для повторов)
+    locked_until = Column(DateTime, nullable=True)  # Аренда выполняющейся задачи (восстановление после падения)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_jobs_status_run_after", "status", "run_after"),
+    )
+
+
+class MaintenanceState(Base):
+    """Состояние фоновых обслуживающих процессов (курсоры, водяные знаки)"""
+    __tablename__ = "maintenance_state"
+
+    name = Column(String, primary_key=True)  # Например: file_gc.cursor
+    value = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class DocumentCounter(Base):
+    """
+    Счетчики документов заведения для статистики без перебора документов
+
+    dimension: total (value пустой), status или verification_status.
+    Поддерживаются автоматически при каждом flush (см. update_document_counters).
+    """
+    __tablename__ = "document_counters"
+
+    establishment_id = Column(Integer, primary_key=True)
+    dimension = Column(String, primary_key=True)
+    value = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+# Поля документа, по которым ведутся счетчики
+COUNTED_DOCUMENT_FIELDS = ("status", "verification_status")
+
+
+@event.listens_for(Session, "after_flush")
+def update_document_counters(session, flush_context):
+    """Переносит изменения документов в document_counters в той же транзакции"""
+    deltas = defaultdict(int)
+
+    def count(establishment_id, dimension, value, delta):
+        if establishment_id is not None and value is not None:
+            deltas[(establishment_id, dimension, value)] += delta
+
+    def old_value(document, field):
+        history = get_history(document, field)
+        if history.deleted:
+            return history.deleted[0]
+        return getattr(document, field)
+
+    for document in session.new:
+        if isinstance(document, Document):
+            count(document.establishment_id, "total", "", 1)
+            for field in COUNTED_DOCUMENT_FIELDS:
+                count(document.establishment_id, field, getattr(document, field), 1)
+
+    for document in session.deleted:
+        if isinstance(document, Document):
+            count(document.establishment_id, "total", "", -1)
+            for field in COUNTED_DOCUMENT_FIELDS:
+                count(document.establishment_id, field, old_value(document, field), -1)
+
+    for document in session.dirty:
+        if not isinstance(document, Document):
+            continue
+        for field in COUNTED_DOCUMENT_FIELDS:
+            history = get_history(document, field)
+            if history.added and history.added[0] != old_value(document, field):
+                count(document.establishment_id, field, old_value(document, field), -1)
+                count(document.establishment_id, field, history.added[0], 1)
+
+    apply_counter_deltas(session.connection(), deltas)
+
+
+def run_after_commit(session: Session, action: Callable[[], None]) -> None:
+    """
+    Выполняет action после успешного коммита текущей транзакции сессии
+
+    Для действий вне БД (перенос и удаление файлов), которые нельзя откатить:
+    при откате транзакции action не выполняется. Работает и для сессий
+    очереди записи (write_queue): их синхронная сессия - тоже Session.
+    """
+    session.info.setdefault("after_commit", []).append(action)
+
+
+@event.listens_for(Session, "after_commit")
+def _run_after_commit_actions(session):
+    for action in session.info.pop("after_commit", []):
+        try:
+            action()
+        except Exception as e:
+            # Транзакция уже закоммичена - ошибка действия не должна выглядеть как ошибка записи
+            print(f"[db] After-commit action failed: {e}")
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _discard_after_commit_actions(session, transaction):
+    # Откат или закрытие сессии без коммита: действия отменяются вместе с транзакцией
+    if transaction.parent is None:
+        session.info.pop("after_commit", None)
+
+
+def apply_counter_deltas(connection, deltas) -> None:
+    """
+    Прибавляет изменения к document_counters
+
+    Нужна и коду, который меняет документы в обход ORM (массовые UPDATE).
+
+    Args:
+        deltas: {(establishment_id, dimension, value): изменение}
+    """
+    for (establishment_id, dimension, value), delta in deltas.items():
+        if delta == 0:
+            continue
+        connection.execute(
+            sqlite_insert(DocumentCounter)
+            .values(establishment_id=establishment_id, dimension=dimension, value=value, count=delta)
+            .on_conflict_do_update(
+                index_elements=["establishment_id", "dimension", "value"],
+                set_={"count": DocumentCounter.count + delta}
+            )
+        )
+
+
 # Создаем таблицы при импорте
 def init_db():
     Base.metadata.create_all(bind=engine)
+    # Изменения уже существующих таблиц - версионными миграциями
+    from migrations import upgrade_schema
+    upgrade_schema()
 
 
-def get_db():
-    db = SessionLocal()
+def get_read_db():
+    db = ReadSessionLocal()
     try:
         yield db
     finally:
         db.close()
 
+
+async def get_async_read_db():
+    async with AsyncReadSessionLocal() as db:
+        yield db
+
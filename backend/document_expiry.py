@@ -0,0 +1,185 @@
+"""
+Сроки действия документов
+
+Периодическая задача переводит документы по expiry_date:
+- за EXPIRY_WARNING_DAYS до окончания срока: verified -> update_by_date;
+- в момент окончания срока: любой статус -> invalid.
+
+Каждый запуск обрабатывает только документы, пересекшие порог с прошлого
+запуска: диапазон (прошлый запуск, сейчас] по индексу ix_documents_expiry_date,
+а время прошлого запуска (водяной знак) хранится в maintenance_state. Таблица
+целиком не перечитывается. Статусы меняются массовыми UPDATE пачками,
+счетчики статистики правятся в той же транзакции.
+
+Переходы идемпотентны (условие на текущий статус), поэтому повторный или
+параллельный запуск с другого воркера ничего не испортит.
+
+Дату, уже попавшую за водяной знак (ее выставили задним числом), учитывает
+apply_expiry() при записи документа.
+
+Запуск вручную: python document_expiry.py [--dry-run]
+"""
+import argparse
+import json
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from database import Document, MaintenanceState, SessionLocal, apply_counter_deltas, init_db
+
+# За сколько дней до окончания срока документ нужно обновить
+EXPIRY_WARNING_DAYS = int(os.getenv("EXPIRY_WARNING_DAYS", "7"))
+
+# Сколько документов менять одной транзакцией
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", "500"))
+
+WATERMARK_KEY = "document_expiry.watermark"
+
+WARNING_STATUS = "update_by_date"
+EXPIRED_STATUS = "invalid"
+
+
+def apply_expiry(document: Document, now: Optional[datetime] = None) -> None:
+    """Выставляет статус по сроку действия сразу (при изменении expiry_date)"""
+    if document.expiry_date is None:
+        return
+    now = now or datetime.utcnow()
+    if document.expiry_date <= now:
+        document.verification_status = EXPIRED_STATUS
+    elif document.expiry_date <= now + timedelta(days=EXPIRY_WARNING_DAYS) and document.verification_status == "verified":
+        document.verification_status = WARNING_STATUS
+
+
+def _load_watermark(db: Session) -> Optional[datetime]:
+    state = db.query(MaintenanceState).filter(MaintenanceState.name == WATERMARK_KEY).first()
+    return datetime.fromisoformat(state.value) if state and state.value else None
+
+
+def _save_watermark(db: Session, watermark: datetime) -> None:
+    value = watermark.isoformat()
+    db.execute(
+        sqlite_insert(MaintenanceState)
+        .values(name=WATERMARK_KEY, value=value, updated_at=datetime.utcnow())
+        .on_conflict_do_update(index_elements=["name"], set_={"value": value, "updated_at": datetime.utcnow()})
+    )
+
+
+def transition(
+    db: Session,
+    since: Optional[datetime],
+    until: datetime,
+    from_condition,
+    new_status: str,
+    dry_run: bool = False
+) -> int:
+    """
+    Переводит в new_status документы с expiry_date в (since, until], подходящие под from_condition
+
+    Пачки идут по (expiry_date, id); каждая - отдельная транзакция.
+
+    Returns:
+        Количество измененных документов
+    """
+    changed = 0
+    last = None
+    while True:
+        query = select(
+            Document.id, Document.establishment_id, Document.verification_status, Document.expiry_date
+        ).where(Document.expiry_date <= until, from_condition)
+        if since is not None:
+            query = query.where(Document.expiry_date > since)
+        if last is not None:
+            query = query.where(or_(
+                Document.expiry_date > last[0],
+                and_(Document.expiry_date == last[0], Document.id > last[1])
+            ))
+        rows = db.execute(query.order_by(Document.expiry_date, Document.id).limit(EXPIRY_BATCH_SIZE)).all()
+        if not rows:
+            return changed
+        last = (rows[-1].expiry_date, rows[-1].id)
+        changed += len(rows)
+        if dry_run:
+            continue
+
+        db.execute(
+            update(Document)
+            .where(Document.id.in_([row.id for row in rows]))
+            .values(verification_status=new_status)
+            .execution_options(synchronize_session=False)
+        )
+        # UPDATE в обход ORM - счетчики статистики правим сами
+        deltas = defaultdict(int)
+        for row in rows:
+            if row.establishment_id is None:
+                continue
+            if row.verification_status is not None:
+                deltas[(row.establishment_id, "verification_status", row.verification_status)] -= 1
+            deltas[(row.establishment_id, "verification_status", new_status)] += 1
+        apply_counter_deltas(db.connection(), deltas)
+        db.commit()
+
+
+def check_expiry(db: Session, now: Optional[datetime] = None, dry_run: bool = False) -> dict:
+    """
+    Один проход: переходы с прошлого запуска до now, затем сдвиг водяного знака
+
+    Returns:
+        Отчет: границы диапазона, сколько документов получили предупреждение и сколько истекли
+    """
+    now = now or datetime.utcnow()
+    since = _load_watermark(db)
+    if since is not None and since >= now:
+        return {"since": since.isoformat(), "until": now.isoformat(), "warned": 0, "expired": 0, "dry_run": dry_run}
+
+    warning = timedelta(days=EXPIRY_WARNING_DAYS)
+    report = {
+        "since": since.isoformat() if since else None,
+        "until": now.isoformat(),
+        # Сначала истекшие: документ, пересекший оба порога, сразу становится invalid
+        "expired": transition(
+            db, since, now,
+            or_(Document.verification_status != EXPIRED_STATUS, Document.verification_status.is_(None)),
+            EXPIRED_STATUS, dry_run
+        ),
+        # Предупреждение: порог now + warning; без водяного знака - все, кто еще не истек
+        "warned": transition(
+            db, since + warning if since else now, now + warning,
+            Document.verification_status == "verified",
+            WARNING_STATUS, dry_run
+        ),
+        "dry_run": dry_run,
+    }
+    if not dry_run:
+        _save_watermark(db, now)
+        db.commit()
+    return report
+
+
+def run_expiry_check(session_factory: Callable[[], Session] = SessionLocal, dry_run: bool = False) -> dict:
+    """check_expiry() в отдельной сессии (для фоновой задачи и CLI)"""
+    db = session_factory()
+    try:
+        report = check_expiry(db, dry_run=dry_run)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    print(
+        f"[expiry] {report['since']}..{report['until']}: warned {report['warned']}, "
+        f"expired {report['expired']}" + (" (dry run)" if dry_run else "")
+    )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Перевод документов по сроку действия")
+    parser.add_argument("--dry-run", action="store_true", help="Только посчитать, что изменится")
+    args = parser.parse_args()
+    init_db()
+    print(json.dumps(run_expiry_check(dry_run=args.dry_run), ensure_ascii=False, indent=2))
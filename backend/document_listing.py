@@ -0,0 +1,108 @@
+"""
+Постраничная выдача списка документов
+
+Курсорная (keyset) пагинация по (uploaded_at, id): следующая страница
+начинается сразу после последней строки предыдущей, поэтому запрос страницы
+не зависит от ее номера (без OFFSET) и не теряет строки при вставках.
+Курсор - непрозрачная для клиента строка (base64 от JSON).
+
+fields= ограничивает набор колонок: из SQLite читаются только они.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import Document
+from schemas import DocumentResponse
+
+# Размер страницы по умолчанию и максимальный
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# Поля, которые можно запросить через fields=
+DOCUMENT_FIELDS = list(DocumentResponse.model_fields.keys())
+
+
+def encode_cursor(uploaded_at: Optional[datetime], document_id: int) -> str:
+    raw = json.dumps([uploaded_at.isoformat() if uploaded_at else None, document_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime], int]:
+    """Разбирает курсор; HTTPException 400, если он поврежден"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        uploaded_at, document_id = json.loads(raw)
+        return (datetime.fromisoformat(uploaded_at) if uploaded_at else None), int(document_id)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def parse_fields(fields: Optional[str]) -> List[str]:
+    """Список запрошенных полей (все поля, если fields не задан)"""
+    if not fields:
+        return DOCUMENT_FIELDS
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in DOCUMENT_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    # Порядок - как в схеме, без повторов
+    return [field for field in DOCUMENT_FIELDS if field in requested]
+
+
+def _after_cursor(uploaded_at: Optional[datetime], document_id: int):
+    """Условие "строго после курсора" в порядке (uploaded_at, id); NULL идут первыми"""
+    if uploaded_at is None:
+        return or_(
+            Document.uploaded_at.isnot(None),
+            and_(Document.uploaded_at.is_(None), Document.id > document_id)
+        )
+    return or_(
+        Document.uploaded_at > uploaded_at,
+        and_(Document.uploaded_at == uploaded_at, Document.id > document_id)
+    )
+
+
+async def list_documents_page(
+    db: AsyncSession,
+    establishment_id: int,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    document_group: Optional[str] = None,
+    verification_status: Optional[str] = None,
+    fields: Optional[str] = None
+) -> Tuple[List[dict], Optional[str]]:
+    """
+    Одна страница документов заведения
+
+    Returns:
+        (документы в виде словарей только с запрошенными полями, курсор следующей страницы или None)
+    """
+    selected = parse_fields(fields)
+    # id и uploaded_at нужны для курсора, даже если их не просили
+    columns = list(dict.fromkeys(selected + ["id", "uploaded_at"]))
+
+    query = select(*[getattr(Document, column) for column in columns]).where(
+        Document.establishment_id == establishment_id
+    )
+    if document_group:
+        query = query.where(Document.document_group == document_group)
+    if verification_status:
+        query = query.where(Document.verification_status == verification_status)
+    if cursor:
+        query = query.where(_after_cursor(*decode_cursor(cursor)))
+    # На одну строку больше - чтобы узнать, есть ли следующая страница
+    query = query.order_by(Document.uploaded_at, Document.id).limit(limit + 1)
+
+    rows = (await db.execute(query)).mappings().all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["uploaded_at"], rows[-1]["id"])
+    return [{field: row[field] for field in selected} for row in rows], next_cursor
@@ -0,0 +1,87 @@
+"""
+Статистика документов заведения
+
+Основной источник - таблица document_counters: счетчики обновляются в той же
+транзакции, что и сами документы, поэтому запрос статистики читает несколько
+строк по первичному ключу вне зависимости от количества документов.
+Точный пересчет делается агрегатами GROUP BY по таблице documents.
+"""
+from typing import Iterable, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, literal, select
+from sqlalchemy.orm import Session
+
+from database import COUNTED_DOCUMENT_FIELDS, Document, DocumentCounter
+
+# Статусы, которые всегда есть в ответе (даже с нулем)
+DOCUMENT_STATUSES = ("pending", "verified", "rejected")
+
+
+def stats_from_counts(rows: Iterable[Tuple[str, str, int]]) -> dict:
+    """Ответ API из строк (dimension, value, count)"""
+    stats = {"total": 0, **{status: 0 for status in DOCUMENT_STATUSES}, "verification_status": {}}
+    for dimension, value, count in rows:
+        if not count:
+            continue
+        if dimension == "total":
+            stats["total"] = count
+        elif dimension == "status":
+            stats[value] = count
+        elif dimension == "verification_status":
+            stats["verification_status"][value] = count
+    return stats
+
+
+def counters_query(establishment_id: int):
+    """Счетчики заведения из document_counters"""
+    return select(DocumentCounter.dimension, DocumentCounter.value, DocumentCounter.count).where(
+        DocumentCounter.establishment_id == establishment_id
+    )
+
+
+def aggregate_queries(establishment_id: Optional[int] = None):
+    """
+    GROUP BY агрегаты по таблице documents: строки (establishment_id, dimension, value, count)
+
+    Один запрос на каждое считаемое поле плюс общее количество.
+    Без establishment_id - по всем заведениям (для пересчета счетчиков).
+    """
+    def scoped(query):
+        if establishment_id is not None:
+            return query.where(Document.establishment_id == establishment_id)
+        return query.where(Document.establishment_id.isnot(None))
+
+    queries = [scoped(
+        select(Document.establishment_id, literal("total"), literal(""), func.count())
+        .group_by(Document.establishment_id)
+    )]
+    for field in COUNTED_DOCUMENT_FIELDS:
+        column = getattr(Document, field)
+        queries.append(scoped(
+            select(Document.establishment_id, literal(field), column, func.count())
+            .where(column.isnot(None))
+            .group_by(Document.establishment_id, column)
+        ))
+    return queries
+
+
+def rebuild_document_counters(db: Session) -> int:
+    """Пересчитывает document_counters с нуля; возвращает количество строк счетчиков"""
+    db.execute(delete(DocumentCounter))
+    total = 0
+    for query in aggregate_queries():
+        result = db.execute(
+            insert(DocumentCounter).from_select(
+                ["establishment_id", "dimension", "value", "count"], query
+            )
+        )
+        total += result.rowcount
+    db.commit()
+    return total
+
+
+def counters_need_rebuild(db: Session) -> bool:
+    """Счетчиков нет, а документы есть - таблица появилась после документов"""
+    has_counters = db.execute(select(DocumentCounter.establishment_id).limit(1)).first() is not None
+    has_documents = db.execute(select(Document.id).limit(1)).first() is not None
+    return has_documents and not has_counters
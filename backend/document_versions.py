@@ -0,0 +1,188 @@
+"""
+Версии документов
+
+У заведения по каждому типу документа одна текущая версия. Таблица documents
+хранит только текущие версии, поэтому списки, проверка обязательных документов,
+статистика и выгрузка читают не больше одной строки на тип, сколько бы раз
+документ ни перезагружали. Замененная версия переносится в document_history
+(вместе со ссылкой на файл в хранилище), а current_documents хранит номер
+текущей версии и id ее строки.
+
+Все функции работают в транзакции вызывающего кода. Запись начинается с
+blob_store.put (см. add_document_record), так что указатель читается уже под
+блокировкой записи SQLite и две загрузки одного типа не заменят одну версию дважды.
+
+Версии старше DOCUMENT_HISTORY_RETENTION_DAYS удаляет периодическая задача
+prune_history; ссылки на их файлы в хранилище при этом освобождаются, и файлы
+без ссылок забирает сборщик мусора.
+"""
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from database import CurrentDocument, Document, DocumentHistory, SessionLocal
+from storage import BlobStore
+
+# Размер страницы истории по умолчанию и максимальный
+DEFAULT_HISTORY_PAGE_SIZE = 20
+MAX_HISTORY_PAGE_SIZE = 100
+
+# Сколько хранить замененные версии (дней с момента замены); 0 - хранить всегда
+DOCUMENT_HISTORY_RETENTION_DAYS = int(os.getenv("DOCUMENT_HISTORY_RETENTION_DAYS", "730"))
+
+# Сколько версий удалять одной транзакцией
+HISTORY_PRUNE_BATCH = int(os.getenv("DOCUMENT_HISTORY_PRUNE_BATCH", "500"))
+
+# Поля версии в ответе API
+HISTORY_FIELDS = (
+    "id", "document_id", "version", "document_group", "document_type", "document_name",
+    "file_name", "required", "status", "verification_status", "expiry_date",
+    "uploaded_at", "created_at", "superseded_at",
+)
+
+
+def replace_current(db: Session, document: Document) -> Optional[DocumentHistory]:
+    """
+    Делает документ (уже получивший id) текущей версией своего типа
+
+    Прежняя текущая версия переносится в историю, ссылка на ее файл в хранилище
+    переходит к записи истории (release не нужен, его делает prune_history).
+    id документов не переиспользуются (AUTOINCREMENT), так что document_id
+    записи истории однозначен.
+
+    Returns:
+        Запись истории прежней версии или None, если ее не было
+    """
+    key = (document.establishment_id, document.document_type)
+    pointer = db.get(CurrentDocument, key)
+    if pointer is None:
+        db.add(CurrentDocument(
+            establishment_id=document.establishment_id,
+            document_type=document.document_type,
+            document_id=document.id,
+            version=1
+        ))
+        db.flush()
+        return None
+
+    current = db.get(Document, pointer.document_id) if pointer.document_id is not None else None
+    entry = None
+    if current is not None and current.id != document.id:
+        entry = DocumentHistory(
+            document_id=current.id,
+            establishment_id=current.establishment_id,
+            document_type=current.document_type,
+            version=pointer.version,
+            document_group=current.document_group,
+            document_name=current.document_name,
+            file_path=current.file_path,
+            file_name=current.file_name,
+            required=current.required,
+            status=current.status,
+            verification_status=current.verification_status,
+            expiry_date=current.expiry_date,
+            uploaded_at=current.uploaded_at,
+            created_at=current.created_at,
+            superseded_at=datetime.utcnow()
+        )
+        db.add(entry)
+        db.delete(current)
+
+    pointer.document_id = document.id
+    pointer.version += 1
+    db.flush()
+    return entry
+
+
+def forget_current(db: Session, document: Document) -> None:
+    """Документ удаляется: у его типа больше нет текущей версии (номер версии сохраняется)"""
+    pointer = db.get(CurrentDocument, (document.establishment_id, document.document_type))
+    if pointer is not None and pointer.document_id == document.id:
+        pointer.document_id = None
+
+
+def prune_history(
+    blob_store: BlobStore,
+    session_factory: Callable[[], Session] = SessionLocal,
+    retention_days: int = DOCUMENT_HISTORY_RETENTION_DAYS,
+    batch_size: int = HISTORY_PRUNE_BATCH,
+    pause: float = 0.05
+) -> int:
+    """
+    Удаляет версии, замененные раньше срока хранения, и освобождает их файлы
+
+    Returns:
+        Количество удаленных версий
+    """
+    if retention_days <= 0:
+        return 0
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    removed = 0
+    while True:
+        # Сессия на пачку: между пачками соединение писателя свободно
+        with session_factory() as db:
+            rows = db.execute(
+                select(DocumentHistory.id, DocumentHistory.file_path)
+                .where(DocumentHistory.superseded_at < cutoff)
+                .order_by(DocumentHistory.superseded_at)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            for row in rows:
+                blob_store.release(db, row.file_path)
+            db.execute(delete(DocumentHistory).where(DocumentHistory.id.in_([row.id for row in rows])))
+            db.commit()
+        removed += len(rows)
+        if len(rows) < batch_size:
+            break
+        time.sleep(pause)
+    if removed:
+        print(f"[document-history] Pruned {removed} version(s) older than {retention_days} days")
+    return removed
+
+
+async def history_page(
+    db: AsyncSession,
+    establishment_id: int,
+    document_type: str,
+    limit: int = DEFAULT_HISTORY_PAGE_SIZE,
+    cursor: Optional[str] = None
+) -> Tuple[List[dict], Optional[str]]:
+    """
+    Одна страница замененных версий документа, новые первыми
+
+    Курсор - номер последней версии предыдущей страницы.
+
+    Returns:
+        (версии в виде словарей, курсор следующей страницы или None)
+    """
+    query = select(*[getattr(DocumentHistory, field) for field in HISTORY_FIELDS]).where(
+        DocumentHistory.establishment_id == establishment_id,
+        DocumentHistory.document_type == document_type
+    )
+    if cursor:
+        try:
+            before_version = int(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.where(DocumentHistory.version < before_version)
+    query = query.order_by(DocumentHistory.version.desc()).limit(limit + 1)
+
+    rows = (await db.execute(query)).mappings().all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = str(rows[-1]["version"])
+    return [dict(row) for row in rows], next_cursor
+
+
+async def current_version(db: AsyncSession, establishment_id: int, document_type: str) -> Optional[CurrentDocument]:
+    """Указатель на текущую версию (None, если документ этого типа не загружали)"""
+    return await db.get(CurrentDocument, (establishment_id, document_type))
@@ -0,0 +1,206 @@
+"""
+Отдача сохраненных файлов: ETag, условные запросы, Range и zero-copy
+
+Файлы документов неизменяемы (адресуются по хешу или uuid), поэтому их можно
+кешировать надолго, а повторные запросы закрывать ответом 304. Просмотрщики PDF
+запрашивают файл кусками через Range - на такие запросы отвечаем 206.
+
+Отдача тела:
+- если задан SENDFILE_HEADER (X-Accel-Redirect для nginx, X-Sendfile для
+  Apache/lighttpd), тело отдает фронтовой сервер через sendfile ядра - это
+  единственный zero-copy вариант в боевой схеме (настройка nginx - в README);
+- если сервер поддерживает ASGI-расширение http.response.zerocopysend, файл
+  уходит через sendfile; uvicorn и hypercorn его не реализуют, так что без
+  SENDFILE_HEADER эта ветка обычно не срабатывает;
+- иначе файл читается неблокирующе кусками фиксированного размера, через
+  буферы Python (по умолчанию, в том числе при локальном запуске без nginx).
+"""
+import mimetypes
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Tuple
+from urllib.parse import quote
+
+import aiofiles
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+# Заголовок для передачи отдачи файла фронтовому серверу (например X-Accel-Redirect).
+# По умолчанию пуст: без фронтового сервера файлы отдает сам Python
+SENDFILE_HEADER = os.getenv("SENDFILE_HEADER", "")
+# Внутренний URL-префикс фронтового сервера, соответствующий корню загрузок
+SENDFILE_URL_PREFIX = os.getenv("SENDFILE_URL_PREFIX", "/protected-uploads/")
+
+# Файлы неизменяемы: кешируем на год, но только в браузере пользователя
+CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+CHUNK_SIZE = 256 * 1024
+
+
+def file_etag(path: str, stat_result: os.stat_result, content_hash: Optional[str] = None) -> str:
+    """
+    Сильный ETag файла
+
+    Для файлов хранилища это хеш содержимого; для остальных (неизменяемых,
+    с uuid в имени) - время изменения и размер.
+    """
+    if content_hash:
+        return f'"{content_hash}"'
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+def _etag_matches(header_value: str, etag: str) -> bool:
+    """Сравнение для If-None-Match (слабое сравнение, как требует RFC 9110)"""
+    if header_value.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in header_value.split(",")]
+    return etag in candidates or f"W/{etag}" in candidates
+
+
+def _not_modified(request: Request, etag: str, stat_result: os.stat_result) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(stat_result.st_mtime) <= since
+    return False
+
+
+def _parse_range(header_value: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Разбирает заголовок Range (поддерживается один диапазон)
+
+    Returns:
+        (start, end) включительно; None если заголовок не поддерживается
+        (тогда отдаем файл целиком)
+
+    Raises:
+        ValueError: Диапазон не пересекается с файлом (ответ 416)
+    """
+    unit, _, ranges = header_value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    start_str, _, end_str = ranges.strip().partition("-")
+    if not start_str.isdigit() and not end_str.isdigit():
+        return None
+
+    if not start_str:
+        # Суффикс: последние N байт
+        length = int(end_str)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+
+    start = int(start_str)
+    end = int(end_str) if end_str.isdigit() else size - 1
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, size - 1)
+
+
+class FileRangeResponse(Response):
+    """Ответ с содержимым файла (целиком или диапазон), отдаваемый без чтения в память"""
+
+    def __init__(self, path: str, start: int, length: int, status_code: int, headers: dict):
+        super().__init__(status_code=status_code, headers=headers)
+        self.path = path
+        self.start = start
+        self.length = length
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope.get("method") == "HEAD" or self.length == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as f:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": f.fileno(),
+                    "offset": self.start,
+                    "count": self.length,
+                    "more_body": False,
+                })
+            return
+
+        remaining = self.length
+        async with aiofiles.open(self.path, "rb") as f:
+            await f.seek(self.start)
+            while remaining > 0:
+                chunk = await f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        if remaining > 0:
+            # Файл укоротился во время отдачи - закрываем тело
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def file_download_response(
+    request: Request,
+    path: str,
+    download_name: str,
+    root_dir: str,
+    content_hash: Optional[str] = None,
+) -> Response:
+    """
+    Формирует ответ на скачивание файла с учетом условных запросов и Range
+
+    Args:
+        request: Входящий запрос
+        path: Путь к файлу на диске
+        download_name: Имя файла для Content-Disposition
+        root_dir: Корень загрузок (для формирования внутреннего URL при SENDFILE_HEADER)
+        content_hash: SHA-256 содержимого, если известен
+    """
+    stat_result = os.stat(path)
+    size = stat_result.st_size
+    etag = file_etag(path, stat_result, content_hash)
+    media_type = mimetypes.guess_type(download_name)[0] or "application/octet-stream"
+
+    headers = {
+        "etag": etag,
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "cache-control": CACHE_CONTROL,
+        "accept-ranges": "bytes",
+    }
+
+    if _not_modified(request, etag, stat_result):
+        return Response(status_code=304, headers=headers)
+
+    headers["content-type"] = media_type
+    headers["content-disposition"] = f"inline; filename*=UTF-8''{quote(download_name)}"
+
+    if SENDFILE_HEADER:
+        # Диапазоны и sendfile обработает фронтовой сервер
+        relative = os.path.relpath(path, root_dir).replace(os.sep, "/")
+        headers[SENDFILE_HEADER] = SENDFILE_URL_PREFIX + quote(relative)
+        return Response(status_code=200, headers=headers)
+
+    start, end = 0, size - 1
+    status_code = 200
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # If-Range с устаревшим валидатором - отдаем файл целиком
+    if range_header and (if_range is None or if_range.strip() == etag):
+        try:
+            byte_range = _parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "content-range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            status_code = 206
+            headers["content-range"] = f"bytes {start}-{end}/{size}"
+
+    length = max(end - start + 1, 0)
+    headers["content-length"] = str(length)
+    return FileRangeResponse(path, start, length, status_code, headers)
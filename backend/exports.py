@@ -0,0 +1,177 @@
+"""
+Потоковая выгрузка пакета документов в ZIP
+
+Архив собирается на лету, по мере отправки клиенту: без временного файла и без
+сборки архива в памяти - в памяти только текущий кусок файла. Для каждого файла
+пишется локальный заголовок и данные, в конце - центральный каталог.
+
+В режиме deflated сжатый размер заранее неизвестен: CRC и размеры считаются по ходу
+чтения и пишутся в дескриптор после данных (бит 3). В режиме stored дескриптор не
+используется - потоковые распаковщики (java.util.zip.ZipInputStream) отвергают
+несжатые записи без размеров в локальном заголовке. Поэтому CRC файла считается
+отдельным проходом перед его заголовком, а размер архива известен заранее и ответ
+получает Content-Length. Zip64 не поддерживается: архив ограничен 4 ГБ.
+"""
+import struct
+import zlib
+from datetime import datetime
+from typing import AsyncIterator, List, Optional
+
+import aiofiles
+
+CHUNK_SIZE = 256 * 1024
+
+# Ограничения формата ZIP без расширения Zip64
+ZIP_MAX_SIZE = 0xFFFFFFFF
+ZIP_MAX_ENTRIES = 0xFFFF
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Бит 11: имена в UTF-8; бит 3: CRC и размеры - в дескрипторе после данных
+_FLAG_UTF8 = 0x0800
+_FLAG_DATA_DESCRIPTOR = 0x0008
+
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_DATA_DESCRIPTOR = struct.Struct("<IIII")
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END_OF_CENTRAL_DIR = struct.Struct("<IHHHHIIH")
+
+
+class ZipEntry:
+    """Файл, который войдет в архив"""
+
+    def __init__(self, path: str, arcname: str, size: int, modified: Optional[datetime] = None):
+        self.path = path
+        self.arcname = arcname
+        self.size = size
+        self.modified = modified or datetime.utcnow()
+        # Заполняются при записи
+        self.crc = 0
+        self.compressed_size = 0
+        self.offset = 0
+
+    @property
+    def name_bytes(self) -> bytes:
+        return self.arcname.encode("utf-8")
+
+    @property
+    def dos_datetime(self):
+        dt = max(self.modified, datetime(1980, 1, 1))
+        dos_time = (dt.hour << 11) | (dt.minute << 5) | (dt.second // 2)
+        dos_date = ((dt.year - 1980) << 9) | (dt.month << 5) | dt.day
+        return dos_time, dos_date
+
+
+class ZipStream:
+    """
+    Генератор ZIP-архива из файлов на диске
+
+    Args:
+        entries: Файлы архива
+        method: ZIP_STORED (без сжатия, известен размер) или ZIP_DEFLATED
+    """
+
+    def __init__(self, entries: List[ZipEntry], method: int = ZIP_STORED):
+        if len(entries) > ZIP_MAX_ENTRIES:
+            raise ValueError("Too many files for a ZIP archive")
+        self.entries = entries
+        self.method = method
+        self.flags = _FLAG_UTF8 if method == ZIP_STORED else _FLAG_UTF8 | _FLAG_DATA_DESCRIPTOR
+
+    def stored_size(self) -> int:
+        """Точный размер архива в режиме stored (для Content-Length)"""
+        total = 0
+        for entry in self.entries:
+            name_length = len(entry.name_bytes)
+            total += _LOCAL_HEADER.size + name_length + entry.size
+            total += _CENTRAL_HEADER.size + name_length
+        return total + _END_OF_CENTRAL_DIR.size
+
+    @staticmethod
+    async def _read(entry: ZipEntry) -> AsyncIterator[bytes]:
+        """Куски файла ровно на entry.size байт"""
+        async with aiofiles.open(entry.path, "rb") as f:
+            remaining = entry.size
+            while remaining > 0:
+                chunk = await f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError(f"File {entry.path} is shorter than expected")
+                remaining -= len(chunk)
+                yield chunk
+
+    async def _file_crc(self, entry: ZipEntry) -> int:
+        """CRC-32 файла - отдельный проход для локального заголовка stored-записи"""
+        crc = 0
+        async for chunk in self._read(entry):
+            crc = zlib.crc32(chunk, crc)
+        return crc
+
+    def check_size(self) -> None:
+        """Проверяет, что архив поместится в ZIP без Zip64"""
+        # Сжатые данные несжимаемого файла в худшем случае чуть больше исходных
+        worst_case = self.stored_size() + sum(entry.size for entry in self.entries) // 1000 + 1024 * len(self.entries)
+        if worst_case > ZIP_MAX_SIZE:
+            raise ValueError("Archive would exceed 4 GB")
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            dos_time, dos_date = entry.dos_datetime
+            if self.method == ZIP_STORED:
+                entry.crc = await self._file_crc(entry)
+                entry.compressed_size = entry.size
+                header_fields = (entry.crc, entry.size, entry.size)
+            else:
+                header_fields = (0, 0, 0)
+            header = _LOCAL_HEADER.pack(
+                0x04034B50, 20, self.flags, self.method, dos_time, dos_date,
+                *header_fields, len(entry.name_bytes), 0
+            ) + entry.name_bytes
+            yield header
+            offset += len(header)
+
+            crc = 0
+            compressed_size = 0
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15) if self.method == ZIP_DEFLATED else None
+            async for chunk in self._read(entry):
+                crc = zlib.crc32(chunk, crc)
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    compressed_size += len(chunk)
+                    yield chunk
+            offset += compressed_size
+
+            if compressor is None:
+                # Файл поменялся между проходами - заголовок уже не соответствует данным
+                if crc != entry.crc:
+                    raise IOError(f"File {entry.path} changed while archiving")
+                continue
+
+            tail = compressor.flush()
+            compressed_size += len(tail)
+            yield tail
+            entry.crc = crc
+            entry.compressed_size = compressed_size
+            descriptor = _DATA_DESCRIPTOR.pack(0x08074B50, crc, compressed_size, entry.size)
+            yield descriptor
+            offset += len(tail) + len(descriptor)
+
+        central_directory_offset = offset
+        central_directory_size = 0
+        for entry in self.entries:
+            dos_time, dos_date = entry.dos_datetime
+            record = _CENTRAL_HEADER.pack(
+                0x02014B50, 20, 20, self.flags, self.method, dos_time, dos_date,
+                entry.crc, entry.compressed_size, entry.size,
+                len(entry.name_bytes), 0, 0, 0, 0, 0, entry.offset
+            ) + entry.name_bytes
+            central_directory_size += len(record)
+            yield record
+
+        yield _END_OF_CENTRAL_DIR.pack(
+            0x06054B50, 0, 0, len(self.entries), len(self.entries),
+            central_directory_size, central_directory_offset, 0
+        )
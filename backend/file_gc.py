@@ -0,0 +1,402 @@
+"""
+Сборка мусора в каталоге загрузок
+
+Файлы на диске могут остаться без ссылок из БД: удаление документа не смогло
+удалить файл, процесс упал между записью файла и коммитом, заведение удалили
+напрямую в БД вместе со ссылками на документы. Сборщик сверяет UPLOAD_DIR с
+documents.file_path, document_history.file_path, establishments.logo_path и
+file_blobs.file_path и удаляет то, на что никто не ссылается.
+
+- Работает пачками: за один запуск просматривается не больше max_files файлов,
+  позиция обхода сохраняется в maintenance_state и следующий запуск продолжает с нее.
+- Файлы моложе grace-периода не трогаются: это могут быть идущие прямо сейчас
+  загрузки, которые еще не закоммитили запись в БД.
+- Перед удалением ссылки перепроверяются в пишущей транзакции, поэтому
+  параллельная загрузка того же файла не потеряет его.
+- Пути сравниваются после os.path.realpath относительно UPLOAD_DIR; файлы,
+  которые разрешаются за его пределы, не удаляются.
+- Записи file_blobs удаляются отдельным коммитом, файлы - после него.
+
+Запуск вручную: python file_gc.py [--max-files N] [--grace S] [--dry-run]
+"""
+import argparse
+import json
+import os
+import re
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Iterator, List, Optional, Set, Tuple
+
+from sqlalchemy import or_, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from database import CurrentDocument, Document, DocumentHistory, Establishment, FileBlob, Job, MaintenanceState, SessionLocal, init_db
+from storage import BlobStore, UPLOAD_DIR, UPLOAD_SESSIONS_DIR, remove_file
+from uploads import UploadSessionStore
+
+# Файлы моложе этого возраста не удаляются (секунды)
+GC_GRACE_SECONDS = int(os.getenv("GC_GRACE_SECONDS", "3600"))
+
+# Сколько файлов сверять с БД одним запросом
+GC_BATCH_SIZE = int(os.getenv("GC_BATCH_SIZE", "300"))
+
+# Сколько файлов просматривать за один запуск
+GC_MAX_FILES = int(os.getenv("GC_MAX_FILES", "20000"))
+
+CURSOR_KEY = "file_gc.cursor"
+
+# Временные файлы загрузок и миниатюр
+TEMP_SUFFIXES = (".part", ".tmp")
+THUMBNAIL_RE = re.compile(r"^(.*)\.thumb\d+\.jpg$")
+
+# Колонки БД со ссылками на файлы в UPLOAD_DIR
+REFERENCE_COLUMNS = (Document.file_path, DocumentHistory.file_path, Establishment.logo_path, FileBlob.file_path)
+
+
+def walk_files(root: str, cursor: Optional[List[str]] = None) -> Iterator[List[str]]:
+    """
+    Обходит дерево каталогов в отсортированном порядке, начиная после cursor
+
+    Возвращает пути как списки компонентов относительно root - их удобно
+    сравнивать с курсором, не заходя в уже просмотренные каталоги.
+    """
+    def walk(directory: str, prefix: List[str]) -> Iterator[List[str]]:
+        try:
+            entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+        except OSError:
+            return
+        for entry in entries:
+            parts = prefix + [entry.name]
+            if entry.is_dir(follow_symlinks=False):
+                # Каталог целиком до курсора - уже просмотрен
+                if cursor is not None and parts < cursor[:len(parts)]:
+                    continue
+                yield from walk(entry.path, parts)
+            elif entry.is_file(follow_symlinks=False):
+                if cursor is not None and parts <= cursor:
+                    continue
+                yield parts
+
+    yield from walk(root, [])
+
+
+def file_age(path: str) -> Optional[float]:
+    """Возраст файла в секундах (по последнему изменению или переименованию)"""
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    return time.time() - max(stat_result.st_mtime, stat_result.st_ctime)
+
+
+def upload_key(path: str) -> Optional[str]:
+    """
+    Путь файла относительно UPLOAD_DIR после разрешения ссылок, "." и ".."
+
+    По этому ключу сравниваются файлы на диске и пути из БД, как бы они ни были
+    записаны (относительные пути старых версий считаются от каталога backend).
+    None - путь ведет за пределы UPLOAD_DIR: такие файлы сборщик не трогает.
+    """
+    root = os.path.realpath(UPLOAD_DIR)
+    real = os.path.realpath(os.path.join(os.path.dirname(UPLOAD_DIR), path))
+    if not real.startswith(root + os.sep):
+        return None
+    return os.path.relpath(real, root)
+
+
+def referenced_keys(db: Session, paths: Set[str]) -> Set[str]:
+    """Какие из файлов упоминаются в БД (как ключи upload_key)"""
+    if not paths:
+        return set()
+    # Поиск по индексу: текущий код пишет пути как UPLOAD_DIR/..., но UPLOAD_DIR
+    # мог быть записан и через символическую ссылку
+    spellings = set(paths) | {os.path.realpath(path) for path in paths}
+    found = set()
+    for column in REFERENCE_COLUMNS:
+        found.update(row[0] for row in db.execute(select(column).where(column.in_(spellings))))
+    return {key for key in map(upload_key, found) if key is not None}
+
+
+def noncanonical_keys(db: Session) -> Set[str]:
+    """
+    Ссылки, записанные не в виде UPLOAD_DIR/... (относительные пути и т.п.)
+
+    Точное сравнение в referenced_keys их не находит, поэтому они читаются один
+    раз за запуск - запросом по диапазону вне префикса UPLOAD_DIR (по индексу).
+    """
+    prefix = os.path.join(UPLOAD_DIR, "")
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    keys = set()
+    for column in REFERENCE_COLUMNS:
+        rows = db.execute(select(column).where(or_(column < prefix, column >= upper)))
+        keys.update(key for key in (upload_key(row[0]) for row in rows) if key is not None)
+    return keys
+
+
+def owner_path(path: str) -> Optional[str]:
+    """Путь, ссылка на который удерживает файл; None для временных файлов"""
+    if path.endswith(TEMP_SUFFIXES):
+        return None
+    match = THUMBNAIL_RE.match(path)
+    return match.group(1) if match else path
+
+
+def _load_cursor(db: Session) -> Optional[List[str]]:
+    state = db.query(MaintenanceState).filter(MaintenanceState.name == CURSOR_KEY).first()
+    return json.loads(state.value) if state and state.value else None
+
+
+def _save_cursor(db: Session, cursor: Optional[List[str]]) -> None:
+    value = json.dumps(cursor) if cursor is not None else None
+    db.execute(
+        sqlite_insert(MaintenanceState)
+        .values(name=CURSOR_KEY, value=value, updated_at=datetime.utcnow())
+        .on_conflict_do_update(index_elements=["name"], set_={"value": value, "updated_at": datetime.utcnow()})
+    )
+
+
+def _sweep_batch(db: Session, batch: List[str], grace: int, dry_run: bool, report: dict, extra_keys: Set[str]) -> None:
+    """Удаляет файлы пачки, на которые нет ссылок в БД"""
+    # Файл, который разрешается за пределы UPLOAD_DIR (ссылка наружу), не трогаем
+    batch = [path for path in batch if upload_key(path) is not None]
+    owners = {path: owner_path(path) for path in batch}
+
+    def unreferenced(paths: List[str]) -> List[str]:
+        referenced = referenced_keys(db, {owners[path] for path in paths if owners[path]}) | extra_keys
+        return [path for path in paths if owners[path] is None or upload_key(owners[path]) not in referenced]
+
+    candidates = unreferenced(batch)
+    if not candidates or dry_run:
+        report["removed"] += len(candidates)
+        report["reclaimed_bytes"] += sum(os.path.getsize(path) for path in candidates if os.path.exists(path))
+        return
+
+    # Перепроверяем ссылки, уже держа блокировку записи (ее берет запись курсора):
+    # загрузка, начавшая писать в БД раньше нас, успела закоммитить ссылку
+    for path in unreferenced(candidates):
+        age = file_age(path)
+        if age is None or age < grace:
+            continue
+        size = os.path.getsize(path)
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"[gc] Error deleting file {path}: {e}")
+            continue
+        report["removed"] += 1
+        report["reclaimed_bytes"] += size
+
+
+def sweep_files(session_factory: Callable[[], Session], max_files: int, grace: int, dry_run: bool, report: dict) -> None:
+    """
+    Просматривает до max_files файлов с сохраненной позиции
+
+    Каждая пачка - отдельная короткая сессия: пока идет обход диска,
+    соединение писателя свободно для очереди задач и других фоновых записей.
+    """
+    with session_factory() as db:
+        cursor = _load_cursor(db)
+        extra_keys = noncanonical_keys(db)
+
+    def sweep(batch: List[str], cursor: Optional[List[str]]) -> None:
+        with session_factory() as db:
+            if not dry_run:
+                _save_cursor(db, cursor)
+            _sweep_batch(db, batch, grace, dry_run, report, extra_keys)
+            db.commit()
+
+    batch: List[str] = []
+    last_parts: Optional[List[str]] = None
+    finished = True
+
+    for parts in walk_files(UPLOAD_DIR, cursor):
+        if report["scanned"] >= max_files:
+            finished = False
+            break
+        report["scanned"] += 1
+        last_parts = parts
+        path = os.path.join(UPLOAD_DIR, *parts)
+        age = file_age(path)
+        if age is not None and age >= grace:
+            batch.append(path)
+        if len(batch) >= GC_BATCH_SIZE:
+            sweep(batch, last_parts)
+            batch = []
+
+    # Дошли до конца дерева - следующий запуск начнет сначала
+    sweep(batch, None if finished else last_parts)
+    report["finished"] = finished
+
+
+def orphans_query(model, after_id: int):
+    """
+    Следующая пачка документов (или версий) удаленных заведений
+
+    Проход по первичному ключу от after_id: уже просмотренные строки не читаются
+    повторно, на каждую строку - поиск заведения по первичному ключу.
+    """
+    return (
+        select(model)
+        .outerjoin(Establishment, model.establishment_id == Establishment.id)
+        .where(model.id > after_id, Establishment.id.is_(None))
+        .order_by(model.id)
+        .limit(GC_BATCH_SIZE)
+    )
+
+
+def sweep_orphan_documents(session_factory: Callable[[], Session], blob_store: BlobStore, dry_run: bool, report: dict) -> None:
+    """Удаляет документы удаленных заведений (и их старые версии) вместе с файлами"""
+    last_id = 0
+    while True:
+        with session_factory() as db:
+            documents = db.scalars(orphans_query(Document, last_id)).all()
+            if not documents:
+                break
+            last_id = documents[-1].id
+            report["orphan_documents"] += len(documents)
+            if dry_run:
+                break
+            document_ids = [document.id for document in documents]
+            db.query(Job).filter(Job.document_id.in_(document_ids)).delete(synchronize_session=False)
+            for document in documents:
+                blob_store.release(db, document.file_path)
+                db.delete(document)
+            db.commit()
+
+    last_id = 0
+    while True:
+        with session_factory() as db:
+            versions = db.scalars(orphans_query(DocumentHistory, last_id)).all()
+            if not versions:
+                break
+            last_id = versions[-1].id
+            report["orphan_documents"] += len(versions)
+            if dry_run:
+                return
+            for version in versions:
+                blob_store.release(db, version.file_path)
+                db.delete(version)
+            db.commit()
+
+    if not dry_run:
+        with session_factory() as db:
+            db.query(CurrentDocument).filter(
+                ~select(Establishment.id).where(Establishment.id == CurrentDocument.establishment_id).exists()
+            ).delete(synchronize_session=False)
+            db.commit()
+
+
+def sweep_stale_blobs(session_factory: Callable[[], Session], grace: int, dry_run: bool, report: dict) -> None:
+    """Удаляет записи хранилища, на которые не ссылается ни один документ"""
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+    last_sha = ""
+    while True:
+        with session_factory() as db:
+            blobs = (
+                db.query(FileBlob)
+                .filter(
+                    FileBlob.sha256 > last_sha,
+                    FileBlob.created_at < cutoff,
+                    ~select(Document.id).where(Document.file_path == FileBlob.file_path).exists(),
+                    ~select(DocumentHistory.id).where(DocumentHistory.file_path == FileBlob.file_path).exists()
+                )
+                .order_by(FileBlob.sha256)
+                .limit(GC_BATCH_SIZE)
+                .all()
+            )
+            if not blobs:
+                return
+            last_sha = blobs[-1].sha256
+            report["stale_blobs"] += len(blobs)
+            if dry_run:
+                continue
+            removed = [(blob.sha256, blob.file_path) for blob in blobs]
+            for blob in blobs:
+                db.delete(blob)
+            db.commit()
+            # Файлы - только после коммита: при откате записи остались бы без файлов
+            _remove_blob_files(db, removed, report)
+
+
+def _remove_blob_files(db: Session, removed: List[Tuple[str, str]], report: dict) -> None:
+    """
+    Удаляет файлы уже удаленных из file_blobs записей
+
+    Между коммитом и удалением put() того же содержимого мог создать запись
+    заново и рассчитывать на файл. Поэтому сначала берется блокировка записи
+    (пустой UPDATE), и под ней удаляются только файлы, записи которых так и не
+    появились: put(), пришедший позже, не найдет файла и перенесет свой.
+    """
+    hashes = [sha256 for sha256, _ in removed]
+    db.execute(update(FileBlob).where(FileBlob.sha256.in_(hashes)).values(ref_count=FileBlob.ref_count))
+    recreated = set(db.execute(select(FileBlob.sha256).where(FileBlob.sha256.in_(hashes))).scalars())
+    for sha256, file_path in removed:
+        if sha256 in recreated:
+            continue
+        if upload_key(file_path) is None:
+            print(f"[gc] Refusing to delete {file_path}: outside {UPLOAD_DIR}")
+            continue
+        # Миниатюры удаляются вместе с файлом
+        report["reclaimed_bytes"] += remove_file(file_path)
+    db.commit()
+
+
+def collect_garbage(
+    session_factory: Callable[[], Session] = SessionLocal,
+    blob_store: Optional[BlobStore] = None,
+    upload_sessions: Optional[UploadSessionStore] = None,
+    max_files: int = GC_MAX_FILES,
+    grace: int = GC_GRACE_SECONDS,
+    dry_run: bool = False
+) -> dict:
+    """
+    Один проход сборщика мусора
+
+    Returns:
+        Отчет: просмотрено файлов, удалено, освобождено байт, удалено документов
+        без заведения и записей хранилища без документов, дошел ли обход до конца
+    """
+    blob_store = blob_store or BlobStore(os.path.join(UPLOAD_DIR, "blobs"))
+    report = {
+        "scanned": 0,
+        "removed": 0,
+        "reclaimed_bytes": 0,
+        "orphan_documents": 0,
+        "stale_blobs": 0,
+        "expired_upload_sessions": 0,
+        "finished": False,
+        "dry_run": dry_run,
+    }
+
+    # Сначала БД: освобожденные здесь файлы не придется искать обходом.
+    # Сессии открываются на пачку, а не на весь проход (откат - при закрытии сессии)
+    sweep_orphan_documents(session_factory, blob_store, dry_run, report)
+    sweep_stale_blobs(session_factory, grace, dry_run, report)
+    sweep_files(session_factory, max_files, grace, dry_run, report)
+
+    if upload_sessions is not None and not dry_run:
+        report["expired_upload_sessions"] = upload_sessions.purge_expired()
+
+    print(
+        f"[gc] Scanned {report['scanned']} file(s), removed {report['removed']}, "
+        f"reclaimed {report['reclaimed_bytes']} bytes, orphan documents {report['orphan_documents']}, "
+        f"stale blobs {report['stale_blobs']}" + (" (dry run)" if dry_run else "")
+    )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Удаление файлов uploads/, на которые нет ссылок в БД")
+    parser.add_argument("--max-files", type=int, default=GC_MAX_FILES, help="Сколько файлов просмотреть за запуск")
+    parser.add_argument("--grace", type=int, default=GC_GRACE_SECONDS, help="Не трогать файлы моложе, секунд")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать, что будет удалено")
+    args = parser.parse_args()
+    init_db()
+    result = collect_garbage(
+        upload_sessions=UploadSessionStore(UPLOAD_SESSIONS_DIR),
+        max_files=args.max_files,
+        grace=args.grace,
+        dry_run=args.dry_run
+    )
+    print(json.dumps(result, ensure_ascii=False, indent=2))
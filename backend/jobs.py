@@ -0,0 +1,368 @@
+"""
+Очередь фоновых задач, хранящаяся в SQLite
+
+Тяжелая обработка после загрузки (миниатюры и т.п.) ставится в очередь в той же
+транзакции, что и запись Document, поэтому задача не теряется, даже если процесс
+упадет сразу после ответа клиенту. Задачи выполняют N асинхронных воркеров внутри
+процесса приложения.
+
+- Захват задачи атомарный (UPDATE ... WHERE status = 'queued'), поэтому очередь
+  можно обслуживать из нескольких процессов uvicorn одновременно.
+- Выполняющаяся задача держит аренду (locked_until) и продлевает ее, пока
+  работает обработчик. Если процесс упал, аренда истекает и задача снова
+  попадает в очередь.
+- Ошибки повторяются с экспоненциальной задержкой до max_attempts раз.
+- Периодические задачи (schedule) ставятся в очередь не чаще заданного
+  интервала, сколько бы процессов ни работало.
+"""
+import asyncio
+import json
+import os
+import random
+import traceback
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import and_, exists, insert, literal, or_, select, update
+from sqlalchemy.orm import Session
+
+from database import Job, SessionLocal
+
+# Количество воркеров очереди в процессе
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+
+# Пауза опроса очереди, когда задач нет (секунды)
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "2"))
+
+# Аренда выполняющейся задачи: после ее истечения задача считается брошенной.
+# Пока обработчик работает, аренда продлевается каждые JOB_LEASE_SECONDS / 3
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+
+# Как часто возвращать в очередь задачи с истекшей арендой (секунды)
+JOB_RECOVERY_INTERVAL = float(os.getenv("JOB_RECOVERY_INTERVAL", "60"))
+
+# Задержка повтора: JOB_RETRY_BASE * 2^(попытка-1), но не больше JOB_RETRY_MAX
+JOB_RETRY_BASE = float(os.getenv("JOB_RETRY_BASE", "5"))
+JOB_RETRY_MAX = float(os.getenv("JOB_RETRY_MAX", "600"))
+
+# Сколько дней хранить выполненные задачи
+JOB_RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", "7"))
+
+# Упавшие задачи хранятся дольше - по last_error разбирают причину
+JOB_FAILED_RETENTION_DAYS = int(os.getenv("JOB_FAILED_RETENTION_DAYS", "30"))
+
+JobHandler = Callable[[Job], Awaitable[None]]
+
+
+def job_to_dict(job: Job) -> dict:
+    """Состояние задачи для ответа API"""
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "document_id": job.document_id,
+        "status": job.status,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "run_after": job.run_after,
+        "last_error": job.last_error,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+    }
+
+
+class JobQueue:
+    """
+    Очередь задач с пулом воркеров
+
+    Args:
+        session_factory: Фабрика сессий БД для воркеров
+        workers: Количество одновременно выполняемых задач
+    """
+
+    def __init__(self, session_factory: Callable[[], Session] = SessionLocal, workers: int = JOB_WORKERS):
+        self.session_factory = session_factory
+        self.workers = workers
+        self.handlers: Dict[str, JobHandler] = {}
+        # Периодические задачи: тип -> интервал в секундах
+        self.periodic: Dict[str, float] = {}
+        # Уникальный идентификатор процесса - для логов
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+
+    def handler(self, kind: str) -> Callable[[JobHandler], JobHandler]:
+        """Декоратор регистрации обработчика задач указанного типа"""
+        def decorator(func: JobHandler) -> JobHandler:
+            self.handlers[kind] = func
+            return func
+        return decorator
+
+    def schedule(self, kind: str, interval: float) -> None:
+        """Запускать задачу указанного типа раз в interval секунд"""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        self.periodic[kind] = interval
+
+    def enqueue_periodic(self, kind: str, interval: float) -> bool:
+        """
+        Ставит периодическую задачу, если пора
+
+        Одна вставка INSERT ... SELECT ... WHERE NOT EXISTS: задача не появится,
+        если такая уже ждет, выполняется или завершилась (в том числе с ошибкой)
+        меньше interval назад.
+        Поэтому несколько процессов не поставят одну задачу дважды.
+        """
+        db = self.session_factory()
+        try:
+            now = datetime.utcnow()
+            recent = select(Job.id).where(
+                Job.kind == kind,
+                or_(
+                    Job.status.in_(["queued", "running"]),
+                    and_(Job.status.in_(["done", "failed"]), Job.finished_at > now - timedelta(seconds=interval))
+                )
+            )
+            result = db.execute(
+                insert(Job).from_select(
+                    ["kind", "status", "attempts", "max_attempts", "run_after", "created_at"],
+                    select(literal(kind), literal("queued"), literal(0), literal(1), literal(now), literal(now))
+                    .where(~exists(recent))
+                )
+            )
+            db.commit()
+            return result.rowcount == 1
+        finally:
+            db.close()
+
+    def enqueue(
+        self,
+        db: Session,
+        kind: str,
+        document_id: Optional[int] = None,
+        payload: Optional[dict] = None,
+        max_attempts: int = 5
+    ) -> Job:
+        """
+        Ставит задачу в очередь в текущей транзакции
+
+        Коммит делает вызывающий код; после коммита стоит вызвать wake(),
+        чтобы воркеры не ждали следующего опроса.
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job = Job(
+            kind=kind,
+            document_id=document_id,
+            payload=json.dumps(payload) if payload is not None else None,
+            status="queued",
+            max_attempts=max_attempts,
+            run_after=datetime.utcnow()
+        )
+        db.add(job)
+        return job
+
+    def wake(self) -> None:
+        """Будит воркеры, ожидающие новых задач"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    # ---- жизненный цикл ----
+
+    async def start(self) -> None:
+        """Восстанавливает брошенные задачи и запускает воркеры"""
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        recovered = await asyncio.to_thread(self._recover_expired)
+        if recovered:
+            print(f"[jobs] Re-queued {recovered} interrupted job(s)")
+        self._tasks = [asyncio.create_task(self._worker_loop(i)) for i in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._recovery_loop()))
+        if self.periodic:
+            self._tasks.append(asyncio.create_task(self._scheduler_loop()))
+        print(f"[jobs] Started {self.workers} worker(s) as {self.worker_id}")
+
+    async def stop(self) -> None:
+        """Останавливает воркеры; незавершенные задачи вернутся в очередь по аренде"""
+        self._stopping = True
+        self.wake()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # ---- работа воркера ----
+
+    async def _worker_loop(self, index: int) -> None:
+        while not self._stopping:
+            try:
+                job = await asyncio.to_thread(self._claim_next)
+            except Exception as e:
+                print(f"[jobs] Worker {index}: error claiming job: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._run(job)
+
+    async def _recovery_loop(self) -> None:
+        """Возвращает в очередь задачи упавших процессов - с постоянным интервалом, даже под нагрузкой"""
+        while not self._stopping:
+            await asyncio.sleep(JOB_RECOVERY_INTERVAL)
+            try:
+                recovered = await asyncio.to_thread(self._recover_expired)
+                if recovered:
+                    print(f"[jobs] Re-queued {recovered} job(s) with expired lease")
+                    self.wake()
+            except Exception as e:
+                print(f"[jobs] Error recovering jobs: {e}")
+
+    async def _scheduler_loop(self) -> None:
+        """Ставит периодические задачи, когда подходит их время"""
+        while not self._stopping:
+            for kind, interval in self.periodic.items():
+                try:
+                    if await asyncio.to_thread(self.enqueue_periodic, kind, interval):
+                        self.wake()
+                except Exception as e:
+                    print(f"[jobs] Error scheduling {kind}: {e}")
+            await asyncio.sleep(min(60.0, min(self.periodic.values())))
+
+    def _claim_next(self) -> Optional[Job]:
+        """Атомарно забирает следующую готовую задачу"""
+        db = self.session_factory()
+        try:
+            now = datetime.utcnow()
+            candidates = db.query(Job.id).filter(
+                Job.status == "queued",
+                Job.run_after <= now
+            ).order_by(Job.run_after, Job.id).limit(5).all()
+
+            for (job_id,) in candidates:
+                result = db.execute(
+                    update(Job)
+                    .where(Job.id == job_id, Job.status == "queued")
+                    .values(
+                        status="running",
+                        attempts=Job.attempts + 1,
+                        locked_until=now + timedelta(seconds=JOB_LEASE_SECONDS)
+                    )
+                )
+                db.commit()
+                if result.rowcount == 1:
+                    job = db.query(Job).filter(Job.id == job_id).first()
+                    db.expunge(job)
+                    return job
+            return None
+        finally:
+            db.close()
+
+    async def _run(self, job: Job) -> None:
+        handler = self.handlers.get(job.kind)
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            if handler is None:
+                raise RuntimeError(f"No handler registered for job kind '{job.kind}'")
+            await handler(job)
+        except Exception as e:
+            print(f"[jobs] Job {job.id} ({job.kind}) failed on attempt {job.attempts}: {e}")
+            await asyncio.to_thread(self._mark_failed, job, traceback.format_exc())
+        else:
+            await asyncio.to_thread(self._mark_done, job)
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, job: Job) -> None:
+        """Продлевает аренду, пока выполняется обработчик (долгие GC и очистки дольше аренды)"""
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                if not await asyncio.to_thread(self._extend_lease, job):
+                    print(f"[jobs] Job {job.id} ({job.kind}) lost its lease")
+                    return
+            except Exception as e:
+                print(f"[jobs] Error extending lease of job {job.id}: {e}")
+
+    def _extend_lease(self, job: Job) -> bool:
+        """Сдвигает locked_until, если задача все еще за этим запуском (attempts не менялся)"""
+        db = self.session_factory()
+        try:
+            result = db.execute(
+                update(Job)
+                .where(Job.id == job.id, Job.status == "running", Job.attempts == job.attempts)
+                .values(locked_until=datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS))
+            )
+            db.commit()
+            return result.rowcount == 1
+        finally:
+            db.close()
+
+    def _mark_done(self, job: Job) -> None:
+        db = self.session_factory()
+        try:
+            db.execute(
+                update(Job)
+                .where(Job.id == job.id)
+                .values(status="done", locked_until=None, last_error=None, finished_at=datetime.utcnow())
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def _mark_failed(self, job: Job, error: str) -> None:
+        """Планирует повтор с экспоненциальной задержкой или помечает задачу проваленной"""
+        db = self.session_factory()
+        try:
+            values = {"locked_until": None, "last_error": error[-4000:]}
+            if job.attempts >= job.max_attempts:
+                values.update(status="failed", finished_at=datetime.utcnow())
+            else:
+                delay = min(JOB_RETRY_BASE * 2 ** (job.attempts - 1), JOB_RETRY_MAX)
+                # Случайный разброс, чтобы повторы не шли пачкой
+                delay *= random.uniform(0.8, 1.2)
+                values.update(status="queued", run_after=datetime.utcnow() + timedelta(seconds=delay))
+            db.execute(update(Job).where(Job.id == job.id).values(**values))
+            db.commit()
+        finally:
+            db.close()
+
+    def _recover_expired(self) -> int:
+        """Возвращает в очередь задачи с истекшей арендой и чистит старые завершенные"""
+        db = self.session_factory()
+        try:
+            now = datetime.utcnow()
+            # Задача, которая раз за разом роняет процесс, не должна крутиться вечно
+            db.execute(
+                update(Job)
+                .where(Job.status == "running", Job.locked_until < now, Job.attempts >= Job.max_attempts)
+                .values(status="failed", locked_until=None, finished_at=now, last_error="Lease expired")
+            )
+            result = db.execute(
+                update(Job)
+                .where(Job.status == "running", Job.locked_until < now)
+                .values(status="queued", locked_until=None, run_after=now)
+            )
+            db.query(Job).filter(or_(
+                and_(Job.status == "done", Job.finished_at < now - timedelta(days=JOB_RETENTION_DAYS)),
+                and_(Job.status == "failed", Job.finished_at < now - timedelta(days=JOB_FAILED_RETENTION_DAYS))
+            )).delete(synchronize_session=False)
+            db.commit()
+            return result.rowcount
+        finally:
+            db.close()
+
+
+def jobs_for_document(db: Session, document_id: int) -> List[Job]:
+    """Задачи, относящиеся к документу (новые первыми)"""
+    return db.query(Job).filter(Job.document_id == document_id).order_by(Job.id.desc()).all()
+
+
+# Очередь приложения
+job_queue = JobQueue()
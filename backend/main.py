@@ -1,29 +1,62 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Depends, Request
+from fastapi import FastAPI, HTTPException, Form, Depends, Request, Response, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.exceptions import RequestValidationError
 from typing import Optional, List
 import os
+import asyncio
 import shutil
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import uuid
 import random
+import json
 from pydantic import BaseModel
 from enum import Enum
 from sqlalchemy.orm import Session
-from sqlalchemy import or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
 from dotenv import load_dotenv
-from database import get_db, Establishment, Document, PasswordResetToken, init_db
+from database import get_read_db, run_after_commit, SessionLocal, get_async_read_db, async_engine, async_read_engine, Establishment, Document, PasswordResetToken, Job, init_db
 from schemas import (
     EstablishmentCreate, EstablishmentResponse, EstablishmentUpdate, DocumentResponse, 
     EstablishmentRegistrationResponse, ForgotPasswordRequest, ForgotPasswordResponse,
-    ResetPasswordRequest, ResetPasswordResponse
+    ResetPasswordRequest, ResetPasswordResponse, UploadSessionCreate, UploadSessionResponse,
+    RefreshTokenRequest, TokenResponse
+)
+from auth_utils import hash_rounds, needs_rehash
+from password_pool import PasswordPoolBusy, password_pool
+from auth import ACCESS_TOKEN_EXPIRE_MINUTES, TokenClaims, create_access_token, credentials_exception, get_current_establishment_async, get_current_principal
+from principal_cache import principal_cache
+from storage import BlobStore, remove_file, sharded_path, UPLOAD_DIR, UPLOAD_SESSIONS_DIR
+from downloads import file_download_response
+import thumbnails
+from jobs import job_queue, job_to_dict, jobs_for_document
+from exports import ZipEntry, ZipStream, ZIP_STORED, ZIP_DEFLATED
+from file_gc import collect_garbage
+from document_expiry import apply_expiry, run_expiry_check
+from reset_tokens import issue_reset_token, mark_used, purge_reset_tokens
+from refresh_tokens import issue_refresh_token, purge_auth_tokens, revoke_establishment_sessions, revoke_family, rotate_refresh_token
+from token_revocation import revocation_list
+from rate_limit import (
+    FORGOT_PASSWORD_RATE_LIMIT, LOGIN_RATE_LIMIT, REGISTRATION_UPLOAD_RATE_LIMIT, RESET_PASSWORD_RATE_LIMIT,
+    UPLOAD_CHUNK_RATE_LIMIT, UPLOAD_RATE_LIMIT,
+    client_address, limit_per_establishment, limit_per_ip, rate_limiter
+)
+from write_queue import write_queue
+from migrations import run_backfills
+from document_listing import list_documents_page, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from queries import (
+    blob_by_path_query, document_query, establishment_by_email_query, establishment_exists_query,
+    export_documents_query, history_version_query, login_query, required_documents_query, reset_token_query
+)
+import document_versions
+from document_versions import DEFAULT_HISTORY_PAGE_SIZE, MAX_HISTORY_PAGE_SIZE
+from document_stats import aggregate_queries, counters_query, counters_need_rebuild, rebuild_document_counters, stats_from_counts
+from uploads import (
+    StreamingUpload, UploadSessionStore, ALLOWED_DOCUMENT_EXTENSIONS, MAX_DOCUMENT_SIZE,
+    ALLOWED_LOGO_EXTENSIONS, ALLOWED_LOGO_TYPES, MAX_LOGO_SIZE
 )
-from auth_utils import hash_password, verify_password
-from auth import create_access_token, get_current_establishment
-from slowapi import Limiter
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
@@ -59,17 +92,11 @@ def document_to_response(doc: Document) -> DocumentResponse:
 
 app = FastAPI(title="E-Bar Document Management System")
 
-# Инициализация rate limiter
-limiter = Limiter(key_func=get_remote_address)
-app.state.limiter = limiter
-
-# Кастомный обработчик для RateLimitExceeded
-@app.exception_handler(RateLimitExceeded)
-async def rate_limit_handler(request: Request, exc: RateLimitExceeded):
-    return JSONResponse(
-        status_code=429,
-        content={"detail": "Слишком много попыток входа. Попробуйте через минуту"}
-    )
+# Лимиты частоты запросов (rate_limit.py): общее для всех воркеров хранилище
+upload_rate_limit = limit_per_establishment("upload", UPLOAD_RATE_LIMIT, "Слишком много загрузок. Попробуйте позже")
+upload_chunk_rate_limit = limit_per_establishment("upload-chunk", UPLOAD_CHUNK_RATE_LIMIT, "Слишком много запросов загрузки. Попробуйте позже")
+registration_upload_rate_limit = limit_per_ip("registration-upload", REGISTRATION_UPLOAD_RATE_LIMIT, "Слишком много загрузок. Попробуйте позже")
+reset_password_rate_limit = limit_per_ip("reset-password", RESET_PASSWORD_RATE_LIMIT, "Слишком много попыток сброса пароля. Попробуйте позже")
 
 # Обработчик ошибок валидации
 @app.exception_handler(RequestValidationError)
@@ -104,17 +131,25 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Курсор следующей страницы списков документов
+    expose_headers=["X-Next-Cursor", "Link"],
 )
 
 # Создаем папку для хранения документов
-UPLOAD_DIR = os.path.join(os.path.dirname(__file__), "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(os.path.join(UPLOAD_DIR, "logos"), exist_ok=True)
 print(f"Upload directory: {UPLOAD_DIR}")
 
-# Монтируем статические файлы для доступа к загруженным файлам
+# Контентно-адресуемое хранилище файлов документов (с дедупликацией)
+blob_store = BlobStore(os.path.join(UPLOAD_DIR, "blobs"))
+
+# Сессии возобновляемой загрузки
+upload_sessions = UploadSessionStore(UPLOAD_SESSIONS_DIR)
+
+# Монтируем статические файлы для доступа к логотипам
+# (документы отдаются только через /api/documents/{doc_id}/download с проверкой прав)
 from fastapi.staticfiles import StaticFiles
-app.mount("/api/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+app.mount("/api/uploads/logos", StaticFiles(directory=os.path.join(UPLOAD_DIR, "logos")), name="uploads")
 
 class DocumentStatus(str, Enum):
     PENDING = "pending"
@@ -147,26 +182,303 @@ class DocumentType(str, Enum):
     BANK_DETAILS = "bank_details"
     FNS_CERTIFICATE = "fns_certificate"
 
+# Группы документов по типу
+DOCUMENT_GROUPS = {
+    'ogrn_inn': 'founding', 'charter': 'founding', 'registration_certificate': 'founding',
+    'egryul_extract': 'founding', 'authorized_capital': 'founding', 'okved': 'founding',
+    'passport_power_of_attorney': 'founding', 'general_director_appointment': 'founding',
+    'company_card': 'founding',
+    'alcohol_license': 'licenses', 'lease_ownership': 'licenses', 'egais': 'licenses',
+    'mchs_conclusion': 'additional', 'rospotrebnadzor_conclusion': 'additional',
+    'kkt_registration': 'financial', 'bank_details': 'financial', 'fns_certificate': 'financial'
+}
+
+# Названия документов по типу
+DOCUMENT_NAMES = {
+    'ogrn_inn': 'ОГРН/ИНН',
+    'charter': 'Устав',
+    'registration_certificate': 'Свидетельство о регистрации',
+    'egryul_extract': 'Выписка ЕГРЮЛ',
+    'authorized_capital': 'Уставной капитал',
+    'okved': 'ОКВЭД',
+    'passport_power_of_attorney': 'Паспорт/Доверенность',
+    'general_director_appointment': 'Приказ о назначении Ген. Директора',
+    'company_card': 'Карточка предприятия',
+    'alcohol_license': 'Лицензия на алкоголь',
+    'lease_ownership': 'Договор аренды/собственности',
+    'egais': 'ЕГАИС',
+    'mchs_conclusion': 'МЧС',
+    'rospotrebnadzor_conclusion': 'Роспотребнадзор',
+    'kkt_registration': 'ККТ',
+    'bank_details': 'Банковские реквизиты',
+    'fns_certificate': 'Справка из ФНС'
+}
+
+def add_document_record(
+    db: Session,
+    establishment_id: int,
+    document_type: str,
+    temp_path: str,
+    sha256: str,
+    size: int,
+    file_name: str,
+    document_group: Optional[str] = None,
+    document_name: Optional[str] = None,
+    required: bool = False
+) -> Document:
+    """
+    Кладет принятый файл в хранилище и добавляет для него запись Document в текущую транзакцию
+    
+    Группа и название по умолчанию определяются по типу документа.
+    Предыдущая версия документа этого типа уходит в историю (document_versions),
+    новая наследует ее признак обязательности.
+    Фоновые задачи обработки файла ставятся в очередь в той же транзакции.
+    """
+    file_path = blob_store.put(db, temp_path, sha256, size, os.path.splitext(file_name)[1])
+    db_document = Document(
+        establishment_id=establishment_id,
+        document_group=document_group or DOCUMENT_GROUPS.get(document_type, 'additional'),
+        document_type=document_type,
+        document_name=document_name or DOCUMENT_NAMES.get(document_type, document_type),
+        file_path=file_path,
+        file_name=file_name,
+        required=required,
+        uploaded=True,
+        uploaded_at=datetime.utcnow()
+    )
+    db.add(db_document)
+    db.flush()
+    previous = document_versions.replace_current(db, db_document)
+    if previous is not None and previous.required:
+        db_document.required = True
+    
+    # Тяжелая обработка - фоновыми задачами; они коммитятся вместе с документом
+    if thumbnails.supports_thumbnails(file_path):
+        job_queue.enqueue(db, "thumbnails", document_id=db_document.id, payload={"file_path": file_path})
+    return db_document
+
+async def save_document_record(*args, **kwargs) -> Document:
+    """
+    Сохраняет один документ (см. add_document_record) через очередь групповых коммитов
+    
+    Документы от одновременных запросов попадают в одну транзакцию.
+    """
+    db_document = await write_queue.submit(lambda db: add_document_record(db, *args, **kwargs))
+    job_queue.wake()
+    return db_document
+
 # Хранилище документов теперь в БД (documents_storage удалено)
 # DocumentResponse импортируется из schemas.py
 
+@job_queue.handler("thumbnails")
+async def thumbnails_job(job: Job):
+    """Фоновая задача: миниатюры загруженного изображения"""
+    file_path = json.loads(job.payload)["file_path"]
+    # Документ могли удалить раньше, чем дошла очередь
+    if os.path.exists(file_path):
+        await thumbnails.generate_thumbnails(file_path)
+
+# Период сборки мусора в каталоге загрузок (часы)
+FILE_GC_INTERVAL_HOURS = float(os.getenv("FILE_GC_INTERVAL_HOURS", "6"))
+
+@job_queue.handler("file_gc")
+async def file_gc_job(job: Job):
+    """Периодическая задача: удаление файлов без ссылок из БД"""
+    await asyncio.to_thread(collect_garbage, blob_store=blob_store, upload_sessions=upload_sessions)
+
+if FILE_GC_INTERVAL_HOURS > 0:
+    job_queue.schedule("file_gc", FILE_GC_INTERVAL_HOURS * 3600)
+
+# Период удаления версий документов старше срока хранения (часы)
+DOCUMENT_HISTORY_PRUNE_INTERVAL_HOURS = float(os.getenv("DOCUMENT_HISTORY_PRUNE_INTERVAL_HOURS", "24"))
+
+@job_queue.handler("document_history_prune")
+async def document_history_prune_job(job: Job):
+    """Периодическая задача: удаление старых версий документов и ссылок на их файлы"""
+    await asyncio.to_thread(document_versions.prune_history, blob_store)
+
+if DOCUMENT_HISTORY_PRUNE_INTERVAL_HOURS > 0:
+    job_queue.schedule("document_history_prune", DOCUMENT_HISTORY_PRUNE_INTERVAL_HOURS * 3600)
+
+# Период проверки сроков действия документов (минуты)
+DOCUMENT_EXPIRY_INTERVAL_MINUTES = float(os.getenv("DOCUMENT_EXPIRY_INTERVAL_MINUTES", "60"))
+
+@job_queue.handler("document_expiry")
+async def document_expiry_job(job: Job):
+    """Периодическая задача: статусы документов с истекающим и истекшим сроком"""
+    await asyncio.to_thread(run_expiry_check)
+
+if DOCUMENT_EXPIRY_INTERVAL_MINUTES > 0:
+    job_queue.schedule("document_expiry", DOCUMENT_EXPIRY_INTERVAL_MINUTES * 60)
+
+# Период очистки истекших и использованных токенов восстановления пароля (минуты)
+RESET_TOKEN_PURGE_INTERVAL_MINUTES = float(os.getenv("RESET_TOKEN_PURGE_INTERVAL_MINUTES", "30"))
+
+@job_queue.handler("reset_token_purge")
+async def reset_token_purge_job(job: Job):
+    """Периодическая задача: удаление истекших и использованных токенов сброса пароля"""
+    await asyncio.to_thread(purge_reset_tokens)
+
+if RESET_TOKEN_PURGE_INTERVAL_MINUTES > 0:
+    job_queue.schedule("reset_token_purge", RESET_TOKEN_PURGE_INTERVAL_MINUTES * 60)
+
+# Период очистки истекших refresh-токенов и записей списка отзыва (минуты)
+AUTH_TOKEN_PURGE_INTERVAL_MINUTES = float(os.getenv("AUTH_TOKEN_PURGE_INTERVAL_MINUTES", "60"))
+
+@job_queue.handler("auth_token_purge")
+async def auth_token_purge_job(job: Job):
+    """Периодическая задача: удаление истекших refresh-токенов и отзывов"""
+    await asyncio.to_thread(purge_auth_tokens)
+
+if AUTH_TOKEN_PURGE_INTERVAL_MINUTES > 0:
+    job_queue.schedule("auth_token_purge", AUTH_TOKEN_PURGE_INTERVAL_MINUTES * 60)
+
+@job_queue.handler("rate_limit_purge")
+async def rate_limit_purge_job(job: Job):
+    """Периодическая задача: удаление давно не используемых корзин лимитов"""
+    await asyncio.to_thread(rate_limiter.purge)
+
+job_queue.schedule("rate_limit_purge", 3600)
+
+# Доводить ли незавершенные backfill миграций при старте сервера
+RUN_BACKFILLS_ON_STARTUP = os.getenv("RUN_BACKFILLS_ON_STARTUP", "1") == "1"
+
+async def run_migration_backfills():
+    try:
+        await asyncio.to_thread(run_backfills)
+    except Exception as e:
+        print(f"[migrations] Backfill failed, will resume on next start: {e}")
+
+def init_document_counters():
+    """Заполняет счетчики документов, если таблица счетчиков появилась после документов"""
+    db = SessionLocal()
+    try:
+        if counters_need_rebuild(db):
+            rows = rebuild_document_counters(db)
+            print(f"Document counters rebuilt: {rows} row(s)")
+    finally:
+        db.close()
+
+@app.on_event("startup")
+async def start_workers():
+    """Запускаем воркеры очереди фоновых задач"""
+    await asyncio.to_thread(init_document_counters)
+    await password_pool.calibrate()
+    await revocation_list.start()
+    await job_queue.start()
+    if RUN_BACKFILLS_ON_STARTUP:
+        # Перенос данных идет короткими транзакциями параллельно с обработкой запросов
+        asyncio.create_task(run_migration_backfills())
+
+@app.on_event("shutdown")
+async def shutdown_workers():
+    """Останавливаем фоновые воркеры и пулы при остановке сервера"""
+    await job_queue.stop()
+    await revocation_list.stop()
+    await write_queue.stop()
+    thumbnails.shutdown()
+    password_pool.shutdown()
+    await async_engine.dispose()
+    await async_read_engine.dispose()
+
 @app.get("/")
 async def root():
     return {"message": "E-Bar Document Management System API", "version": "1.0"}
 
-@app.post("/api/documents/upload")
+@app.get("/api/metrics/write-queue")
+async def get_write_queue_metrics():
+    """Метрики группового коммита: размеры пачек и время транзакций"""
+    return write_queue.stats()
+
+@app.get("/api/metrics/principal-cache")
+async def get_principal_cache_metrics():
+    """Метрики кеша пользователей: попадания, промахи, вытеснения"""
+    return principal_cache.stats()
+
+@app.get("/api/metrics/token-revocation")
+async def get_token_revocation_metrics():
+    """Метрики списка отзыва: размер фильтра, перестроения, срабатывания"""
+    return revocation_list.stats()
+
+@app.get("/api/metrics/rate-limit")
+async def get_rate_limit_metrics():
+    """Метрики ограничения частоты: проверки, отказы, ошибки хранилища"""
+    return rate_limiter.stats()
+
+@app.get("/api/metrics/password-hashing")
+async def get_password_hashing_metrics():
+    """Метрики пула bcrypt: очередь, отказы, время ожидания и хеширования"""
+    return password_pool.stats()
+
+# Схема multipart-тела для OpenAPI: тело разбирается потоково, без File()/Form()
+DOCUMENT_UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file", "document_type", "establishment_id"],
+                    "properties": {
+                        "file": {"type": "string", "format": "binary"},
+                        "document_type": {"type": "string"},
+                        "establishment_id": {"type": "integer"},
+                    },
+                }
+            }
+        },
+    }
+}
+
+LOGO_UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file"],
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                }
+            }
+        },
+    }
+}
+
+@app.post("/api/documents/upload", openapi_extra=DOCUMENT_UPLOAD_OPENAPI, dependencies=[Depends(upload_rate_limit)])
 async def upload_document(
-    file: UploadFile = File(...),
-    document_type: str = Form(...),
-    establishment_id: int = Form(...),
-    current_establishment: Establishment = Depends(get_current_establishment),
-    db: Session = Depends(get_db)
+    request: Request,
+    current_establishment: TokenClaims = Depends(get_current_principal)
 ):
-    """Загрузка документа"""
+    """Загрузка документа (файл пишется на диск потоково, без чтения в память целиком)"""
+    upload = StreamingUpload(
+        request,
+        UPLOAD_DIR,
+        allowed_extensions=ALLOWED_DOCUMENT_EXTENSIONS,
+        max_file_size=MAX_DOCUMENT_SIZE
+    )
     try:
+        # Размер и расширение проверяются прямо во время приема тела
+        await upload.receive()
+        
+        file = upload.files.get("file")
+        document_type = upload.fields.get("document_type")
+        establishment_id_raw = upload.fields.get("establishment_id")
+        
+        # Проверяем наличие файла
+        if file is None:
+            raise HTTPException(status_code=400, detail="No file provided")
+        if not document_type or establishment_id_raw is None:
+            raise HTTPException(status_code=422, detail="document_type and establishment_id are required")
+        try:
+            establishment_id = int(establishment_id_raw)
+        except ValueError:
+            raise HTTPException(status_code=422, detail="establishment_id must be an integer")
+        
         print("=" * 50)
         print("DOCUMENT UPLOAD REQUEST:")
         print(f"Filename: {file.filename}")
+        print(f"Size: {file.size} bytes")
         print(f"Document type: {document_type}")
         print(f"Establishment ID: {establishment_id}")
         print("=" * 50)
@@ -175,94 +487,23 @@ async def upload_document(
         if current_establishment.id != establishment_id:
             raise HTTPException(status_code=403, detail="Forbidden: You can only upload documents for your own establishment")
         
-        # Проверяем существование заведения
-        establishment = db.query(Establishment).filter(Establishment.id == establishment_id).first()
-        if not establishment:
-            print(f"ERROR: Establishment with ID {establishment_id} not found in database")
-            raise HTTPException(status_code=404, detail=f"Establishment with ID {establishment_id} not found")
-        
-        print(f"Establishment found: {establishment.business_name}")
-        
-        # Проверяем наличие файла
-        if not file.filename:
-            raise HTTPException(status_code=400, detail="No file provided")
-        
-        # Валидация файла
-        allowed_extensions = ['.pdf', '.jpg', '.jpeg', '.png', '.doc', '.docx']
-        file_ext = os.path.splitext(file.filename)[1].lower()
-        if file_ext not in allowed_extensions:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"File type not allowed. Allowed types: {', '.join(allowed_extensions)}"
-            )
-        
-        # Определяем группу документа по типу
-        document_groups = {
-            'ogrn_inn': 'founding', 'charter': 'founding', 'registration_certificate': 'founding',
-            'egryul_extract': 'founding', 'authorized_capital': 'founding', 'okved': 'founding',
-            'passport_power_of_attorney': 'founding', 'general_director_appointment': 'founding',
-            'company_card': 'founding',
-            'alcohol_license': 'licenses', 'lease_ownership': 'licenses', 'egais': 'licenses',
-            'mchs_conclusion': 'additional', 'rospotrebnadzor_conclusion': 'additional',
-            'kkt_registration': 'financial', 'bank_details': 'financial', 'fns_certificate': 'financial'
-        }
-        document_group = document_groups.get(document_type, 'additional')
-        
-        # Маппинг названий документов
-        document_names = {
-            'ogrn_inn': 'ОГРН/ИНН',
-            'charter': 'Устав',
-            'registration_certificate': 'Свидетельство о регистрации',
-            'egryul_extract': 'Выписка ЕГРЮЛ',
-            'authorized_capital': 'Уставной капитал',
-            'okved': 'ОКВЭД',
-            'passport_power_of_attorney': 'Паспорт/Доверенность',
-            'general_director_appointment': 'Приказ о назначении Ген. Директора',
-            'company_card': 'Карточка предприятия',
-            'alcohol_license': 'Лицензия на алкоголь',
-            'lease_ownership': 'Договор аренды/собственности',
-            'egais': 'ЕГАИС',
-            'mchs_conclusion': 'МЧС',
-            'rospotrebnadzor_conclusion': 'Роспотребнадзор',
-            'kkt_registration': 'ККТ',
-            'bank_details': 'Банковские реквизиты',
-            'fns_certificate': 'Справка из ФНС'
-        }
-        document_name = document_names.get(document_type, document_type)
-        
-        # Сохраняем файл
-        doc_id = str(uuid.uuid4())
-        safe_filename = "".join(c for c in file.filename if c.isalnum() or c in "._- ")
-        file_path = os.path.join(UPLOAD_DIR, f"{doc_id}_{safe_filename}")
+        # Заведение проверено по токену, БД для этого не нужна
+        print(f"Establishment authorized: {current_establishment.id}")
         
-        print(f"Saving file to: {file_path}")
+        # Файл уже на диске и его хеш посчитан - переносим в хранилище и создаем запись в БД
+        print(f"Storing file with SHA-256: {file.sha256}")
         
         try:
-            contents = await file.read()
-            with open(file_path, "wb") as buffer:
-                buffer.write(contents)
-            print(f"File saved successfully: {file_path}")
+            db_document = await save_document_record(
+                establishment_id, document_type, file.temp_path, file.sha256, file.size, file.filename
+            )
+            print(f"File saved successfully: {db_document.file_path}")
         except Exception as file_error:
             import traceback
             print(f"Error saving file: {str(file_error)}")
             print(traceback.format_exc())
             raise HTTPException(status_code=500, detail=f"Error saving file: {str(file_error)}")
         
-        # Создаем запись в БД
-        db_document = Document(
-            establishment_id=establishment_id,
-            document_group=document_group,
-            document_type=document_type,
-            document_name=document_name,
-            file_path=file_path,
-            file_name=file.filename,
-            uploaded=True,
-            uploaded_at=datetime.utcnow()
-        )
-        db.add(db_document)
-        db.commit()
-        db.refresh(db_document)
-        
         print(f"Document stored in DB: {db_document.id}")
         print("=" * 50)
         
@@ -281,109 +522,359 @@ async def upload_document(
         print(traceback.format_exc())
         print("=" * 50)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    finally:
+        # Удаляем временные файлы, если запрос не дошел до сохранения
+        await upload.cleanup()
+
+# ============ RESUMABLE UPLOAD ENDPOINTS ============
+
+def session_to_response(session: dict) -> UploadSessionResponse:
+    """Преобразует сессию загрузки в ответ API"""
+    return UploadSessionResponse(
+        upload_id=session["upload_id"],
+        establishment_id=session["establishment_id"],
+        document_type=session["document_type"],
+        file_name=session["file_name"],
+        file_size=session["file_size"],
+        offset=session["offset"],
+        complete=session["offset"] == session["file_size"],
+        expires_at=datetime.fromisoformat(session["expires_at"])
+    )
+
+def get_own_upload_session(upload_id: str, current_establishment: Establishment) -> dict:
+    """Находит сессию загрузки и проверяет, что она принадлежит текущему пользователю"""
+    session = upload_sessions.get(upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload session not found or expired")
+    if session["establishment_id"] != current_establishment.id:
+        raise HTTPException(status_code=403, detail="Forbidden: You can only access your own upload sessions")
+    return session
+
+@app.post("/api/documents/uploads", response_model=UploadSessionResponse, dependencies=[Depends(upload_rate_limit)])
+async def create_upload_session(
+    session_data: UploadSessionCreate,
+    current_establishment: TokenClaims = Depends(get_current_principal)
+):
+    """Создать сессию возобновляемой загрузки документа"""
+    if current_establishment.id != session_data.establishment_id:
+        raise HTTPException(status_code=403, detail="Forbidden: You can only upload documents for your own establishment")
+    
+    file_ext = os.path.splitext(session_data.file_name)[1].lower()
+    if file_ext not in ALLOWED_DOCUMENT_EXTENSIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"File type not allowed. Allowed types: {', '.join(ALLOWED_DOCUMENT_EXTENSIONS)}"
+        )
+    if session_data.file_size <= 0:
+        raise HTTPException(status_code=400, detail="file_size must be positive")
+    if session_data.file_size > MAX_DOCUMENT_SIZE:
+        raise HTTPException(status_code=413, detail=f"File size exceeds {MAX_DOCUMENT_SIZE // (1024 * 1024)}MB limit")
+    
+    session = upload_sessions.create(
+        session_data.establishment_id,
+        session_data.document_type,
+        session_data.file_name,
+        session_data.file_size
+    )
+    print(f"Upload session created: {session['upload_id']} ({session['file_size']} bytes)")
+    return session_to_response(session)
+
+@app.get("/api/documents/uploads/{upload_id}", response_model=UploadSessionResponse)
+async def get_upload_session(
+    upload_id: str,
+    current_establishment: TokenClaims = Depends(get_current_principal)
+):
+    """Статус сессии загрузки - сколько байт уже принято"""
+    return session_to_response(get_own_upload_session(upload_id, current_establishment))
+
+@app.patch("/api/documents/uploads/{upload_id}", response_model=UploadSessionResponse, dependencies=[Depends(upload_chunk_rate_limit)])
+async def upload_session_chunk(
+    upload_id: str,
+    request: Request,
+    current_establishment: TokenClaims = Depends(get_current_principal)
+):
+    """
+    Дописать кусок файла в сессию
+    
+    Тело запроса - сырые байты куска, заголовок Upload-Offset - смещение,
+    с которого он начинается (должно совпадать с текущим offset сессии).
+    Пока в сессию пишет другой запрос (в любом воркере), ответ - 409.
+    """
+    upload_offset = request.headers.get("upload-offset")
+    if upload_offset is None or not upload_offset.isdigit():
+        raise HTTPException(status_code=400, detail="Upload-Offset header is required")
+    
+    # Блокировку берем только для существующей сессии
+    get_own_upload_session(upload_id, current_establishment)
+    async with upload_sessions.lock(upload_id):
+        session = get_own_upload_session(upload_id, current_establishment)
+        session["offset"] = await upload_sessions.append(session, int(upload_offset), request)
+    
+    return session_to_response(session)
+
+@app.post("/api/documents/uploads/{upload_id}/finalize")
+async def finalize_upload_session(
+    upload_id: str,
+    current_establishment: TokenClaims = Depends(get_current_principal)
+):
+    """Завершить загрузку: перенести файл в хранилище и создать документ"""
+    # Блокировку берем только для существующей сессии
+    get_own_upload_session(upload_id, current_establishment)
+    async with upload_sessions.lock(upload_id):
+        session = get_own_upload_session(upload_id, current_establishment)
+        if session["offset"] != session["file_size"]:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Upload incomplete: {session['offset']} of {session['file_size']} bytes received",
+                headers={"Upload-Offset": str(session["offset"])}
+            )
+        
+        sha256 = await upload_sessions.sha256(upload_id)
+        db_document = await save_document_record(
+            session["establishment_id"],
+            session["document_type"],
+            upload_sessions.data_path(upload_id),
+            sha256,
+            session["file_size"],
+            session["file_name"]
+        )
+        upload_sessions.delete(upload_id)
+    
+    print(f"Upload session {upload_id} finalized as document {db_document.id}")
+    return document_to_response(db_document)
+
+@app.delete("/api/documents/uploads/{upload_id}")
+async def cancel_upload_session(
+    upload_id: str,
+    current_establishment: TokenClaims = Depends(get_current_principal)
+):
+    """Отменить сессию загрузки и удалить принятые байты"""
+    # Блокировку берем только для существующей сессии
+    get_own_upload_session(upload_id, current_establishment)
+    async with upload_sessions.lock(upload_id):
+        get_own_upload_session(upload_id, current_establishment)
+        upload_sessions.delete(upload_id)
+    return {"message": "Upload session cancelled"}
+
+def set_next_cursor_headers(request: Request, response: Response, next_cursor: Optional[str]):
+    """Курсор следующей страницы в заголовках X-Next-Cursor и Link"""
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
 
 @app.get("/api/documents")
-async def get_documents(establishment_id: int = None, db: Session = Depends(get_db)):
-    """Получить все документы для заведения"""
+async def get_documents(
+    request: Request,
+    response: Response,
+    establishment_id: int = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    document_group: Optional[str] = None,
+    verification_status: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """
+    Получить документы заведения (постранично)
+    
+    Следующая страница - с параметром cursor=next_cursor из ответа.
+    fields - список полей через запятую, например fields=id,document_type,status
+    """
+    if establishment_id is None:
+        raise HTTPException(status_code=400, detail="establishment_id is required")
+    documents, next_cursor = await list_documents_page(
+        db, establishment_id, limit, cursor, document_group, verification_status, fields
+    )
+    set_next_cursor_headers(request, response, next_cursor)
+    return {"documents": documents, "next_cursor": next_cursor}
+
+@app.get("/api/documents/stats")
+async def get_statistics(
+    establishment_id: int = None,
+    exact: bool = False,
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """
+    Статистика по документам для заведения
+    
+    По умолчанию читается из счетчиков document_counters (несколько строк по ключу);
+    exact=true пересчитывает ее агрегатами GROUP BY по таблице documents.
+    """
     if establishment_id is None:
         raise HTTPException(status_code=400, detail="establishment_id is required")
-    documents = db.query(Document).filter(Document.establishment_id == establishment_id).all()
-    return {"documents": [document_to_response(doc) for doc in documents]}
+    if exact:
+        rows = []
+        for query in aggregate_queries(establishment_id):
+            rows.extend(row[1:] for row in await db.execute(query))
+    else:
+        rows = (await db.execute(counters_query(establishment_id))).all()
+    return stats_from_counts(rows)
 
 @app.get("/api/documents/{doc_id}")
-async def get_document(doc_id: int, db: Session = Depends(get_db)):
+def get_document(doc_id: int, db: Session = Depends(get_read_db)):
     """Получить конкретный документ"""
-    document = db.query(Document).filter(Document.id == doc_id).first()
+    document = db.scalars(document_query(doc_id)).first()
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
     return document_to_response(document)
 
-@app.post("/api/documents/{doc_id}/verify")
-async def verify_document(doc_id: int, status: DocumentStatus = Form(...), db: Session = Depends(get_db)):
-    """Верификация документа (ручная или через API)"""
-    document = db.query(Document).filter(Document.id == doc_id).first()
+@app.api_route("/api/documents/{doc_id}/download", methods=["GET", "HEAD"])
+def download_document(
+    doc_id: int,
+    request: Request,
+    current_establishment: TokenClaims = Depends(get_current_principal),
+    db: Session = Depends(get_read_db)
+):
+    """Скачать файл документа (поддерживает ETag, 304 и Range для просмотрщиков PDF)"""
+    document = db.scalars(document_query(doc_id)).first()
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
     
-    document.status = status.value
-    db.commit()
-    db.refresh(document)
+    # Проверяем права доступа - пользователь может скачивать только свои документы
+    if current_establishment.id != document.establishment_id:
+        raise HTTPException(status_code=403, detail="Forbidden: You can only download your own documents")
+    
+    if not document.file_path or not os.path.exists(document.file_path):
+        raise HTTPException(status_code=404, detail="File not found")
     
+    # Для файлов хранилища хеш содержимого - готовый сильный ETag
+    blob = db.scalars(blob_by_path_query(document.file_path)).first()
+    return file_download_response(
+        request,
+        document.file_path,
+        document.file_name or os.path.basename(document.file_path),
+        UPLOAD_DIR,
+        content_hash=blob.sha256 if blob else None
+    )
+
+@app.get("/api/documents/{doc_id}/thumbnail")
+async def get_document_thumbnail(
+    doc_id: int,
+    request: Request,
+    size: int = 256,
+    current_establishment: TokenClaims = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """Миниатюра изображения документа (ближайший фиксированный размер не меньше size)"""
+    document = await db.get(Document, doc_id)
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    if current_establishment.id != document.establishment_id:
+        raise HTTPException(status_code=403, detail="Forbidden: You can only access your own documents")
+    
+    if not thumbnails.supports_thumbnails(document.file_path):
+        raise HTTPException(status_code=404, detail="Thumbnails are only available for images")
+    if not os.path.exists(document.file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    thumb_size = thumbnails.pick_size(size)
+    try:
+        # Если фоновая генерация еще не успела - строим миниатюру сейчас
+        thumb_path = await thumbnails.get_thumbnail(document.file_path, thumb_size)
+    except Exception as e:
+        print(f"Error generating thumbnail for document {doc_id}: {e}")
+        raise HTTPException(status_code=422, detail="Could not generate thumbnail for this file")
+    
+    return file_download_response(request, thumb_path, f"thumb{thumb_size}.jpg", UPLOAD_DIR)
+
+@app.get("/api/documents/{doc_id}/jobs")
+def get_document_jobs(
+    doc_id: int,
+    current_establishment: TokenClaims = Depends(get_current_principal),
+    db: Session = Depends(get_read_db)
+):
+    """Статус фоновой обработки документа"""
+    document = db.scalars(document_query(doc_id)).first()
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    if current_establishment.id != document.establishment_id:
+        raise HTTPException(status_code=403, detail="Forbidden: You can only access your own documents")
+    
+    return {"jobs": [job_to_dict(job) for job in jobs_for_document(db, doc_id)]}
+
+@app.post("/api/documents/{doc_id}/verify")
+async def verify_document(doc_id: int, status: DocumentStatus = Form(...)):
+    """Верификация документа (ручная или через API)"""
+    def set_status(db: Session) -> Document:
+        document = db.scalars(document_query(doc_id)).first()
+        if not document:
+            raise HTTPException(status_code=404, detail="Document not found")
+        document.status = status.value
+        db.flush()
+        return document
+    
+    document = await write_queue.submit(set_status)
     return document_to_response(document)
 
 @app.put("/api/documents/{doc_id}/status")
 async def update_document_status(
     doc_id: int,
     verification_status: Optional[str] = Form(None),
-    expiry_date: Optional[str] = Form(None),
-    db: Session = Depends(get_db)
+    expiry_date: Optional[str] = Form(None)
 ):
     """Обновить статус верификации документа и дату окончания"""
-    document = db.query(Document).filter(Document.id == doc_id).first()
-    if not document:
-        raise HTTPException(status_code=404, detail="Document not found")
-    
-    if verification_status:
-        document.verification_status = verification_status
-    
+    parsed_expiry_date = None
     if expiry_date:
         try:
-            document.expiry_date = datetime.fromisoformat(expiry_date.replace('Z', '+00:00'))
+            parsed_expiry_date = datetime.fromisoformat(expiry_date.replace('Z', '+00:00'))
         except:
-            document.expiry_date = datetime.fromisoformat(expiry_date)
+            parsed_expiry_date = datetime.fromisoformat(expiry_date)
+        # В БД даты хранятся в UTC без часового пояса
+        if parsed_expiry_date.tzinfo is not None:
+            parsed_expiry_date = parsed_expiry_date.astimezone(timezone.utc).replace(tzinfo=None)
     
-    db.commit()
-    db.refresh(document)
+    def set_status(db: Session) -> Document:
+        document = db.scalars(document_query(doc_id)).first()
+        if not document:
+            raise HTTPException(status_code=404, detail="Document not found")
+        if verification_status:
+            document.verification_status = verification_status
+        if parsed_expiry_date:
+            document.expiry_date = parsed_expiry_date
+            # Фоновая проверка смотрит только вперед от прошлого запуска -
+            # дату задним числом или внутри окна предупреждения учитываем сразу
+            if not verification_status:
+                apply_expiry(document)
+        db.flush()
+        return document
     
+    document = await write_queue.submit(set_status)
     return document_to_response(document)
 
+def remove_document_record(db: Session, document: Document) -> None:
+    """Удаляет документ вместе со ссылкой на его файл (коммит делает вызывающий код)"""
+    # Убираем ссылку на файл (файл без ссылок удалит сборщик мусора)
+    blob_store.release(db, document.file_path)
+    document_versions.forget_current(db, document)
+    db.delete(document)
+
 @app.delete("/api/documents/{doc_id}")
 async def delete_document(
     doc_id: int,
-    current_establishment: Establishment = Depends(get_current_establishment),
-    db: Session = Depends(get_db)
+    current_establishment: TokenClaims = Depends(get_current_principal)
 ):
     """Удалить документ"""
-    document = db.query(Document).filter(Document.id == doc_id).first()
-    if not document:
-        raise HTTPException(status_code=404, detail="Document not found")
-    
-    # Проверяем права доступа - пользователь может удалять только свои документы
-    if current_establishment.id != document.establishment_id:
-        raise HTTPException(status_code=403, detail="Forbidden: You can only delete your own documents")
-    
-    # Удаляем файл
-    if document.file_path and os.path.exists(document.file_path):
-        os.remove(document.file_path)
+    def delete(db: Session) -> None:
+        document = db.scalars(document_query(doc_id)).first()
+        if not document:
+            raise HTTPException(status_code=404, detail="Document not found")
+        
+        # Проверяем права доступа - пользователь может удалять только свои документы
+        if current_establishment.id != document.establishment_id:
+            raise HTTPException(status_code=403, detail="Forbidden: You can only delete your own documents")
+        
+        remove_document_record(db, document)
     
-    # Удаляем из БД
-    db.delete(document)
-    db.commit()
+    await write_queue.submit(delete)
     
     return {"message": "Document deleted successfully"}
 
-@app.get("/api/documents/stats")
-async def get_statistics(establishment_id: int = None, db: Session = Depends(get_db)):
-    """Статистика по документам для заведения"""
-    if establishment_id is None:
-        raise HTTPException(status_code=400, detail="establishment_id is required")
-    documents = db.query(Document).filter(Document.establishment_id == establishment_id).all()
-    total = len(documents)
-    pending = sum(1 for doc in documents if doc.status == "pending")
-    verified = sum(1 for doc in documents if doc.status == "verified")
-    rejected = sum(1 for doc in documents if doc.status == "rejected")
-    
-    return {
-        "total": total,
-        "pending": pending,
-        "verified": verified,
-        "rejected": rejected
-    }
-
 # ============ REGISTRATION ENDPOINTS ============
 
 @app.post("/api/establishments", response_model=EstablishmentRegistrationResponse)
-async def create_establishment(establishment: EstablishmentCreate, db: Session = Depends(get_db)):
+async def create_establishment(establishment: EstablishmentCreate, db: AsyncSession = Depends(get_async_read_db)):
     """Создание нового заведения (регистрация пользователя) с автоматическим логином"""
     try:
         print("=" * 50)
@@ -396,10 +887,9 @@ async def create_establishment(establishment: EstablishmentCreate, db: Session =
         print("=" * 50)
         
         # Проверяем, не существует ли уже пользователь с таким email или username
-        existing = db.query(Establishment).filter(
-            (Establishment.email == establishment.email) | 
-            (Establishment.username == establishment.username)
-        ).first()
+        existing = (await db.execute(
+            establishment_exists_query(establishment.email, establishment.username)
+        )).first()
         if existing:
             raise HTTPException(status_code=400, detail="User with this email or username already exists")
         
@@ -422,7 +912,7 @@ async def create_establishment(establishment: EstablishmentCreate, db: Session =
         
         # Хешируем пароль перед сохранением
         if 'password' in establishment_dict:
-            establishment_dict['password'] = hash_password(establishment_dict['password'])
+            establishment_dict['password'] = await password_pool.hash(establishment_dict['password'])
             print("Password hashed successfully")
         
         try:
@@ -433,22 +923,33 @@ async def create_establishment(establishment: EstablishmentCreate, db: Session =
             import traceback
             print(traceback.format_exc())
             raise
-        db.add(db_establishment)
-        db.commit()
-        db.refresh(db_establishment)
+        
+        # Заведение и refresh-токен для автоматического логина - одной записью через очередь
+        def save_establishment(session: Session):
+            session.add(db_establishment)
+            session.flush()
+            token, row = issue_refresh_token(session, db_establishment.id)
+            return token, row.family_id
+        
+        try:
+            refresh_token, family_id = await write_queue.submit(save_establishment)
+        except IntegrityError:
+            # Такой же логин или email успели зарегистрировать между проверкой и записью
+            raise HTTPException(status_code=400, detail="User with this email or username already exists")
         
         print(f"Establishment created successfully with ID: {db_establishment.id}")
         
-        # Создаем JWT токен для автоматического логина
-        access_token = create_access_token(db_establishment.id)
+        access_token = create_access_token(db_establishment, family_id)
         print(f"Access token created for establishment {db_establishment.id}")
         print("=" * 50)
         
-        # Возвращаем заведение и токен
+        # Возвращаем заведение и токены
         return EstablishmentRegistrationResponse(
             establishment=EstablishmentResponse.model_validate(db_establishment, from_attributes=True),
             access_token=access_token,
-            token_type="bearer"
+            refresh_token=refresh_token,
+            token_type="bearer",
+            expires_in=ACCESS_TOKEN_EXPIRE_MINUTES * 60
         )
     except HTTPException:
         raise
@@ -465,8 +966,7 @@ async def create_establishment(establishment: EstablishmentCreate, db: Session =
 @app.get("/api/establishments/{establishment_id}", response_model=EstablishmentResponse)
 async def get_establishment(
     establishment_id: int,
-    current_establishment: Establishment = Depends(get_current_establishment),
-    db: Session = Depends(get_db)
+    current_establishment: Establishment = Depends(get_current_establishment_async)
 ):
     """Получить заведение по ID (требует авторизации)"""
     # Проверяем что пользователь запрашивает свои данные
@@ -476,70 +976,80 @@ async def get_establishment(
             detail="You can only access your own establishment data"
         )
     
-    establishment = db.query(Establishment).filter(Establishment.id == establishment_id).first()
-    if not establishment:
-        raise HTTPException(status_code=404, detail="Establishment not found")
-    return establishment
+    # Строка уже загружена при проверке токена
+    return current_establishment
 
-@app.post("/api/establishments/{establishment_id}/logo")
+@app.post("/api/establishments/{establishment_id}/logo", openapi_extra=LOGO_UPLOAD_OPENAPI,
+          dependencies=[Depends(upload_rate_limit)])
 async def upload_logo(
     establishment_id: int,
-    file: UploadFile = File(...),
-    current_establishment: Establishment = Depends(get_current_establishment),
-    db: Session = Depends(get_db)
+    request: Request,
+    current_establishment: TokenClaims = Depends(get_current_principal)
 ):
-    """Загрузить логотип компании"""
+    """Загрузить логотип компании (файл пишется на диск потоково, как и документы)"""
     # Проверяем права доступа - пользователь может загружать логотип только для себя
     if current_establishment.id != establishment_id:
         raise HTTPException(status_code=403, detail="Forbidden: You can only upload logo for your own establishment")
     
-    # Проверяем существование заведения
-    establishment = db.query(Establishment).filter(Establishment.id == establishment_id).first()
-    if not establishment:
-        raise HTTPException(status_code=404, detail="Establishment not found")
-    
-    # Проверяем тип файла (только изображения)
-    allowed_types = ["image/jpeg", "image/jpg", "image/png", "image/gif", "image/webp"]
-    if file.content_type not in allowed_types:
-        raise HTTPException(status_code=400, detail="Only image files are allowed (JPEG, PNG, GIF, WebP)")
-    
-    # Проверяем размер файла (макс 5MB)
-    file_content = await file.read()
-    if len(file_content) > 5 * 1024 * 1024:
-        raise HTTPException(status_code=400, detail="File size exceeds 5MB limit")
-    
-    # Удаляем старый логотип, если есть
-    if establishment.logo_path and os.path.exists(establishment.logo_path):
-        try:
-            os.remove(establishment.logo_path)
-        except Exception as e:
-            print(f"Error deleting old logo: {e}")
-    
-    # Сохраняем новый логотип
-    file_extension = os.path.splitext(file.filename)[1]
-    logo_filename = f"logo_{establishment_id}_{int(datetime.utcnow().timestamp())}{file_extension}"
-    logo_path = os.path.join(UPLOAD_DIR, "logos", logo_filename)
-    os.makedirs(os.path.dirname(logo_path), exist_ok=True)
-    
+    logos_dir = os.path.join(UPLOAD_DIR, "logos")
+    os.makedirs(logos_dir, exist_ok=True)
+    # Размер (макс 5MB) и расширение проверяются прямо во время приема тела
+    upload = StreamingUpload(
+        request,
+        logos_dir,
+        allowed_extensions=ALLOWED_LOGO_EXTENSIONS,
+        max_file_size=MAX_LOGO_SIZE
+    )
+    logo_path = None
     try:
-        with open(logo_path, "wb") as f:
-            f.write(file_content)
+        await upload.receive()
+        
+        file = upload.files.get("file")
+        if file is None:
+            raise HTTPException(status_code=400, detail="No file provided")
+        # Проверяем тип файла (только изображения)
+        if file.content_type not in ALLOWED_LOGO_TYPES:
+            raise HTTPException(status_code=400, detail="Only image files are allowed (JPEG, PNG, GIF, WebP)")
+        
+        # Сохраняем новый логотип: временный файл уже на той же ФС - достаточно переименовать
+        file_extension = os.path.splitext(file.filename)[1]
+        logo_filename = f"logo_{establishment_id}_{int(datetime.utcnow().timestamp())}{file_extension}"
+        logo_path = sharded_path(logos_dir, logo_filename)
+        os.makedirs(os.path.dirname(logo_path), exist_ok=True)
+        os.replace(file.temp_path, logo_path)
+        
+        def save_logo_path(session: Session):
+            establishment = session.get(Establishment, establishment_id)
+            if not establishment:
+                raise HTTPException(status_code=404, detail="Establishment not found")
+            old_logo_path = establishment.logo_path
+            establishment.logo_path = logo_path
+            # Старый логотип удаляем, только когда новый путь уже закоммичен
+            if old_logo_path and old_logo_path != logo_path:
+                run_after_commit(session, lambda: remove_file(old_logo_path))
         
         # Обновляем путь к логотипу в БД
-        establishment.logo_path = logo_path
-        db.commit()
-        db.refresh(establishment)
+        await write_queue.submit(save_logo_path)
+        principal_cache.invalidate(establishment_id)
         
         return {"logo_path": logo_path, "message": "Logo uploaded successfully"}
+    except HTTPException:
+        if logo_path:
+            remove_file(logo_path)
+        raise
     except Exception as e:
+        if logo_path:
+            remove_file(logo_path)
         raise HTTPException(status_code=500, detail=f"Error saving logo: {str(e)}")
+    finally:
+        # Удаляем временный файл, если до переноса не дошло
+        await upload.cleanup()
 
 @app.put("/api/establishments/{establishment_id}", response_model=EstablishmentResponse)
 async def update_establishment(
     establishment_id: int, 
     update_data: EstablishmentUpdate,
-    current_establishment: Establishment = Depends(get_current_establishment),
-    db: Session = Depends(get_db)
+    current_establishment: TokenClaims = Depends(get_current_principal)
 ):
     """Обновить данные заведения"""
     try:
@@ -547,19 +1057,22 @@ async def update_establishment(
         if current_establishment.id != establishment_id:
             raise HTTPException(status_code=403, detail="Forbidden: You can only update your own establishment data")
         
-        establishment = db.query(Establishment).filter(Establishment.id == establishment_id).first()
-        if not establishment:
-            raise HTTPException(status_code=404, detail="Establishment not found")
-        
         # Обновляем только переданные поля
         update_dict = update_data.model_dump(exclude_unset=True)
-        for field, value in update_dict.items():
-            if value is not None:
-                setattr(establishment, field, value)
         
-        establishment.updated_at = datetime.now()
-        db.commit()
-        db.refresh(establishment)
+        def save(session: Session) -> Establishment:
+            establishment = session.get(Establishment, establishment_id)
+            if not establishment:
+                raise HTTPException(status_code=404, detail="Establishment not found")
+            for field, value in update_dict.items():
+                if value is not None:
+                    setattr(establishment, field, value)
+            establishment.updated_at = datetime.now()
+            session.flush()
+            return establishment
+        
+        establishment = await write_queue.submit(save)
+        principal_cache.invalidate(establishment_id)
         
         return establishment
     except HTTPException:
@@ -571,18 +1084,53 @@ async def update_establishment(
         print(f"Error: {str(e)}")
         print(traceback.format_exc())
         print("=" * 50)
-        db.rollback()
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+# Фоновые пересчеты хешей паролей (ссылки держим, чтобы задачи не собрал GC)
+_rehash_tasks = set()
+
+async def rehash_password(establishment_id: int, password: str, old_hash: str):
+    """
+    Пересчитывает хеш пароля с текущей стоимостью bcrypt (после успешного входа)
+    
+    Хеш заменяется, только если пароль не поменяли за это время.
+    """
+    try:
+        new_hash = await password_pool.hash(password)
+    except PasswordPoolBusy:
+        # Пул занят входами - пересчитаем при следующем входе
+        return
+    
+    def save(db: Session) -> int:
+        return db.execute(
+            update(Establishment)
+            .where(Establishment.id == establishment_id, Establishment.password == old_hash)
+            .values(password=new_hash)
+        ).rowcount
+    
+    try:
+        if await write_queue.submit(save):
+            principal_cache.invalidate(establishment_id)
+            print(f"Password rehashed for establishment_id {establishment_id}: "
+                  f"{hash_rounds(old_hash)} -> {hash_rounds(new_hash)} rounds")
+    except Exception as e:
+        print(f"Error rehashing password for establishment_id {establishment_id}: {e}")
+
 @app.post("/api/auth/login")
-@limiter.limit("5/minute")
 async def login(
     request: Request,
     username: str = Form(...), 
     password: str = Form(...), 
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     """Авторизация пользователя по логину или email и паролю"""
+    # Лимит попыток с одного IP - до проверки пароля
+    await rate_limiter.check(
+        f"login:ip:{client_address(request)}",
+        LOGIN_RATE_LIMIT,
+        detail="Слишком много попыток входа. Попробуйте через минуту"
+    )
+    
     try:
         print("=" * 50)
         print("LOGIN REQUEST:")
@@ -590,33 +1138,41 @@ async def login(
         print("=" * 50)
         
         # Ищем пользователя по username или email
-        establishment = db.query(Establishment).filter(
-            or_(
-                Establishment.username == username,
-                Establishment.email == username
-            )
-        ).first()
+        result = await db.execute(login_query(username))
+        establishment = result.scalars().first()
         
         if not establishment:
             print(f"User not found: {username}")
             raise HTTPException(status_code=401, detail="Неверный логин или пароль")
         
-        # Проверяем пароль используя verify_password
-        if not verify_password(password, establishment.password):
+        # Проверяем пароль (bcrypt - в пуле потоков, event loop не блокируется)
+        if not await password_pool.verify(password, establishment.password):
             print(f"Invalid password for user: {username}")
             raise HTTPException(status_code=401, detail="Неверный логин или пароль")
         
         print(f"Login successful for user: {username}, establishment_id: {establishment.id}")
+        if needs_rehash(establishment.password):
+            # Ответ не ждет пересчета хеша
+            task = asyncio.create_task(rehash_password(establishment.id, password, establishment.password))
+            _rehash_tasks.add(task)
+            task.add_done_callback(_rehash_tasks.discard)
         print("=" * 50)
         
-        # Создаем JWT токен
-        access_token = create_access_token(establishment.id)
+        # Создаем пару токенов (refresh-токен пишется через очередь записи - сессия здесь только для чтения)
+        def save_refresh_token(session: Session):
+            token, row = issue_refresh_token(session, establishment.id)
+            return token, row.family_id
+        
+        refresh_token, family_id = await write_queue.submit(save_refresh_token)
+        access_token = create_access_token(establishment, family_id)
         
-        # Возвращаем данные заведения и токен
+        # Возвращаем данные заведения и токены
         return {
             "establishment": EstablishmentResponse.model_validate(establishment),
             "access_token": access_token,
-            "token_type": "bearer"
+            "refresh_token": refresh_token,
+            "token_type": "bearer",
+            "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60
         }
     except HTTPException:
         raise
@@ -630,45 +1186,77 @@ async def login(
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
+@app.post("/api/auth/refresh", response_model=TokenResponse)
+async def refresh_tokens(request_data: RefreshTokenRequest):
+    """Новая пара токенов по refresh-токену (старый refresh-токен перестает действовать)"""
+    def rotate(session: Session):
+        refresh_token, refresh_row = rotate_refresh_token(session, request_data.refresh_token)
+        # Статус и тип бизнеса в новом токене - актуальные
+        establishment = session.get(Establishment, refresh_row.establishment_id) if refresh_token else None
+        return refresh_token, refresh_row.family_id, establishment
+    
+    refresh_token, family_id, establishment = await write_queue.submit(rotate)
+    # Повторное предъявление (отзыв цепочки уже закоммичен) или заведение удалено
+    if refresh_token is None or establishment is None:
+        raise credentials_exception()
+    
+    return TokenResponse(
+        access_token=create_access_token(establishment, family_id),
+        refresh_token=refresh_token,
+        token_type="bearer",
+        expires_in=ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    )
+
+
+@app.post("/api/auth/logout")
+async def logout(current_establishment: TokenClaims = Depends(get_current_principal)):
+    """Выход: отзывает текущий access-токен и цепочку refresh-токенов этого входа"""
+    def revoke(session: Session) -> None:
+        if current_establishment.session_id:
+            revoke_family(session, current_establishment.session_id)
+        if current_establishment.jti:
+            revocation_list.revoke(session, current_establishment.jti, current_establishment.expires_at)
+    
+    await write_queue.submit(revoke)
+    print(f"Logout for establishment_id: {current_establishment.id}")
+    return {"message": "Logged out"}
+
+
 @app.post("/api/auth/forgot-password", response_model=ForgotPasswordResponse)
 async def forgot_password(
     request_data: ForgotPasswordRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     """Запрос на восстановление пароля - генерирует токен и выводит в консоль"""
+    # Лимит на адрес (т.е. на заведение) - вне try: ошибки ниже скрываются от клиента
+    await rate_limiter.check(
+        f"forgot-password:email:{request_data.email.lower()}",
+        FORGOT_PASSWORD_RATE_LIMIT,
+        detail="Слишком много запросов на восстановление пароля. Попробуйте позже"
+    )
     try:
         # Ищем пользователя по email
-        establishment = db.query(Establishment).filter(
-            Establishment.email == request_data.email
-        ).first()
+        establishment = (await db.execute(
+            establishment_by_email_query(request_data.email)
+        )).scalars().first()
         
         if not establishment:
             # Для безопасности не сообщаем, что email не найден
             # Просто возвращаем успешный ответ
             return ForgotPasswordResponse(message="Password reset token sent")
         
-        # Генерируем случайный токен из 6 цифр
-        import random
-        token = ''.join([str(random.randint(0, 9)) for _ in range(6)])
-        
-        # Проверяем уникальность токена (на случай коллизии)
-        while db.query(PasswordResetToken).filter(PasswordResetToken.token == token).first():
-            token = ''.join([str(random.randint(0, 9)) for _ in range(6)])
-        
-        # Создаем токен с временем жизни 1 час
-        from datetime import timedelta
-        expires_at = datetime.utcnow() + timedelta(hours=1)
-        
-        reset_token = PasswordResetToken(
-            token=token,
-            establishment_id=establishment.id,
-            expires_at=expires_at,
-            used=False
-        )
-        
-        db.add(reset_token)
-        db.commit()
-        db.refresh(reset_token)
+        # Токен из 6 цифр с временем жизни 1 час (уникальность - см. reset_tokens.py)
+        try:
+            reset_token = await write_queue.submit(lambda session: issue_reset_token(session, establishment.id))
+        except RuntimeError as e:
+            # Код не выдан - клиент не должен ждать письма, которого не будет
+            print(f"[reset-tokens] Token not issued: {e}")
+            raise HTTPException(
+                status_code=503,
+                detail="Не удалось создать код восстановления. Попробуйте позже"
+            )
+        token = reset_token.token
+        expires_at = reset_token.expires_at
         
         # ВЫВОДИМ ТОКЕН В КОНСОЛЬ (для тестирования, потом заменим на отправку email)
         print("=" * 50)
@@ -680,6 +1268,8 @@ async def forgot_password(
         
         return ForgotPasswordResponse(message="Password reset token sent")
         
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         print("=" * 50)
@@ -687,15 +1277,14 @@ async def forgot_password(
         print(f"Error: {str(e)}")
         print(traceback.format_exc())
         print("=" * 50)
-        db.rollback()
-        # Для безопасности возвращаем успешный ответ даже при ошибке
-        return ForgotPasswordResponse(message="Password reset token sent")
+        # Токен не создан: ответ "отправлен" ввел бы пользователя в заблуждение
+        raise HTTPException(status_code=500, detail="Internal server error")
 
 
-@app.post("/api/auth/reset-password", response_model=ResetPasswordResponse)
+@app.post("/api/auth/reset-password", response_model=ResetPasswordResponse, dependencies=[Depends(reset_password_rate_limit)])
 async def reset_password(
     request_data: ResetPasswordRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     """Сброс пароля по токену"""
     try:
@@ -707,9 +1296,9 @@ async def reset_password(
             )
         
         # Ищем токен
-        reset_token = db.query(PasswordResetToken).filter(
-            PasswordResetToken.token == request_data.token
-        ).first()
+        reset_token = (await db.execute(
+            reset_token_query(request_data.token)
+        )).scalars().first()
         
         if not reset_token:
             raise HTTPException(
@@ -732,9 +1321,7 @@ async def reset_password(
             )
         
         # Находим пользователя
-        establishment = db.query(Establishment).filter(
-            Establishment.id == reset_token.establishment_id
-        ).first()
+        establishment = await db.get(Establishment, reset_token.establishment_id)
         
         if not establishment:
             raise HTTPException(
@@ -743,16 +1330,29 @@ async def reset_password(
             )
         
         # Хешируем новый пароль
-        hashed_password = hash_password(request_data.new_password)
+        hashed_password = await password_pool.hash(request_data.new_password)
         
-        # Обновляем пароль
-        establishment.password = hashed_password
-        establishment.updated_at = datetime.utcnow()
-        
-        # Помечаем токен как использованный
-        reset_token.used = True
+        def save(session: Session) -> None:
+            # Перечитываем токен в пишущей транзакции: два сброса одним кодом не пройдут оба
+            token_row = session.get(PasswordResetToken, reset_token.id)
+            if token_row is None or token_row.used:
+                raise HTTPException(status_code=400, detail="Токен уже использован")
+            
+            # Обновляем пароль
+            session.execute(
+                update(Establishment)
+                .where(Establishment.id == establishment.id)
+                .values(password=hashed_password, updated_at=datetime.utcnow())
+            )
+            
+            # Помечаем токен как использованный
+            mark_used(token_row)
+            
+            # Все прежние входы (и украденные токены, если пароль меняют из-за них) больше не действуют
+            revoke_establishment_sessions(session, establishment.id)
         
-        db.commit()
+        await write_queue.submit(save)
+        principal_cache.invalidate(establishment.id)
         
         print(f"Password reset successful for establishment_id: {establishment.id}")
         
@@ -767,117 +1367,379 @@ async def reset_password(
         print(f"Error: {str(e)}")
         print(traceback.format_exc())
         print("=" * 50)
-        db.rollback()
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
-@app.post("/api/establishments/{establishment_id}/documents/upload")
+# Схема multipart-тела загрузки документа при регистрации (тело разбирается потоково)
+REGISTRATION_UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file", "document_group", "document_type", "document_name"],
+                    "properties": {
+                        "file": {"type": "string", "format": "binary"},
+                        "document_group": {"type": "string"},
+                        "document_type": {"type": "string"},
+                        "document_name": {"type": "string"},
+                        "required": {"type": "boolean", "default": False},
+                    },
+                }
+            }
+        },
+    }
+}
+
+@app.post("/api/establishments/{establishment_id}/documents/upload", openapi_extra=REGISTRATION_UPLOAD_OPENAPI, dependencies=[Depends(registration_upload_rate_limit)])
 async def upload_registration_document(
     establishment_id: int,
-    file: UploadFile = File(...),
-    document_group: str = Form(...),
-    document_type: str = Form(...),
-    document_name: str = Form(...),
-    required: bool = Form(False),
-    db: Session = Depends(get_db)
+    request: Request,
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     """Загрузка документа при регистрации"""
     # Проверяем существование заведения
-    establishment = db.query(Establishment).filter(Establishment.id == establishment_id).first()
+    establishment = await db.get(Establishment, establishment_id)
     if not establishment:
         raise HTTPException(status_code=404, detail="Establishment not found")
     
-    # Валидация файла
-    allowed_extensions = ['.pdf', '.jpg', '.jpeg', '.png', '.doc', '.docx']
-    file_ext = os.path.splitext(file.filename)[1].lower()
-    if file_ext not in allowed_extensions:
-        raise HTTPException(
-            status_code=400, 
-            detail=f"File type not allowed. Allowed types: {', '.join(allowed_extensions)}"
+    # Валидация файла выполняется во время приема тела
+    upload = StreamingUpload(
+        request,
+        UPLOAD_DIR,
+        allowed_extensions=ALLOWED_DOCUMENT_EXTENSIONS,
+        max_file_size=MAX_DOCUMENT_SIZE
+    )
+    try:
+        await upload.receive()
+        
+        file = upload.files.get("file")
+        if file is None:
+            raise HTTPException(status_code=400, detail="No file provided")
+        missing_fields = [
+            field for field in ("document_group", "document_type", "document_name")
+            if not upload.fields.get(field)
+        ]
+        if missing_fields:
+            raise HTTPException(status_code=422, detail=f"Missing required fields: {', '.join(missing_fields)}")
+        required = upload.fields.get("required", "false").lower() in ("true", "1", "yes", "on")
+        
+        # Сохраняем файл и создаем запись в БД
+        db_document = await save_document_record(
+            establishment_id,
+            upload.fields["document_type"],
+            file.temp_path,
+            file.sha256,
+            file.size,
+            file.filename,
+            document_group=upload.fields["document_group"],
+            document_name=upload.fields["document_name"],
+            required=required
         )
+    finally:
+        await upload.cleanup()
     
-    # Сохраняем файл
-    doc_id = str(uuid.uuid4())
-    file_path = os.path.join(UPLOAD_DIR, f"{doc_id}_{file.filename}")
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    return document_to_response(db_document)
+
+# Схема multipart-тела пакетной загрузки
+BATCH_UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["documents"],
+                    "properties": {
+                        "documents": {
+                            "type": "string",
+                            "description": (
+                                'JSON-массив: [{"file": "<имя поля с файлом>", "document_type": "...", '
+                                '"document_group": "...", "document_name": "...", "required": true}]'
+                            ),
+                        },
+                    },
+                    "additionalProperties": {"type": "string", "format": "binary"},
+                }
+            }
+        },
+    }
+}
+
+# Максимум файлов в одной пакетной загрузке
+MAX_BATCH_FILES = 30
+
+@app.post("/api/establishments/{establishment_id}/documents/batch", openapi_extra=BATCH_UPLOAD_OPENAPI, dependencies=[Depends(upload_rate_limit)])
+async def upload_documents_batch(
+    establishment_id: int,
+    request: Request,
+    current_establishment: TokenClaims = Depends(get_current_principal)
+):
+    """
+    Пакетная загрузка документов одним запросом
     
-    # Создаем запись в БД
-    db_document = Document(
-        establishment_id=establishment_id,
-        document_group=document_group,
-        document_type=document_type,
-        document_name=document_name,
-        file_path=file_path,
-        file_name=file.filename,
-        required=required,
-        uploaded=True,
-        uploaded_at=datetime.utcnow()
+    Файлы передаются отдельными частями multipart, поле documents описывает,
+    какой файл каким документом является. Файлы пишутся на диск параллельно,
+    записи Document обычно коммитятся одной транзакцией; ошибка одного файла
+    не отменяет остальные. В ответе - результат по каждому файлу.
+    """
+    if current_establishment.id != establishment_id:
+        raise HTTPException(status_code=403, detail="Forbidden: You can only upload documents for your own establishment")
+    
+    upload = StreamingUpload(
+        request,
+        UPLOAD_DIR,
+        allowed_extensions=ALLOWED_DOCUMENT_EXTENSIONS,
+        max_file_size=MAX_DOCUMENT_SIZE,
+        max_files=MAX_BATCH_FILES
     )
-    db.add(db_document)
-    db.commit()
-    db.refresh(db_document)
+    try:
+        await upload.receive()
+        
+        try:
+            manifest = json.loads(upload.fields.get("documents", ""))
+        except ValueError:
+            raise HTTPException(status_code=422, detail="Field 'documents' must be a JSON array")
+        if not isinstance(manifest, list) or not manifest:
+            raise HTTPException(status_code=422, detail="Field 'documents' must be a non-empty JSON array")
+        
+        results = []
+        accepted = []
+        used_fields = set()
+        used_types = set()
+        for item in manifest:
+            field = item.get("file") if isinstance(item, dict) else None
+            file = upload.files.get(field) if field else None
+            if file is None or field in used_fields:
+                results.append({"file": field, "status": "error", "detail": "File part not found"})
+                continue
+            if not item.get("document_type"):
+                results.append({"file": field, "status": "error", "detail": "document_type is required"})
+                continue
+            # Вторая версия того же типа в одной пачке сразу заменила бы первую
+            if item["document_type"] in used_types:
+                results.append({"file": field, "status": "error", "detail": "Duplicate document_type in batch"})
+                continue
+            used_fields.add(field)
+            used_types.add(item["document_type"])
+            result = {"file": field, "status": "ok"}
+            results.append(result)
+            accepted.append((item, file, result))
+        
+        # Каждый файл - своя операция очереди записей. Отправленные разом, они
+        # попадают в одну транзакцию с одним коммитом (и одним fsync); если
+        # какая-то падает, очередь повторяет их поштучно - ошибка достается
+        # только своему файлу
+        saved = await asyncio.gather(
+            *(
+                save_document_record(
+                    establishment_id,
+                    item["document_type"],
+                    file.temp_path,
+                    file.sha256,
+                    file.size,
+                    file.filename,
+                    document_group=item.get("document_group"),
+                    document_name=item.get("document_name"),
+                    required=bool(item.get("required", False))
+                )
+                for item, file, _ in accepted
+            ),
+            return_exceptions=True
+        )
+        for (item, _, result), outcome in zip(accepted, saved):
+            if isinstance(outcome, HTTPException):
+                result.update(status="error", detail=outcome.detail)
+            elif isinstance(outcome, Exception):
+                print(f"Error saving batch document {item['document_type']}: {outcome}")
+                result.update(status="error", detail=f"Error saving document: {str(outcome)}")
+            else:
+                result["document"] = document_to_response(outcome)
+    finally:
+        await upload.cleanup()
     
-    return document_to_response(db_document)
+    saved_count = sum(1 for result in results if result["status"] == "ok")
+    print(f"Batch upload for establishment {establishment_id}: {saved_count} of {len(manifest)} documents saved")
+    return {"results": results}
 
 @app.delete("/api/establishments/{establishment_id}/documents/{document_id}")
 async def delete_registration_document(
     establishment_id: int,
     document_id: int,
-    current_establishment: Establishment = Depends(get_current_establishment),
-    db: Session = Depends(get_db)
+    current_establishment: TokenClaims = Depends(get_current_principal)
 ):
     """Удалить документ при регистрации"""
     # Проверяем права доступа - пользователь может удалять документы только для себя
     if current_establishment.id != establishment_id:
         raise HTTPException(status_code=403, detail="Forbidden: You can only delete documents for your own establishment")
     
-    document = db.query(Document).filter(
-        Document.id == document_id,
-        Document.establishment_id == establishment_id
-    ).first()
-    
-    if not document:
-        raise HTTPException(status_code=404, detail="Document not found")
-    
-    # Удаляем файл
-    if document.file_path and os.path.exists(document.file_path):
-        os.remove(document.file_path)
+    def delete(db: Session) -> None:
+        document = db.scalars(document_query(document_id, establishment_id)).first()
+        
+        if not document:
+            raise HTTPException(status_code=404, detail="Document not found")
+        
+        remove_document_record(db, document)
     
-    db.delete(document)
-    db.commit()
+    await write_queue.submit(delete)
     
     return {"message": "Document deleted successfully"}
 
-@app.get("/api/establishments/{establishment_id}/documents", response_model=List[DocumentResponse])
-async def get_establishment_documents(establishment_id: int, db: Session = Depends(get_db)):
-    """Получить все документы заведения"""
-    documents = db.query(Document).filter(Document.establishment_id == establishment_id).all()
+@app.get("/api/establishments/{establishment_id}/documents")
+async def get_establishment_documents(
+    establishment_id: int,
+    request: Request,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    document_group: Optional[str] = None,
+    verification_status: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """
+    Получить документы заведения (постранично)
+    
+    Ответ - массив документов; курсор следующей страницы - в заголовке X-Next-Cursor.
+    """
+    documents, next_cursor = await list_documents_page(
+        db, establishment_id, limit, cursor, document_group, verification_status, fields
+    )
+    set_next_cursor_headers(request, response, next_cursor)
     return documents
 
-@app.post("/api/establishments/{establishment_id}/submit")
-async def submit_establishment(establishment_id: int, db: Session = Depends(get_db)):
-    """Отправить заявление на проверку"""
-    establishment = db.query(Establishment).filter(Establishment.id == establishment_id).first()
-    if not establishment:
-        raise HTTPException(status_code=404, detail="Establishment not found")
+@app.get("/api/establishments/{establishment_id}/documents/{document_type}/history")
+async def get_document_history(
+    establishment_id: int,
+    document_type: str,
+    request: Request,
+    response: Response,
+    limit: int = Query(DEFAULT_HISTORY_PAGE_SIZE, ge=1, le=MAX_HISTORY_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_establishment: TokenClaims = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """
+    История версий документа одного типа (постранично, новые первыми)
     
-    # Проверяем обязательные документы
-    required_docs = db.query(Document).filter(
-        Document.establishment_id == establishment_id,
-        Document.required == True
-    ).all()
+    current - текущая версия (id документа и ее номер), versions - замененные версии.
+    """
+    if current_establishment.id != establishment_id:
+        raise HTTPException(status_code=403, detail="Forbidden: You can only view your own documents")
     
-    uploaded_required = [doc for doc in required_docs if doc.uploaded]
+    pointer = await document_versions.current_version(db, establishment_id, document_type)
+    versions, next_cursor = await document_versions.history_page(db, establishment_id, document_type, limit, cursor)
+    set_next_cursor_headers(request, response, next_cursor)
+    return {
+        "document_type": document_type,
+        "current": {"document_id": pointer.document_id, "version": pointer.version} if pointer else None,
+        "versions": versions,
+        "next_cursor": next_cursor
+    }
+
+@app.api_route("/api/establishments/{establishment_id}/documents/history/{history_id}/download", methods=["GET", "HEAD"])
+def download_document_version(
+    establishment_id: int,
+    history_id: int,
+    request: Request,
+    current_establishment: TokenClaims = Depends(get_current_principal),
+    db: Session = Depends(get_read_db)
+):
+    """Скачать файл замененной версии документа"""
+    if current_establishment.id != establishment_id:
+        raise HTTPException(status_code=403, detail="Forbidden: You can only download your own documents")
     
-    if len(uploaded_required) < len(required_docs):
-        raise HTTPException(
-            status_code=400,
-            detail=f"Not all required documents uploaded. {len(required_docs) - len(uploaded_required)} missing"
-        )
+    version = db.scalars(history_version_query(history_id, establishment_id)).first()
+    if not version:
+        raise HTTPException(status_code=404, detail="Document version not found")
+    if not version.file_path or not os.path.exists(version.file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    blob = db.scalars(blob_by_path_query(version.file_path)).first()
+    return file_download_response(
+        request,
+        version.file_path,
+        version.file_name or os.path.basename(version.file_path),
+        UPLOAD_DIR,
+        content_hash=blob.sha256 if blob else None
+    )
+
+@app.get("/api/establishments/{establishment_id}/documents/export")
+def export_establishment_documents(
+    establishment_id: int,
+    mode: str = "deflated",
+    current_establishment: TokenClaims = Depends(get_current_principal),
+    db: Session = Depends(get_read_db)
+):
+    """
+    Выгрузить актуальные документы заведения одним ZIP-архивом
+    
+    Архив собирается на лету с разбивкой по папкам document_group.
+    mode=stored - без сжатия, зато с Content-Length; mode=deflated - со сжатием.
+    """
+    if current_establishment.id != establishment_id:
+        raise HTTPException(status_code=403, detail="Forbidden: You can only export your own documents")
+    if mode not in ("stored", "deflated"):
+        raise HTTPException(status_code=400, detail="mode must be 'stored' or 'deflated'")
+    
+    # В documents только текущие версии - по одной на тип
+    documents = db.scalars(export_documents_query(establishment_id)).all()
+    
+    entries = []
+    used_names = set()
+    for doc in documents:
+        if not doc.file_path or not os.path.exists(doc.file_path):
+            continue
+        
+        # В названиях бывают слэши (ОГРН/ИНН) - они не должны превращаться в папки
+        title = f"{doc.document_name} - {doc.file_name}".replace("/", "_").replace("\\", "_")
+        arcname = f"{doc.document_group}/{title}"
+        if arcname in used_names:
+            arcname = f"{doc.document_group}/{doc.id}_{title}"
+        used_names.add(arcname)
+        
+        entries.append(ZipEntry(doc.file_path, arcname, os.path.getsize(doc.file_path), doc.uploaded_at))
+    
+    if not entries:
+        raise HTTPException(status_code=404, detail="No documents to export")
+    
+    archive = ZipStream(entries, ZIP_STORED if mode == "stored" else ZIP_DEFLATED)
+    try:
+        archive.check_size()
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    
+    archive_name = f"documents_{establishment_id}_{datetime.utcnow():%Y%m%d}.zip"
+    headers = {"Content-Disposition": f'attachment; filename="{archive_name}"'}
+    if mode == "stored":
+        headers["Content-Length"] = str(archive.stored_size())
+    
+    return StreamingResponse(archive, media_type="application/zip", headers=headers)
+
+@app.post("/api/establishments/{establishment_id}/submit")
+async def submit_establishment(establishment_id: int):
+    """Отправить заявление на проверку"""
+    def submit(db: Session) -> None:
+        establishment = db.get(Establishment, establishment_id)
+        if not establishment:
+            raise HTTPException(status_code=404, detail="Establishment not found")
+        
+        # Проверяем обязательные документы
+        required_docs = db.scalars(required_documents_query(establishment_id)).all()
+        
+        uploaded_required = [doc for doc in required_docs if doc.uploaded]
+        
+        if len(uploaded_required) < len(required_docs):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Not all required documents uploaded. {len(required_docs) - len(uploaded_required)} missing"
+            )
+        
+        establishment.status = "pending"
     
-    establishment.status = "pending"
-    db.commit()
+    await write_queue.submit(submit)
+    principal_cache.invalidate(establishment_id)
     
     return {"message": "Application submitted successfully", "status": "pending"}
 
@@ -0,0 +1,186 @@
+"""
+Миграция загруженных файлов в хешированное дерево каталогов (uploads/ab/cd/...)
+ВАЖНО: Работает без остановки сервера - файлы переносятся пачками, ссылка в БД
+обновляется короткой транзакцией на каждый файл. Скрипт можно прервать и запустить
+снова: прогресс сохраняется в таблице storage_layout_migration.
+
+Порядок для каждого файла: жесткая ссылка по новому пути (вместе с миниатюрами
+.thumbN.jpg) -> UPDATE + COMMIT -> удаление старого пути. В любой момент хотя бы
+один путь из БД указывает на файл.
+"""
+import argparse
+import filecmp
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+
+from storage import sharded_path, UPLOAD_DIR
+from thumbnails import thumbnail_paths
+
+DB_PATH = "./ebar.db"
+
+# Шаги миграции: (имя, таблица, первичный ключ, колонка с путем, корневой каталог)
+STEPS = [
+    ("blobs", "file_blobs", "rowid", "file_path", os.path.join(UPLOAD_DIR, "blobs")),
+    ("documents", "documents", "id", "file_path", UPLOAD_DIR),
+    ("logos", "establishments", "id", "logo_path", os.path.join(UPLOAD_DIR, "logos")),
+]
+
+
+def get_checkpoint(conn, step: str) -> int:
+    row = conn.execute("SELECT last_id FROM storage_layout_migration WHERE step = ?", (step,)).fetchone()
+    return row[0] if row else 0
+
+
+def set_checkpoint(conn, step: str, last_id: int):
+    conn.execute(
+        "INSERT INTO storage_layout_migration (step, last_id) VALUES (?, ?) "
+        "ON CONFLICT(step) DO UPDATE SET last_id = excluded.last_id",
+        (step, last_id)
+    )
+
+
+def file_sha256(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def is_complete_copy(old_path: str, new_path: str, sha256: str = None) -> bool:
+    """Файл по новому пути - полная копия старого (а не обрывок прерванного запуска)"""
+    if os.path.samefile(old_path, new_path):
+        return True
+    if os.path.getsize(new_path) != os.path.getsize(old_path):
+        return False
+    # Файл хранилища называется своим хешом - сверяем с ним, иначе побайтно
+    if sha256 is not None:
+        return file_sha256(new_path) == sha256
+    return filecmp.cmp(old_path, new_path, shallow=False)
+
+
+def link_or_copy(old_path: str, new_path: str, sha256: str = None):
+    """Создает файл по новому пути, не трогая старый"""
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    if os.path.exists(new_path):
+        # Остался от прерванного запуска
+        if is_complete_copy(old_path, new_path, sha256):
+            return
+        os.remove(new_path)
+    try:
+        os.link(old_path, new_path)
+    except OSError:
+        # ФС без жестких ссылок - копируем через временный файл
+        tmp_path = new_path + ".tmp"
+        shutil.copy2(old_path, tmp_path)
+        os.replace(tmp_path, new_path)
+
+
+def move_file(conn, step: str, old_path: str, new_path: str, sha256: str = None) -> str:
+    """Переносит один файл с миниатюрами и обновляет все ссылки на него. Возвращает результат"""
+    if not os.path.exists(old_path):
+        if not os.path.exists(new_path):
+            return "missing"
+    else:
+        link_or_copy(old_path, new_path, sha256)
+    # Миниатюры ищутся рядом с файлом: без переноса они создавались бы заново
+    thumbnails = list(zip(thumbnail_paths(old_path), thumbnail_paths(new_path)))
+    for old_thumbnail, new_thumbnail in thumbnails:
+        if os.path.exists(old_thumbnail):
+            link_or_copy(old_thumbnail, new_thumbnail)
+
+    if step == "blobs":
+        # На файл хранилища ссылаются file_blobs, документы и их старые версии
+        conn.execute("UPDATE file_blobs SET file_path = ? WHERE file_path = ?", (new_path, old_path))
+        conn.execute("UPDATE documents SET file_path = ? WHERE file_path = ?", (new_path, old_path))
+        conn.execute("UPDATE document_history SET file_path = ? WHERE file_path = ?", (new_path, old_path))
+    elif step == "documents":
+        conn.execute("UPDATE documents SET file_path = ? WHERE file_path = ?", (new_path, old_path))
+        conn.execute("UPDATE document_history SET file_path = ? WHERE file_path = ?", (new_path, old_path))
+    else:
+        conn.execute("UPDATE establishments SET logo_path = ? WHERE logo_path = ?", (new_path, old_path))
+    conn.commit()
+
+    for path in [old_path] + [old_thumbnail for old_thumbnail, _ in thumbnails]:
+        if os.path.exists(path):
+            os.remove(path)
+    return "moved"
+
+
+def migrate_step(conn, step, table, pk, column, root, batch_size: int, pause: float, dry_run: bool):
+    """Переносит файлы одного вида пачками по возрастанию первичного ключа"""
+    last_id = 0 if dry_run else get_checkpoint(conn, step)
+    stats = {"moved": 0, "missing": 0, "skipped": 0}
+    print(f"Шаг '{step}': продолжаю с {pk} > {last_id}")
+
+    while True:
+        rows = conn.execute(
+            f"SELECT {pk}, {column} FROM {table} WHERE {pk} > ? AND {column} IS NOT NULL ORDER BY {pk} LIMIT ?",
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+
+        for row_id, old_path in rows:
+            old_path = os.path.normpath(old_path)
+            # Переносим только файлы, лежащие прямо в корне (старая плоская раскладка)
+            if os.path.dirname(old_path) != root:
+                stats["skipped"] += 1
+                continue
+            filename = os.path.basename(old_path)
+            key = filename[:64] if step == "blobs" else None
+            new_path = sharded_path(root, filename, key=key)
+            if dry_run:
+                print(f"  {old_path} -> {new_path}")
+                stats["moved"] += 1
+                continue
+            stats[move_file(conn, step, old_path, new_path, sha256=key)] += 1
+
+        last_id = rows[-1][0]
+        if not dry_run:
+            set_checkpoint(conn, step, last_id)
+            conn.commit()
+        print(f"  ...{pk} до {last_id}: перенесено {stats['moved']}, нет файла {stats['missing']}")
+        # Даем поработать запросам пользователей между пачками
+        time.sleep(pause)
+
+    print(f"✓ Шаг '{step}': перенесено {stats['moved']}, нет файла {stats['missing']}, "
+          f"уже в новой раскладке {stats['skipped']}")
+
+
+def migrate_storage_layout(batch_size: int = 200, pause: float = 0.05, dry_run: bool = False):
+    """Переносит документы, файлы хранилища и логотипы в хешированное дерево каталогов"""
+    if not os.path.exists(DB_PATH):
+        print(f"База данных {DB_PATH} не найдена. Создайте её сначала.")
+        return
+
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS storage_layout_migration (step TEXT PRIMARY KEY, last_id INTEGER NOT NULL)"
+        )
+        conn.commit()
+
+        for step, table, pk, column, root in STEPS:
+            migrate_step(conn, step, table, pk, column, root, batch_size, pause, dry_run)
+
+        print("\n✓ Миграция раскладки файлов завершена!")
+    except Exception as e:
+        conn.rollback()
+        print(f"✗ Ошибка при миграции: {e}")
+        print("Запустите скрипт снова - он продолжит с последней сохраненной пачки")
+        raise
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Перенос файлов uploads/ в хешированное дерево каталогов")
+    parser.add_argument("--batch-size", type=int, default=200, help="Сколько строк обрабатывать за пачку")
+    parser.add_argument("--pause", type=float, default=0.05, help="Пауза между пачками, секунд")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать, что будет перенесено")
+    args = parser.parse_args()
+    migrate_storage_layout(args.batch_size, args.pause, args.dry_run)
@@ -0,0 +1,391 @@
+"""
+Версионные миграции схемы БД
+
+Новые таблицы создает init_db() (create_all), а все изменения существующих
+таблиц (колонки, индексы, перенос данных) оформляются здесь миграцией с номером
+версии. Примененные версии хранятся в таблице schema_migrations.
+
+Миграция состоит из двух частей:
+- upgrade - быстрое изменение схемы (ALTER TABLE, CREATE INDEX); выполняется
+  в одной транзакции BEGIN IMMEDIATE, поэтому несколько процессов, стартующих
+  одновременно, не применят ее дважды. Должна быть идемпотентной: на новой базе
+  create_all уже создал все по моделям;
+- backfill (необязательно) - перенос данных пачками по диапазонам первичного
+  ключа. Каждая пачка - короткая транзакция, между пачками пауза, а прогресс
+  сохраняется в schema_migrations: после падения перенос продолжится с места
+  остановки. Блокировка записи держится миллисекунды, поэтому backfill можно
+  выполнять при работающем сервере.
+
+Запуск вручную: python migrations.py [--status] [--no-backfill] [--batch-size N] [--pause S]
+"""
+import argparse
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime
+from typing import Callable, List, Optional
+
+DB_PATH = "./ebar.db"
+
+# Размер диапазона первичного ключа на одну транзакцию backfill
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "500"))
+
+# Пауза между пачками backfill (секунды), чтобы не мешать запросам пользователей
+BACKFILL_PAUSE = float(os.getenv("BACKFILL_PAUSE", "0.05"))
+
+
+class Backfill:
+    """
+    Перенос данных по диапазонам первичного ключа
+
+    Args:
+        table: Таблица, по первичному ключу которой идут диапазоны
+        statements: SQL-запросы пачки с параметрами :lo и :hi (pk > :lo AND pk <= :hi)
+        pk: Целочисленная колонка, по которой идут диапазоны (обычно первичный ключ)
+    """
+
+    def __init__(self, table: str, statements: List[str], pk: str = "id"):
+        self.table = table
+        self.statements = statements
+        self.pk = pk
+
+
+class Migration:
+    """
+    Одна версия схемы
+
+    Args:
+        version: Номер версии (миграции применяются по возрастанию)
+        name: Короткое описание
+        upgrade: Идемпотентное изменение схемы (получает соединение sqlite3)
+        backfill: Перенос данных после изменения схемы
+    """
+
+    def __init__(
+        self,
+        version: int,
+        name: str,
+        upgrade: Callable[[sqlite3.Connection], None],
+        backfill: Optional[Backfill] = None
+    ):
+        self.version = version
+        self.name = name
+        self.upgrade = upgrade
+        self.backfill = backfill
+
+
+# ---- вспомогательные функции для upgrade ----
+
+def column_exists(conn: sqlite3.Connection, table: str, column: str) -> bool:
+    return any(row[1] == column for row in conn.execute(f"PRAGMA table_info({table})"))
+
+
+def add_column(conn: sqlite3.Connection, table: str, column: str, definition: str) -> None:
+    """ALTER TABLE ADD COLUMN, если колонки еще нет"""
+    if not column_exists(conn, table, column):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def create_index(conn: sqlite3.Connection, name: str, table: str, columns: List[str], unique: bool = False) -> None:
+    conn.execute(
+        f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+    )
+
+
+# ---- миграции ----
+
+def _documents_verification_columns(conn):
+    add_column(conn, "documents", "verification_status", "TEXT DEFAULT 'verified'")
+    add_column(conn, "documents", "expiry_date", "DATETIME")
+
+
+def _composite_indexes(conn):
+    create_index(conn, "ix_documents_establishment_uploaded", "documents", ["establishment_id", "uploaded_at", "id"])
+    create_index(conn, "ix_documents_establishment_required", "documents", ["establishment_id", "required"])
+    create_index(conn, "ix_documents_establishment_status", "documents", ["establishment_id", "status"])
+    create_index(conn, "ix_documents_establishment_expiry", "documents", ["establishment_id", "expiry_date"])
+    create_index(conn, "ix_documents_file_path", "documents", ["file_path"])
+    create_index(conn, "ix_establishments_inn", "establishments", ["inn"])
+    create_index(conn, "ix_establishments_ogrn", "establishments", ["ogrn"])
+    create_index(conn, "ix_establishments_logo_path", "establishments", ["logo_path"])
+    create_index(conn, "ix_password_reset_tokens_expires_at", "password_reset_tokens", ["expires_at"])
+
+
+def _document_versions(conn):
+    # Таблицы создает create_all; индексы - на случай, если таблицы уже были без них
+    create_index(conn, "ix_document_history_type_version", "document_history", ["establishment_id", "document_type", "version"])
+    create_index(conn, "ix_document_history_file_path", "document_history", ["file_path"])
+
+
+def _expiry_index(conn):
+    create_index(conn, "ix_documents_expiry_date", "documents", ["expiry_date"])
+
+
+def _reset_token_lookup_index(conn):
+    create_index(conn, "ix_password_reset_tokens_lookup", "password_reset_tokens", ["token", "used", "expires_at"])
+
+
+def table_exists(conn: sqlite3.Connection, table: str) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+
+def _documents_autoincrement(conn):
+    # Без AUTOINCREMENT SQLite выдает id удаленной последней строки заново, а эти id
+    # хранятся в document_history и jobs. Колонку PRIMARY KEY не поменять через
+    # ALTER TABLE, поэтому таблица перестраивается (в documents только текущие
+    # версии - по строке на тип документа, так что копирование короткое)
+    create_sql = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'documents'"
+    ).fetchone()[0]
+    if "AUTOINCREMENT" in create_sql.upper():
+        return
+    create_sql, with_column = re.subn(
+        r"\bid INTEGER NOT NULL,", "id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,", create_sql, count=1
+    )
+    create_sql, without_constraint = re.subn(r",\s*PRIMARY KEY \(id\)", "", create_sql, count=1)
+    if not (with_column and without_constraint):
+        raise RuntimeError("Unexpected definition of table documents")
+    create_sql = re.sub(r"^CREATE TABLE \"?documents\"?", "CREATE TABLE documents_new", create_sql)
+
+    index_sql = [row[0] for row in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'documents' AND sql IS NOT NULL"
+    )]
+    columns = ", ".join(row[1] for row in conn.execute("PRAGMA table_info(documents)"))
+
+    conn.execute(create_sql)
+    conn.execute(f"INSERT INTO documents_new ({columns}) SELECT {columns} FROM documents")
+    conn.execute("DROP TABLE documents")
+    conn.execute("ALTER TABLE documents_new RENAME TO documents")
+    for sql in index_sql:
+        conn.execute(sql)
+
+    # Счетчик продолжается после всех id, которые где-то еще упоминаются
+    used_ids = ["SELECT MAX(id) AS last_id FROM documents"]
+    if table_exists(conn, "document_history"):
+        used_ids.append("SELECT MAX(document_id) AS last_id FROM document_history")
+    if table_exists(conn, "jobs"):
+        used_ids.append("SELECT MAX(document_id) AS last_id FROM jobs")
+    conn.execute("DELETE FROM sqlite_sequence WHERE name = 'documents'")
+    conn.execute(
+        "INSERT INTO sqlite_sequence (name, seq) "
+        f"SELECT 'documents', COALESCE(MAX(last_id), 0) FROM ({' UNION ALL '.join(used_ids)})"
+    )
+
+
+def _history_retention_index(conn):
+    create_index(conn, "ix_document_history_superseded_at", "document_history", ["superseded_at"])
+
+
+# Диапазоны идут по establishment_id: версии одного типа всегда у одного заведения
+_ESTABLISHMENT_RANGE = "establishment_id > :lo AND establishment_id <= :hi"
+
+DOCUMENT_VERSIONS_BACKFILL = [
+    # Текущая версия каждого типа - последняя загруженная, ее номер - число версий
+    "INSERT INTO current_documents (establishment_id, document_type, document_id, version, updated_at) "
+    "SELECT establishment_id, document_type, id, versions, CURRENT_TIMESTAMP FROM ("
+    "  SELECT establishment_id, document_type, id, "
+    "    ROW_NUMBER() OVER (PARTITION BY establishment_id, document_type ORDER BY uploaded_at DESC, id DESC) AS rn, "
+    "    COUNT(*) OVER (PARTITION BY establishment_id, document_type) AS versions "
+    f"  FROM documents WHERE {_ESTABLISHMENT_RANGE}"
+    ") WHERE rn = 1 "
+    "ON CONFLICT (establishment_id, document_type) DO UPDATE SET "
+    "document_id = excluded.document_id, version = excluded.version",
+    # Остальные строки - в историю с номерами 1..N-1 по порядку загрузки
+    "INSERT INTO document_history (document_id, establishment_id, document_type, version, document_group, "
+    "document_name, file_path, file_name, required, status, verification_status, expiry_date, uploaded_at, "
+    "created_at, superseded_at) "
+    "SELECT d.id, d.establishment_id, d.document_type, "
+    "ROW_NUMBER() OVER (PARTITION BY d.establishment_id, d.document_type ORDER BY d.uploaded_at, d.id), "
+    "d.document_group, d.document_name, d.file_path, d.file_name, d.required, d.status, d.verification_status, "
+    "d.expiry_date, d.uploaded_at, d.created_at, CURRENT_TIMESTAMP "
+    f"FROM documents d WHERE d.{_ESTABLISHMENT_RANGE.replace(' AND ', ' AND d.')} "
+    "AND NOT EXISTS (SELECT 1 FROM current_documents c WHERE c.document_id = d.id)",
+    f"DELETE FROM documents WHERE {_ESTABLISHMENT_RANGE} "
+    "AND id NOT IN (SELECT document_id FROM current_documents "
+    f"WHERE document_id IS NOT NULL AND {_ESTABLISHMENT_RANGE})",
+    # Строки удалены в обход ORM - пересчитываем счетчики статистики этих заведений
+    f"DELETE FROM document_counters WHERE {_ESTABLISHMENT_RANGE}",
+    "INSERT INTO document_counters (establishment_id, dimension, value, count) "
+    f"SELECT establishment_id, 'total', '', COUNT(*) FROM documents WHERE {_ESTABLISHMENT_RANGE} "
+    "GROUP BY establishment_id",
+    "INSERT INTO document_counters (establishment_id, dimension, value, count) "
+    "SELECT establishment_id, 'status', status, COUNT(*) FROM documents "
+    f"WHERE {_ESTABLISHMENT_RANGE} AND status IS NOT NULL GROUP BY establishment_id, status",
+    "INSERT INTO document_counters (establishment_id, dimension, value, count) "
+    "SELECT establishment_id, 'verification_status', verification_status, COUNT(*) FROM documents "
+    f"WHERE {_ESTABLISHMENT_RANGE} AND verification_status IS NOT NULL GROUP BY establishment_id, verification_status",
+]
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(
+        1, "documents: verification_status and expiry_date",
+        _documents_verification_columns,
+        Backfill("documents", [
+            "UPDATE documents SET verification_status = 'verified' "
+            "WHERE id > :lo AND id <= :hi AND verification_status IS NULL"
+        ])
+    ),
+    Migration(2, "composite indexes for documents, establishments, reset tokens", _composite_indexes),
+    Migration(
+        3, "document versions: current pointers and history",
+        _document_versions,
+        Backfill("documents", DOCUMENT_VERSIONS_BACKFILL, pk="establishment_id")
+    ),
+    Migration(4, "documents: expiry_date index", _expiry_index),
+    Migration(5, "password_reset_tokens: (token, used, expires_at) index", _reset_token_lookup_index),
+    Migration(6, "documents: AUTOINCREMENT ids", _documents_autoincrement),
+    Migration(7, "document_history: superseded_at index", _history_retention_index),
+]
+
+
+# ---- применение ----
+
+def connect(db_path: str = DB_PATH) -> sqlite3.Connection:
+    # isolation_level=None: транзакциями управляем сами (BEGIN IMMEDIATE)
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA busy_timeout=30000")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, "
+        "name TEXT NOT NULL, "
+        "applied_at DATETIME NOT NULL, "
+        "backfill_last_id INTEGER, "
+        "completed_at DATETIME)"
+    )
+    return conn
+
+
+def apply_schema(conn: sqlite3.Connection) -> List[int]:
+    """Применяет недостающие изменения схемы; возвращает примененные версии"""
+    applied = []
+    for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Проверяем под блокировкой записи: другой процесс мог успеть раньше
+            if conn.execute(
+                "SELECT 1 FROM schema_migrations WHERE version = ?", (migration.version,)
+            ).fetchone():
+                conn.execute("ROLLBACK")
+                continue
+            print(f"[migrations] Applying {migration.version}: {migration.name}")
+            migration.upgrade(conn)
+            now = datetime.utcnow().isoformat(" ")
+            conn.execute(
+                "INSERT INTO schema_migrations (version, name, applied_at, backfill_last_id, completed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (migration.version, migration.name, now,
+                 0 if migration.backfill else None, None if migration.backfill else now)
+            )
+            conn.execute("COMMIT")
+            applied.append(migration.version)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return applied
+
+
+def run_backfill(
+    conn: sqlite3.Connection,
+    migration: Migration,
+    batch_size: int = BACKFILL_BATCH_SIZE,
+    pause: float = BACKFILL_PAUSE
+) -> None:
+    """Выполняет backfill миграции пачками с сохранением прогресса"""
+    backfill = migration.backfill
+    row = conn.execute(
+        "SELECT backfill_last_id, completed_at FROM schema_migrations WHERE version = ?", (migration.version,)
+    ).fetchone()
+    if row is None or row[1] is not None:
+        return
+    last_id = row[0] or 0
+    # Строки, добавленные после начала, уже пишет новый код - их переносить не нужно
+    max_id = conn.execute(f"SELECT MAX({backfill.pk}) FROM {backfill.table}").fetchone()[0] or 0
+    print(f"[migrations] Backfill {migration.version}: {backfill.table}.{backfill.pk} {last_id}..{max_id}")
+
+    while last_id < max_id:
+        upper = min(last_id + batch_size, max_id)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in backfill.statements:
+                conn.execute(statement, {"lo": last_id, "hi": upper})
+            conn.execute(
+                "UPDATE schema_migrations SET backfill_last_id = ? WHERE version = ?",
+                (upper, migration.version)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        last_id = upper
+        time.sleep(pause)
+
+    conn.execute(
+        "UPDATE schema_migrations SET completed_at = ? WHERE version = ?",
+        (datetime.utcnow().isoformat(" "), migration.version)
+    )
+    print(f"[migrations] Backfill {migration.version} completed")
+
+
+def run_backfills(db_path: str = DB_PATH, batch_size: int = BACKFILL_BATCH_SIZE, pause: float = BACKFILL_PAUSE) -> None:
+    """Доводит до конца все незавершенные backfill"""
+    conn = connect(db_path)
+    try:
+        for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+            if migration.backfill:
+                run_backfill(conn, migration, batch_size, pause)
+    finally:
+        conn.close()
+
+
+def upgrade_schema(db_path: str = DB_PATH) -> List[int]:
+    """Применяет недостающие изменения схемы (без backfill)"""
+    conn = connect(db_path)
+    try:
+        return apply_schema(conn)
+    finally:
+        conn.close()
+
+
+def print_status(db_path: str = DB_PATH) -> None:
+    conn = connect(db_path)
+    try:
+        rows = {
+            row[0]: row[1:]
+            for row in conn.execute(
+                "SELECT version, applied_at, backfill_last_id, completed_at FROM schema_migrations"
+            )
+        }
+    finally:
+        conn.close()
+    for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+        if migration.version not in rows:
+            state = "pending"
+        elif rows[migration.version][2] is None:
+            state = f"backfill in progress (last id {rows[migration.version][1]})"
+        else:
+            state = f"applied {rows[migration.version][0]}"
+        print(f"{migration.version:>4}  {migration.name}: {state}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Версионные миграции схемы БД")
+    parser.add_argument("--status", action="store_true", help="Показать состояние миграций")
+    parser.add_argument("--no-backfill", action="store_true", help="Только изменения схемы, без переноса данных")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE, help="Диапазон id на одну транзакцию")
+    parser.add_argument("--pause", type=float, default=BACKFILL_PAUSE, help="Пауза между пачками, секунд")
+    args = parser.parse_args()
+
+    if args.status:
+        print_status()
+    else:
+        # Новые таблицы создаются по моделям, изменения существующих - миграциями
+        from database import init_db
+        init_db()
+        if not args.no_backfill:
+            run_backfills(batch_size=args.batch_size, pause=args.pause)
+        print("\n✓ Миграции применены")
+        print_status()
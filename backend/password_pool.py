@@ -0,0 +1,152 @@
+"""
+Пул потоков для bcrypt
+
+Одно хеширование или проверка пароля bcrypt - это 200-300 мс процессора.
+Вызванные прямо в async-эндпоинте, они останавливают event loop, и в это время
+не обслуживается ни один другой запрос воркера. Поэтому bcrypt выполняется в
+отдельном пуле потоков фиксированного размера (bcrypt отпускает GIL, так что
+потоки действительно работают параллельно с event loop).
+
+Очередь пула ограничена: если ожидающих задач больше PASSWORD_HASH_MAX_QUEUE,
+запрос сразу получает 503 с Retry-After, а не копит задержку у всех остальных.
+
+Метрики (GET /api/metrics/password-hashing): выполнено, отклонено, сколько
+задач сейчас в пуле, время ожидания в очереди и время самого bcrypt.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Optional
+
+from fastapi import HTTPException
+
+from auth_utils import get_rounds, hash_password, verify_password
+
+# Потоков для bcrypt (не больше ядер: иначе задачи только делят процессор)
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Сколько задач может ждать свободного потока
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "32"))
+
+
+class PasswordPoolBusy(HTTPException):
+    """Очередь bcrypt переполнена - клиенту стоит повторить запрос позже"""
+
+    def __init__(self):
+        super().__init__(
+            status_code=503,
+            detail="Сервер перегружен, попробуйте еще раз через несколько секунд",
+            headers={"Retry-After": "1"}
+        )
+
+
+class PasswordHasherPool:
+    """
+    Ограниченный пул потоков для hash_password / verify_password
+
+    Args:
+        workers: Количество потоков
+        max_queue: Максимум задач, ожидающих свободного потока
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_queue: int = PASSWORD_HASH_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Стоимость bcrypt после калибровки (calibrate)
+        self.rounds: Optional[int] = None
+        # Задачи в пуле: выполняются и ждут потока
+        self._in_flight = 0
+        # Метрики
+        self.completed = 0
+        self.rejected = 0
+        self.max_in_flight = 0
+        self._recent_waits: Deque[float] = deque(maxlen=1000)
+        self._recent_runs: Deque[float] = deque(maxlen=1000)
+
+    async def hash(self, password: str) -> str:
+        """hash_password в пуле"""
+        return await self._run(hash_password, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        """verify_password в пуле"""
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    async def calibrate(self) -> int:
+        """Калибрует стоимость bcrypt в пуле (при старте, чтобы не занимать event loop)"""
+        self.rounds = await self._run(get_rounds)
+        return self.rounds
+
+    def stats(self) -> dict:
+        """Метрики пула: очередь и задержки (мс)"""
+        def percentiles(samples: Deque[float]) -> dict:
+            values = sorted(samples)
+
+            def percentile(p: float) -> Optional[float]:
+                if not values:
+                    return None
+                return round(values[min(int(len(values) * p), len(values) - 1)] * 1000, 2)
+
+            return {
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+                "max": round(values[-1] * 1000, 2) if values else None,
+            }
+
+        return {
+            "bcrypt_rounds": self.rounds,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "in_flight": self._in_flight,
+            "queued": max(self._in_flight - self.workers, 0),
+            "max_in_flight": self.max_in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "queue_wait_ms": percentiles(self._recent_waits),
+            "run_ms": percentiles(self._recent_runs),
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, func: Callable[..., Any], *args: Any) -> Any:
+        if self._in_flight >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise PasswordPoolBusy()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+        timings = {}
+
+        def task():
+            timings["started"] = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                timings["finished"] = time.perf_counter()
+
+        self._in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        future = self._executor.submit(task)
+        # Задача занимает место в пуле, пока реально не закончится - даже если
+        # запрос, который ее ждал, уже отменен (клиент отключился)
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._task_done, submitted, timings))
+        return await asyncio.wrap_future(future)
+
+    def _task_done(self, submitted: float, timings: dict) -> None:
+        self._in_flight -= 1
+        if "started" in timings:
+            self.completed += 1
+            self._recent_waits.append(timings["started"] - submitted)
+            self._recent_runs.append(timings["finished"] - timings["started"])
+
+
+# Пул приложения
+password_pool = PasswordHasherPool()
@@ -0,0 +1,107 @@
+"""
+Кеш аутентифицированных пользователей (заведений)
+
+Каждый авторизованный запрос после проверки JWT читал строку establishments
+по id. Кеш хранит ее копию в памяти процесса: ограниченный размер (вытесняется
+давно не использованная запись) и ограниченное время жизни записи.
+
+В кеше лежит не объект сессии, а отсоединенная копия строки (snapshot) -
+ее можно отдавать параллельным запросам, но нельзя менять и сохранять.
+Обработчики, которые меняют заведение, читают строку в своей сессии и после
+коммита вызывают principal_cache.invalidate(id). В других воркерах запись
+устаревает не позже чем через PRINCIPAL_CACHE_TTL_SECONDS.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from database import Establishment
+
+# Время жизни записи (секунды)
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "30"))
+
+# Максимум записей
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+
+
+def snapshot(establishment: Establishment) -> Establishment:
+    """Отсоединенная копия строки: все колонки уже загружены, сессия не нужна"""
+    return Establishment(**{
+        column.key: getattr(establishment, column.key)
+        for column in Establishment.__mapper__.column_attrs
+    })
+
+
+class PrincipalCache:
+    """
+    TTL/LRU-кеш заведений по id
+
+    Args:
+        maxsize: Максимум записей
+        ttl: Время жизни записи (секунды)
+    """
+
+    def __init__(self, maxsize: int = PRINCIPAL_CACHE_SIZE, ttl: float = PRINCIPAL_CACHE_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, Tuple[float, Establishment]]" = OrderedDict()
+        # Синхронные зависимости выполняются в пуле потоков
+        self._lock = threading.Lock()
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, establishment_id: int) -> Optional[Establishment]:
+        with self._lock:
+            entry = self._entries.get(establishment_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[establishment_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(establishment_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, establishment: Establishment) -> Establishment:
+        """Кладет копию строки в кеш и возвращает ее"""
+        principal = snapshot(establishment)
+        with self._lock:
+            self._entries[principal.id] = (time.monotonic() + self.ttl, principal)
+            self._entries.move_to_end(principal.id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return principal
+
+    def invalidate(self, establishment_id: int) -> None:
+        """Данные заведения изменились - следующий запрос перечитает их из БД"""
+        with self._lock:
+            if self._entries.pop(establishment_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+# Кеш приложения
+principal_cache = PrincipalCache()
@@ -0,0 +1,71 @@
+"""
+Запросы обработчиков main.py
+
+Обработчики выполняют их в синхронной сессии, в асинхронной или внутри операции
+write_queue, поэтому здесь только построение запроса (select), без выполнения.
+test_query_plans.py прогоняет эти же запросы через EXPLAIN QUERY PLAN.
+"""
+from sqlalchemy import select
+
+from database import Document, DocumentHistory, Establishment, FileBlob, PasswordResetToken
+
+
+def document_query(doc_id: int, establishment_id: int = None):
+    """Документ по id (и, если задано, только этого заведения)"""
+    query = select(Document).where(Document.id == doc_id)
+    if establishment_id is not None:
+        query = query.where(Document.establishment_id == establishment_id)
+    return query.limit(1)
+
+
+def blob_by_path_query(file_path: str):
+    """Запись хранилища по пути файла (для ETag)"""
+    return select(FileBlob).where(FileBlob.file_path == file_path).limit(1)
+
+
+def establishment_exists_query(email: str, username: str):
+    """Заведение с таким email или username (проверка при регистрации)"""
+    return select(Establishment.id).where(
+        (Establishment.email == email) |
+        (Establishment.username == username)
+    ).limit(1)
+
+
+def login_query(username: str):
+    """Заведение для входа: логин может быть username или email"""
+    return select(Establishment).where(
+        (Establishment.username == username) |
+        (Establishment.email == username)
+    ).limit(1)
+
+
+def establishment_by_email_query(email: str):
+    return select(Establishment).where(Establishment.email == email).limit(1)
+
+
+def reset_token_query(token: str):
+    return select(PasswordResetToken).where(PasswordResetToken.token == token).limit(1)
+
+
+def history_version_query(history_id: int, establishment_id: int):
+    """Замененная версия документа заведения"""
+    return select(DocumentHistory).where(
+        DocumentHistory.id == history_id,
+        DocumentHistory.establishment_id == establishment_id
+    ).limit(1)
+
+
+def export_documents_query(establishment_id: int):
+    """Загруженные документы заведения для выгрузки в ZIP (новые первыми)"""
+    return select(Document).where(
+        Document.establishment_id == establishment_id,
+        Document.uploaded == True
+    ).order_by(Document.uploaded_at.desc(), Document.id.desc())
+
+
+def required_documents_query(establishment_id: int):
+    """Обязательные документы заведения (проверка перед отправкой заявления)"""
+    return select(Document).where(
+        Document.establishment_id == establishment_id,
+        Document.required == True
+    )
@@ -0,0 +1,302 @@
+"""
+Ограничение частоты запросов (token bucket)
+
+slowapi хранил счетчики в памяти процесса: при N воркерах uvicorn лимит
+"5 попыток в минуту" на деле был 5*N, а перезапуск обнулял счетчики.
+Здесь состояние лежит в отдельном файле SQLite (RATE_LIMIT_DB), общем для всех
+воркеров на сервере; отдельный файл - чтобы проверки не стояли в очереди за
+блокировкой записи основной БД.
+
+Лимит "N/период" - это корзина на N токенов, которая равномерно пополняется
+N токенами за период; запрос забирает токен (пакет - несколько). Проверка -
+один оператор UPSERT ... RETURNING: пополнение, списание и ответ "можно ли"
+считаются внутри SQLite атомарно, то есть один поход в хранилище и никаких
+гонок между воркерами.
+
+Бэкенд подключаемый (RATE_LIMIT_BACKEND): sqlite - по умолчанию, memory -
+словарь в памяти процесса (один воркер, тесты). Обращение к файлу SQLite
+блокирующее (до RATE_LIMIT_BUSY_TIMEOUT_MS при занятом файле), поэтому
+проверка выполняется в пуле потоков, а не в event loop.
+"""
+import asyncio
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Tuple
+
+from fastapi import Depends, HTTPException, Request
+
+from auth import TokenClaims, get_current_principal
+
+# Бэкенд хранения корзин: sqlite | memory
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "sqlite")
+
+# Файл общего хранилища: в каталоге backend (рядом с ebar.db и uploads/),
+# от рабочего каталога процесса не зависит
+RATE_LIMIT_DB = os.getenv(
+    "RATE_LIMIT_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ratelimit.db")
+)
+
+# Сколько ждать блокировку файла (мс); дольше - запрос пропускается без проверки
+RATE_LIMIT_BUSY_TIMEOUT_MS = int(os.getenv("RATE_LIMIT_BUSY_TIMEOUT_MS", "100"))
+
+# Корзина, которую не трогали дольше, давно полная - ее можно удалить
+RATE_LIMIT_IDLE_SECONDS = 86400
+
+_PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+_LIMIT_FORMAT = re.compile(r"^\s*(\d+)\s*/\s*(\d*)\s*(second|minute|hour|day)s?\s*$")
+
+
+class RateLimit:
+    """
+    Лимит в формате slowapi: "5/minute", "3/15minutes", "100/hour"
+
+    Args:
+        value: Строка лимита
+    """
+
+    def __init__(self, value: str):
+        match = _LIMIT_FORMAT.match(value)
+        if match is None:
+            raise ValueError(f"Invalid rate limit: {value}")
+        count, multiplier, unit = match.groups()
+        self.value = value
+        # Емкость корзины и пополнение (токенов в секунду)
+        self.capacity = float(count)
+        self.period = int(multiplier or 1) * _PERIODS[unit]
+        self.rate = self.capacity / self.period
+
+    def __repr__(self) -> str:
+        return f"RateLimit({self.value!r})"
+
+
+# Лимиты: вход - на IP, восстановление пароля - на email, загрузки - на заведение
+LOGIN_RATE_LIMIT = RateLimit(os.getenv("LOGIN_RATE_LIMIT", "5/minute"))
+FORGOT_PASSWORD_RATE_LIMIT = RateLimit(os.getenv("FORGOT_PASSWORD_RATE_LIMIT", "3/15minutes"))
+# Ввод кода сброса - на IP: код из 6 цифр не должен подбираться перебором
+RESET_PASSWORD_RATE_LIMIT = RateLimit(os.getenv("RESET_PASSWORD_RATE_LIMIT", "10/15minutes"))
+UPLOAD_RATE_LIMIT = RateLimit(os.getenv("UPLOAD_RATE_LIMIT", "60/minute"))
+# Куски возобновляемой загрузки: один файл - это десятки запросов PATCH
+UPLOAD_CHUNK_RATE_LIMIT = RateLimit(os.getenv("UPLOAD_CHUNK_RATE_LIMIT", "600/minute"))
+# Загрузка документов при регистрации без токена - на IP
+REGISTRATION_UPLOAD_RATE_LIMIT = RateLimit(os.getenv("REGISTRATION_UPLOAD_RATE_LIMIT", "30/hour"))
+
+
+class RateLimitExceeded(HTTPException):
+    """Лимит исчерпан: 429 и Retry-After - через сколько секунд появится токен"""
+
+    def __init__(self, retry_after: float, detail: str):
+        super().__init__(
+            status_code=429,
+            detail=detail,
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
+        )
+
+
+class MemoryBackend:
+    """Корзины в памяти процесса (только для одного воркера)"""
+
+    name = "memory"
+    # Проверка не ходит на диск - пул потоков не нужен
+    blocking = False
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key: str, limit: RateLimit, cost: float, now: float) -> Tuple[bool, float]:
+        """Списывает cost токенов, если они есть. Returns: (разрешено, токенов осталось)"""
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (limit.capacity, now))
+            tokens = min(limit.capacity, tokens + max(0.0, now - updated_at) * limit.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            return allowed, tokens
+
+    def purge(self, before: float) -> int:
+        """Удаляет корзины, не тронутые с before (они уже полные - как отсутствующие)"""
+        with self._lock:
+            idle = [key for key, (_, updated_at) in self._buckets.items() if updated_at < before]
+            for key in idle:
+                del self._buckets[key]
+            return len(idle)
+
+
+class SQLiteBackend:
+    """
+    Корзины в файле SQLite, общем для всех воркеров сервера
+
+    Файл и таблица создаются при первой проверке, а не при создании бэкенда:
+    импорт модуля (тесты, скрипты) ничего не пишет на диск.
+
+    Args:
+        path: Путь к файлу
+    """
+
+    name = "sqlite"
+    blocking = True
+
+    # Уровень корзины на момент :now (старый уровень плюс пополнение)
+    _LEVEL = "min(:capacity, tokens + max(0.0, :now - updated_at) * :rate)"
+
+    # Пополнение, списание и ответ - одним оператором. В SET все выражения
+    # видят старые значения строки, поэтому allowed и tokens считаются от одного уровня
+    _HIT = f"""
+        INSERT INTO rate_limit_buckets (key, tokens, allowed, updated_at)
+        VALUES (:key, :capacity - :cost, 1, :now)
+        ON CONFLICT(key) DO UPDATE SET
+            allowed = {_LEVEL} >= :cost,
+            tokens = {_LEVEL} - CASE WHEN {_LEVEL} >= :cost THEN :cost ELSE 0 END,
+            updated_at = :now
+        RETURNING allowed, tokens
+    """
+
+    def __init__(self, path: str = RATE_LIMIT_DB):
+        self.path = path
+        # Соединение на поток: sqlite3 не разрешает делить его между потоками
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # isolation_level=None - каждый оператор сам себе транзакция
+            connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            connection.execute(f"PRAGMA busy_timeout={RATE_LIMIT_BUSY_TIMEOUT_MS}")
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Счетчики не стоят fsync: после сбоя питания корзины просто начнутся заново
+            connection.execute("PRAGMA synchronous=OFF")
+            self._local.connection = connection
+            if not self._schema_ready:
+                self._init_schema(connection)
+        return connection
+
+    def _init_schema(self, connection: sqlite3.Connection) -> None:
+        """Создает таблицу корзин (один раз на бэкенд, при первом соединении)"""
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    allowed INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_rate_limit_buckets_updated_at ON rate_limit_buckets (updated_at)"
+            )
+            self._schema_ready = True
+
+    def hit(self, key: str, limit: RateLimit, cost: float, now: float) -> Tuple[bool, float]:
+        """Списывает cost токенов, если они есть. Returns: (разрешено, токенов осталось)"""
+        allowed, tokens = self._connect().execute(self._HIT, {
+            "key": key,
+            "capacity": limit.capacity,
+            "rate": limit.rate,
+            "cost": cost,
+            "now": now,
+        }).fetchone()
+        return bool(allowed), tokens
+
+    def purge(self, before: float) -> int:
+        """Удаляет корзины, не тронутые с before (они уже полные - как отсутствующие)"""
+        return self._connect().execute("DELETE FROM rate_limit_buckets WHERE updated_at < ?", (before,)).rowcount
+
+
+class RateLimiter:
+    """
+    Проверка лимитов поверх бэкенда
+
+    Args:
+        backend: MemoryBackend или SQLiteBackend
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        # Метрики
+        self.checks = 0
+        self.rejected = 0
+        self.errors = 0
+
+    async def check(self, key: str, limit: RateLimit, cost: float = 1, detail: str = "Слишком много запросов. Попробуйте позже") -> None:
+        """
+        Списывает cost токенов из корзины key
+
+        Raises:
+            RateLimitExceeded: Токенов не хватает
+        """
+        self.checks += 1
+        cost = min(cost, limit.capacity)
+        try:
+            if self.backend.blocking:
+                allowed, tokens = await asyncio.to_thread(self.backend.hit, key, limit, cost, time.time())
+            else:
+                allowed, tokens = self.backend.hit(key, limit, cost, time.time())
+        except sqlite3.Error as e:
+            # Хранилище лимитов недоступно - не отказываем всем запросам из-за него
+            self.errors += 1
+            print(f"[rate-limit] Check skipped for {key}: {e}")
+            return
+        if not allowed:
+            self.rejected += 1
+            raise RateLimitExceeded((cost - tokens) / limit.rate, detail)
+
+    def purge(self) -> int:
+        """Удаляет давно не используемые корзины"""
+        return self.backend.purge(time.time() - RATE_LIMIT_IDLE_SECONDS)
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend.name,
+            "checks": self.checks,
+            "rejected": self.rejected,
+            "errors": self.errors,
+        }
+
+
+def client_address(request: Request) -> str:
+    """IP клиента (как get_remote_address в slowapi)"""
+    return request.client.host if request.client else "127.0.0.1"
+
+
+def create_backend(name: str = RATE_LIMIT_BACKEND):
+    if name == "memory":
+        return MemoryBackend()
+    if name == "sqlite":
+        return SQLiteBackend(RATE_LIMIT_DB)
+    raise ValueError(f"Unknown rate limit backend: {name}")
+
+
+# Лимитер приложения
+rate_limiter = RateLimiter(create_backend())
+
+
+def limit_per_establishment(scope: str, limit: RateLimit, detail: str) -> Callable:
+    """
+    Зависимость FastAPI: лимит на заведение из токена (scope - имя корзины)
+
+    Пример: dependencies=[Depends(limit_per_establishment("upload", UPLOAD_RATE_LIMIT, "..."))]
+    """
+    async def dependency(current_establishment: TokenClaims = Depends(get_current_principal)) -> None:
+        await rate_limiter.check(f"{scope}:establishment:{current_establishment.id}", limit, detail=detail)
+
+    return dependency
+
+
+def limit_per_ip(scope: str, limit: RateLimit, detail: str) -> Callable:
+    """
+    Зависимость FastAPI: лимит на IP клиента (для запросов без токена)
+
+    Пример: dependencies=[Depends(limit_per_ip("reset-password", RESET_PASSWORD_RATE_LIMIT, "..."))]
+    """
+    async def dependency(request: Request) -> None:
+        await rate_limiter.check(f"{scope}:ip:{client_address(request)}", limit, detail=detail)
+
+    return dependency
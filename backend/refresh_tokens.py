@@ -0,0 +1,161 @@
+"""
+Refresh-токены
+
+Вход выдает пару: короткий access-токен (JWT, см. auth.py) и refresh-токен -
+случайную строку, которой клиент получает новую пару (POST /api/auth/refresh).
+В БД хранится только SHA-256 от refresh-токена.
+
+Токен одноразовый: при обмене он помечается замененным (rotated_at), а новый
+получает тот же family_id - цепочку одного входа. Если замененный токен
+предъявили еще раз, значит его копия у кого-то другого: отзывается вся
+цепочка, и заодно (через sid в revocation_list) все ее access-токены.
+
+Истекшие refresh-токены и записи revoked_tokens удаляет периодическая задача
+purge_auth_tokens.
+"""
+import hashlib
+import os
+import secrets
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Optional, Tuple
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import Session
+
+from auth import ACCESS_TOKEN_EXPIRE_MINUTES, credentials_exception
+from database import RefreshToken, SessionLocal
+from token_revocation import revocation_list
+
+# Время жизни refresh-токена (дни): столько можно не вводить пароль
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+
+# Сколько токенов удалять одной транзакцией
+REFRESH_TOKEN_PURGE_BATCH = int(os.getenv("REFRESH_TOKEN_PURGE_BATCH", "1000"))
+
+
+def _hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _revoke_access(db: Session, family_id: str) -> None:
+    """Отзывает access-токены цепочки: последний из них истечет не позже чем через TTL"""
+    revocation_list.revoke(db, family_id, datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+
+
+def issue_refresh_token(db: Session, establishment_id: int, family_id: str = None) -> Tuple[str, RefreshToken]:
+    """
+    Создает refresh-токен в текущей транзакции (коммит делает вызывающий код)
+
+    Args:
+        establishment_id: ID заведения
+        family_id: Цепочка, которую продолжает токен (None - новый вход)
+
+    Returns:
+        (токен для клиента, строка БД)
+    """
+    now = datetime.utcnow()
+    token = secrets.token_urlsafe(32)
+    row = RefreshToken(
+        token_hash=_hash(token),
+        family_id=family_id or uuid.uuid4().hex,
+        establishment_id=establishment_id,
+        created_at=now,
+        expires_at=now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    )
+    db.add(row)
+    return token, row
+
+
+def rotate_refresh_token(db: Session, token: str) -> Tuple[Optional[str], RefreshToken]:
+    """
+    Обменивает refresh-токен на новый из той же цепочки (коммит делает вызывающий код)
+
+    Повторное предъявление уже обмененного токена отзывает всю цепочку и
+    возвращает (None, row): отзыв нужно закоммитить, а затем ответить 401.
+
+    Raises:
+        HTTPException: 401 - токен неизвестен, истек или отозван
+    """
+    now = datetime.utcnow()
+    row = db.execute(
+        select(RefreshToken).where(RefreshToken.token_hash == _hash(token))
+    ).scalars().first()
+    if row is None or row.revoked_at is not None or row.expires_at <= now:
+        raise credentials_exception()
+
+    # Compare-and-set: из двух одновременных обменов одного токена проходит один
+    claimed = db.execute(
+        update(RefreshToken)
+        .where(RefreshToken.id == row.id, RefreshToken.rotated_at.is_(None))
+        .values(rotated_at=now)
+    ).rowcount
+    if not claimed:
+        print(f"[auth] Refresh token reuse detected, revoking session {row.family_id} "
+              f"of establishment_id {row.establishment_id}")
+        revoke_family(db, row.family_id)
+        return None, row
+
+    return issue_refresh_token(db, row.establishment_id, row.family_id)
+
+
+def revoke_family(db: Session, family_id: str) -> None:
+    """Выход: отзывает цепочку refresh-токенов и ее access-токены (коммит делает вызывающий код)"""
+    db.execute(
+        update(RefreshToken)
+        .where(RefreshToken.family_id == family_id, RefreshToken.revoked_at.is_(None))
+        .values(revoked_at=datetime.utcnow())
+    )
+    _revoke_access(db, family_id)
+
+
+def revoke_establishment_sessions(db: Session, establishment_id: int) -> int:
+    """
+    Отзывает все входы заведения (после смены пароля), коммит делает вызывающий код
+
+    Returns:
+        Количество отозванных цепочек
+    """
+    now = datetime.utcnow()
+    family_ids = db.execute(
+        select(RefreshToken.family_id).where(
+            RefreshToken.establishment_id == establishment_id,
+            RefreshToken.revoked_at.is_(None),
+            RefreshToken.expires_at > now
+        ).distinct()
+    ).scalars().all()
+    for family_id in family_ids:
+        revoke_family(db, family_id)
+    return len(family_ids)
+
+
+def purge_auth_tokens(
+    session_factory: Callable[[], Session] = SessionLocal,
+    batch_size: int = REFRESH_TOKEN_PURGE_BATCH,
+    pause: float = 0.05
+) -> int:
+    """
+    Удаляет истекшие refresh-токены пачками и истекшие записи списка отзыва
+
+    Returns:
+        Количество удаленных refresh-токенов
+    """
+    cutoff = datetime.utcnow()
+    removed = 0
+    while True:
+        # Сессия на пачку: между пачками соединение писателя свободно
+        with session_factory() as db:
+            ids = select(RefreshToken.id).where(
+                RefreshToken.expires_at < cutoff
+            ).order_by(RefreshToken.expires_at).limit(batch_size)
+            result = db.execute(delete(RefreshToken).where(RefreshToken.id.in_(ids)))
+            db.commit()
+        removed += result.rowcount
+        if result.rowcount < batch_size:
+            break
+        time.sleep(pause)
+    revoked = revocation_list.purge(session_factory)
+    if removed or revoked:
+        print(f"[auth-tokens] Purged {removed} expired refresh token(s), {revoked} revocation(s)")
+    return removed
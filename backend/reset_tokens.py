@@ -0,0 +1,161 @@
+"""
+Токены восстановления пароля
+
+Код - 6 цифр (так его вводит фронтенд). Коды не выбираются случайно с
+повтором при совпадении, а получаются из счетчика выдач ключевой перестановкой
+множества 000000..999999 (сеть Фейстеля, ключ выводится из SECRET_KEY):
+миллион подряд идущих выдач дают миллион разных кодов, поэтому действующие
+коды не совпадают, пока за время жизни токена их выдано меньше миллиона.
+Счетчик хранится в maintenance_state и увеличивается в той же транзакции.
+Соседние коды по своим выдачам не угадать без ключа; перебор кодов
+ограничивает лимит запросов на /api/auth/reset-password.
+
+Истекшие и использованные токены удаляет периодическая задача purge_reset_tokens
+пачками по индексу expires_at (использованный токен сразу получает
+expires_at = время использования).
+"""
+import hashlib
+import hmac
+import os
+import time
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Callable, List
+
+from sqlalchemy import Integer, Text, cast, delete, or_, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from auth import SECRET_KEY
+from database import MaintenanceState, PasswordResetToken, SessionLocal
+
+# Время жизни токена
+RESET_TOKEN_TTL = timedelta(hours=1)
+
+# Сколько хранить истекший или использованный токен перед удалением
+# (чтобы сброс повторным кодом получил понятную ошибку, а не "неверный токен")
+RESET_TOKEN_RETENTION = timedelta(minutes=int(os.getenv("RESET_TOKEN_RETENTION_MINUTES", "10")))
+
+# Сколько токенов удалять одной транзакцией
+RESET_TOKEN_PURGE_BATCH = int(os.getenv("RESET_TOKEN_PURGE_BATCH", "1000"))
+
+TOKEN_DIGITS = 6
+
+# Код - пара половин по 3 цифры, которые перемешивает сеть Фейстеля
+HALF_MODULUS = 10 ** (TOKEN_DIGITS // 2)
+FEISTEL_ROUNDS = 8
+
+COUNTER_KEY = "reset_tokens.counter"
+
+# Ключ перестановки: отдельный от подписи JWT, но выводится из того же секрета
+PERMUTATION_KEY = hmac.new(SECRET_KEY.encode(), b"password-reset-code", hashlib.sha256).digest()
+
+
+@lru_cache(maxsize=4)
+def _round_table(key: bytes) -> List[List[int]]:
+    """Значения раундовой функции для всех половин (8 x 1000 HMAC на ключ)"""
+    return [
+        [
+            int.from_bytes(
+                hmac.new(key, bytes([round_number]) + half.to_bytes(2, "big"), hashlib.sha256).digest()[:8], "big"
+            ) % HALF_MODULUS
+            for half in range(HALF_MODULUS)
+        ]
+        for round_number in range(FEISTEL_ROUNDS)
+    ]
+
+
+def permute_code(number: int, key: bytes = PERMUTATION_KEY) -> str:
+    """
+    Номер выдачи -> код из TOKEN_DIGITS цифр
+
+    Перестановка: разные номера из 0..10**TOKEN_DIGITS-1 дают разные коды.
+    """
+    left, right = divmod(number % (HALF_MODULUS * HALF_MODULUS), HALF_MODULUS)
+    for round_values in _round_table(key):
+        left, right = right, (left + round_values[right]) % HALF_MODULUS
+    return f"{left * HALF_MODULUS + right:0{TOKEN_DIGITS}d}"
+
+
+def next_code(db: Session, now: datetime) -> str:
+    """Увеличивает счетчик выдач в текущей транзакции и возвращает код для него"""
+    counter = db.execute(
+        sqlite_insert(MaintenanceState)
+        .values(name=COUNTER_KEY, value="0", updated_at=now)
+        .on_conflict_do_update(
+            index_elements=["name"],
+            set_={"value": cast(cast(MaintenanceState.value, Integer) + 1, Text), "updated_at": now}
+        )
+        .returning(MaintenanceState.value)
+    ).scalar()
+    return permute_code(int(counter))
+
+
+def issue_reset_token(db: Session, establishment_id: int) -> PasswordResetToken:
+    """
+    Создает токен в текущей транзакции (коммит делает вызывающий код)
+
+    Raises:
+        RuntimeError: код еще занят действующим токеном (за время жизни токена
+            выдан миллион кодов и счетчик пошел по кругу)
+    """
+    now = datetime.utcnow()
+    token = next_code(db, now)
+    # Тот же код остался от токена предыдущего круга счетчика, если очистка еще не дошла
+    db.execute(
+        delete(PasswordResetToken).where(
+            PasswordResetToken.token == token,
+            or_(PasswordResetToken.used == True, PasswordResetToken.expires_at < now)
+        )
+    )
+    token_id = db.execute(
+        sqlite_insert(PasswordResetToken)
+        .values(
+            token=token,
+            establishment_id=establishment_id,
+            created_at=now,
+            expires_at=now + RESET_TOKEN_TTL,
+            used=False
+        )
+        .on_conflict_do_nothing(index_elements=["token"])
+        .returning(PasswordResetToken.id)
+    ).scalar()
+    if token_id is None:
+        raise RuntimeError("Password reset code is still in use by an active token")
+    return db.get(PasswordResetToken, token_id)
+
+
+def mark_used(reset_token: PasswordResetToken) -> None:
+    """Токен использован: он больше не действует и попадет под ближайшую очистку"""
+    reset_token.used = True
+    reset_token.expires_at = min(reset_token.expires_at, datetime.utcnow())
+
+
+def purge_reset_tokens(
+    session_factory: Callable[[], Session] = SessionLocal,
+    batch_size: int = RESET_TOKEN_PURGE_BATCH,
+    pause: float = 0.05
+) -> int:
+    """
+    Удаляет истекшие и использованные токены пачками
+
+    Returns:
+        Количество удаленных токенов
+    """
+    cutoff = datetime.utcnow() - RESET_TOKEN_RETENTION
+    removed = 0
+    while True:
+        # Сессия на пачку: между пачками соединение писателя свободно
+        with session_factory() as db:
+            ids = select(PasswordResetToken.id).where(
+                PasswordResetToken.expires_at < cutoff
+            ).order_by(PasswordResetToken.expires_at).limit(batch_size)
+            result = db.execute(delete(PasswordResetToken).where(PasswordResetToken.id.in_(ids)))
+            db.commit()
+        removed += result.rowcount
+        if result.rowcount < batch_size:
+            break
+        time.sleep(pause)
+    if removed:
+        print(f"[reset-tokens] Purged {removed} expired or used token(s)")
+    return removed
@@ -70,10 +70,24 @@ class EstablishmentResponse(BaseModel):
 
 
 class EstablishmentRegistrationResponse(BaseModel):
-    """Ответ при регистрации - включает заведение и токен"""
+    """Ответ при регистрации - включает заведение и токены"""
     establishment: EstablishmentResponse
     access_token: str
+    refresh_token: str
     token_type: str = "bearer"
+    expires_in: int  # Время жизни access-токена (секунды)
+
+
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
+
+
+class TokenResponse(BaseModel):
+    """Новая пара токенов (refresh-токен одноразовый)"""
+    access_token: str
+    refresh_token: str
+    token_type: str = "bearer"
+    expires_in: int
 
 
 class DocumentResponse(BaseModel):
@@ -112,3 +126,22 @@ class ResetPasswordRequest(BaseModel):
 class ResetPasswordResponse(BaseModel):
     message: str
 
+
+
+class UploadSessionCreate(BaseModel):
+    """Создание сессии возобновляемой загрузки"""
+    establishment_id: int
+    document_type: str
+    file_name: str
+    file_size: int
+
+
+class UploadSessionResponse(BaseModel):
+    upload_id: str
+    establishment_id: int
+    document_type: str
+    file_name: str
+    file_size: int
+    offset: int  # Сколько байт уже принято
+    complete: bool
+    expires_at: datetime
@@ -0,0 +1,154 @@
+"""
+Контентно-адресуемое хранилище загруженных файлов
+
+Одинаковые файлы (одна и та же выписка ЕГРЮЛ, реквизиты юр. лица для нескольких
+заведений) хранятся на диске один раз. Ключ - SHA-256 содержимого, который
+считается во время потоковой загрузки. Таблица file_blobs хранит счетчик ссылок;
+файл, на который не ссылается ни один документ, удаляет сборщик мусора (file_gc.py).
+Файловые операции выполняются только после коммита транзакции, которая их вызвала.
+
+Новые файлы раскладываются по двухуровневому хешированному дереву каталогов
+(ab/cd/имя_файла), чтобы ни в одном каталоге не копились сотни тысяч файлов.
+"""
+import hashlib
+import os
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from database import FileBlob, run_after_commit
+from thumbnails import thumbnail_paths
+
+# Каталог для хранения загруженных файлов
+UPLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads")
+
+# Сессии возобновляемой загрузки хранятся рядом с UPLOAD_DIR
+UPLOAD_SESSIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "upload_sessions")
+
+
+def sharded_path(root: str, filename: str, key: Optional[str] = None) -> str:
+    """
+    Путь к файлу в хешированном дереве каталогов: root/ab/cd/filename
+
+    Args:
+        root: Корневой каталог
+        filename: Имя файла
+        key: Hex-строка, по которой выбирается каталог (по умолчанию - SHA-1 имени файла)
+    """
+    if key is None:
+        key = hashlib.sha1(filename.encode("utf-8")).hexdigest()
+    return os.path.join(root, key[0:2], key[2:4], filename)
+
+
+class BlobStore:
+    """
+    Хранилище файлов с дедупликацией по SHA-256 и подсчетом ссылок
+
+    Args:
+        root: Каталог для файлов хранилища (на той же ФС, что и временные файлы загрузок)
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def blob_path(self, sha256: str, ext: str) -> str:
+        """Путь к файлу по его хешу (расширение нужно для корректного Content-Type)"""
+        return sharded_path(self.root, f"{sha256}{ext.lower()}", key=sha256)
+
+    def put(self, db: Session, temp_path: str, sha256: str, size: int, ext: str) -> str:
+        """
+        Кладет файл в хранилище и добавляет на него ссылку
+
+        Если такое содержимое уже есть - временный файл удаляется, а счетчик
+        ссылок увеличивается. Изменения в БД попадают в текущую транзакцию,
+        коммит делает вызывающий код вместе с записью Document; файл
+        переносится (или временный удаляется) только после этого коммита.
+
+        Returns:
+            Путь к файлу в хранилище (его и нужно записать в Document.file_path)
+        """
+        db.execute(
+            sqlite_insert(FileBlob)
+            .values(
+                sha256=sha256,
+                file_path=self.blob_path(sha256, ext),
+                size=size,
+                ref_count=0,
+                created_at=datetime.utcnow()
+            )
+            .on_conflict_do_nothing(index_elements=["sha256"])
+        )
+        blob = self._add_ref(db, sha256)
+        file_path = blob.file_path
+
+        # Файл переносится только после коммита: при откате (и повторе записи
+        # очередью write_queue) временный файл должен остаться на месте
+        def move_into_place():
+            if os.path.exists(file_path):
+                # Такое содержимое уже лежит в хранилище
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                os.replace(temp_path, file_path)
+
+        run_after_commit(db, move_into_place)
+        return file_path
+
+    def release(self, db: Session, file_path: Optional[str]) -> None:
+        """
+        Убирает одну ссылку на файл
+
+        Файл без ссылок остается на диске до сборщика мусора (file_gc.sweep_stale_blobs):
+        удалять его здесь нельзя - транзакция еще может откатиться, а put()
+        того же содержимого после коммита рассчитывает, что файл на месте.
+        Файлы, сохраненные до появления хранилища, удаляются после коммита вместе
+        с миниатюрами; миниатюры файла хранилища удаляет сборщик мусора вместе с ним.
+        """
+        if not file_path:
+            return
+
+        blob = db.query(FileBlob).filter(FileBlob.file_path == file_path).first()
+        if blob is None:
+            run_after_commit(db, lambda: remove_file(file_path))
+            return
+
+        db.execute(
+            update(FileBlob)
+            .where(FileBlob.sha256 == blob.sha256, FileBlob.ref_count > 0)
+            .values(ref_count=FileBlob.ref_count - 1)
+        )
+
+    def _add_ref(self, db: Session, sha256: str) -> FileBlob:
+        """Увеличивает счетчик ссылок файла"""
+        db.execute(
+            update(FileBlob)
+            .where(FileBlob.sha256 == sha256)
+            .values(ref_count=FileBlob.ref_count + 1)
+        )
+        return db.query(FileBlob).filter(FileBlob.sha256 == sha256).populate_existing().first()
+
+
+def remove_file(file_path: str) -> int:
+    """
+    Удаляет файл с диска вместе с его миниатюрами, не прерывая запрос при ошибке
+
+    Returns:
+        Сколько байт освобождено
+    """
+    if not file_path:
+        return 0
+    freed = 0
+    for path in [file_path] + thumbnail_paths(file_path):
+        if os.path.exists(path):
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                freed += size
+            except OSError as e:
+                print(f"Error deleting file {path}: {e}")
+    return freed
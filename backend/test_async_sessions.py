@@ -0,0 +1,144 @@
+"""
+Асинхронные сессии (database.py, auth.py): зависимость пула чтения и
+зависимости авторизации поверх нее
+
+База - SQLite во временном файле через aiosqlite, с профилями соединений
+из database.py. Сервер не нужен.
+"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import auth
+import database
+from auth import create_access_token, get_current_establishment_async, get_current_principal
+from database import Base, Establishment, apply_sqlite_profile
+from principal_cache import PrincipalCache
+from token_revocation import RevocationList
+
+
+def make_establishment(**overrides) -> Establishment:
+    values = dict(id=1, name="Test", username="test", password="x", position="owner",
+                  phone="+79990000000", email="test@test.com", business_name="Test",
+                  business_type="bar", address="Test", inn="7700000000", ogrn="1027700000000",
+                  status="draft")
+    values.update(overrides)
+    return Establishment(**values)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = tmp_path / "ebar.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add(make_establishment())
+    session.commit()
+    session.close()
+    engine.dispose()
+    return path
+
+
+@pytest.fixture
+def revocations(db_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{db_path}")
+    revocation_list = RevocationList(sessionmaker(bind=engine))
+    monkeypatch.setattr(auth, "revocation_list", revocation_list)
+    monkeypatch.setattr(auth, "principal_cache", PrincipalCache())
+    yield revocation_list
+    engine.dispose()
+
+
+def run_with_read_session(db_path, monkeypatch, scenario):
+    """Выполняет scenario(db) в сессии get_async_read_db, подключенной к временной БД"""
+    async def run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        apply_sqlite_profile(engine.sync_engine, read_only=True)
+        factory = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+        monkeypatch.setattr(database, "AsyncReadSessionLocal", factory)
+        monkeypatch.setattr(auth, "AsyncReadSessionLocal", factory)
+        dependency = database.get_async_read_db()
+        db = await dependency.__anext__()
+        try:
+            return await scenario(db)
+        finally:
+            await dependency.aclose()
+            await engine.dispose()
+
+    return asyncio.run(run())
+
+
+def test_read_session_reads(db_path, monkeypatch):
+    async def scenario(db):
+        return (await db.execute(select(Establishment.username))).scalar_one()
+
+    assert run_with_read_session(db_path, monkeypatch, scenario) == "test"
+
+
+def test_read_session_cannot_write(db_path, monkeypatch):
+    async def scenario(db):
+        db.add(make_establishment(id=2, username="other", email="other@test.com"))
+        await db.flush()
+
+    with pytest.raises(OperationalError, match="readonly"):
+        run_with_read_session(db_path, monkeypatch, scenario)
+
+
+def test_principal_from_claims_without_db(revocations, monkeypatch):
+    # Пул чтения не нужен: токен не отозван, фильтр его не знает
+    monkeypatch.setattr(auth, "AsyncReadSessionLocal", None)
+    token = create_access_token(make_establishment(), "family")
+
+    claims = asyncio.run(get_current_principal(token))
+
+    assert (claims.id, claims.status, claims.business_type) == (1, "draft", "bar")
+
+
+def test_revoked_session_rejected(db_path, revocations, monkeypatch):
+    token = create_access_token(make_establishment(), "family")
+    db = revocations.session_factory()
+    revocations.revoke(db, "family", datetime.utcnow() + timedelta(days=1))
+    db.commit()
+    db.close()
+
+    async def scenario(read_db):
+        with pytest.raises(HTTPException) as principal_error:
+            await get_current_principal(token)
+        with pytest.raises(HTTPException) as establishment_error:
+            await get_current_establishment_async(token, read_db)
+        return principal_error.value.status_code, establishment_error.value.status_code
+
+    assert run_with_read_session(db_path, monkeypatch, scenario) == (401, 401)
+
+
+def test_establishment_loaded_once_then_cached(db_path, revocations, monkeypatch):
+    token = create_access_token(make_establishment(), "family")
+
+    async def scenario(db):
+        first = await get_current_establishment_async(token, db)
+        # Вторая проверка того же токена берет строку из кеша, а не из сессии
+        second = await get_current_establishment_async(token, None)
+        return first, second
+
+    first, second = run_with_read_session(db_path, monkeypatch, scenario)
+
+    assert first is second
+    assert (first.id, first.username) == (1, "test")
+    assert auth.principal_cache.stats()["hits"] == 1
+
+
+def test_unknown_establishment_rejected(db_path, revocations, monkeypatch):
+    token = create_access_token(make_establishment(id=42), "family")
+
+    async def scenario(db):
+        with pytest.raises(HTTPException) as error:
+            await get_current_establishment_async(token, db)
+        return error.value.status_code
+
+    assert run_with_read_session(db_path, monkeypatch, scenario) == 401
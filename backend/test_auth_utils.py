@@ -0,0 +1,77 @@
+"""
+Хеширование паролей (auth_utils.py): подбор стоимости bcrypt и пересчет
+хешей только в сторону усиления
+
+Сервер не нужен; bcrypt вызывается только с минимальной стоимостью.
+"""
+import pytest
+
+import auth_utils
+
+
+@pytest.mark.parametrize("measured_ms, target_ms, rounds", [
+    # Замер на 10 раундах; каждая единица стоимости удваивает время
+    (15, 250, 14),
+    (60, 250, 12),
+    (125, 250, 11),
+    (126, 250, 10),
+    # Медленнее цели уже на минимальной стоимости - остается минимальная
+    (400, 250, 10),
+    # Быстрое железо упирается в верхнюю границу
+    (0.1, 250, 16),
+])
+def test_rounds_for_target(measured_ms, target_ms, rounds):
+    assert auth_utils.rounds_for_target(measured_ms, target_ms) == rounds
+
+
+def test_rounds_from_other_measured_cost():
+    assert auth_utils.rounds_for_target(60, 250, measured_rounds=12) == 14
+
+
+def test_low_cost_logged_with_measured_latency(monkeypatch, capsys):
+    monkeypatch.setattr(auth_utils, "measure_hash_ms", lambda rounds: 100.0)
+
+    assert auth_utils.calibrate_rounds(250) == 11
+
+    output = capsys.readouterr().out
+    assert "measured 100 ms at 10 rounds" in output
+    assert "WARNING: bcrypt cost 11 is below 12" in output
+    assert "~400 ms" in output
+
+
+def test_recommended_cost_not_warned(monkeypatch, capsys):
+    monkeypatch.setattr(auth_utils, "measure_hash_ms", lambda rounds: 30.0)
+
+    assert auth_utils.calibrate_rounds(250) == 13
+    assert "WARNING" not in capsys.readouterr().out
+
+
+def test_hash_rounds():
+    assert auth_utils.hash_rounds("$2b$12$" + "a" * 53) == 12
+    assert auth_utils.hash_rounds("plain-text") is None
+
+
+@pytest.mark.parametrize("stored_rounds, current_rounds, expected", [
+    (10, 12, True),
+    (12, 12, False),
+    # Сервер откалибровался ниже - сохраненные хеши не ослабляются
+    (14, 11, False),
+])
+def test_needs_rehash_only_upward(monkeypatch, stored_rounds, current_rounds, expected):
+    monkeypatch.setattr(auth_utils, "_rounds", current_rounds)
+    assert auth_utils.needs_rehash(f"$2b${stored_rounds:02d}$" + "a" * 53) is expected
+
+
+def test_unknown_hash_format_not_rehashed(monkeypatch):
+    monkeypatch.setattr(auth_utils, "_rounds", 12)
+    assert auth_utils.needs_rehash("plain-text") is False
+
+
+def test_hash_uses_current_rounds(monkeypatch):
+    monkeypatch.setattr(auth_utils, "_rounds", auth_utils.BCRYPT_MIN_ROUNDS)
+
+    hashed = auth_utils.hash_password("secret")
+
+    assert auth_utils.hash_rounds(hashed) == auth_utils.BCRYPT_MIN_ROUNDS
+    assert auth_utils.verify_password("secret", hashed)
+    assert not auth_utils.needs_rehash(hashed)
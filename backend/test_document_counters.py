@@ -0,0 +1,135 @@
+"""
+Счетчики документов (database.update_document_counters, document_stats.py):
+поддержка document_counters при каждом flush и точный пересчет
+
+База - SQLite в памяти. Сервер не нужен.
+"""
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from database import Base, Document
+from document_stats import (
+    aggregate_queries, counters_need_rebuild, counters_query, rebuild_document_counters, stats_from_counts
+)
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def add_document(db, establishment_id=1, status="pending", verification_status="verified") -> Document:
+    document = Document(establishment_id=establishment_id, document_group="founding", document_type="charter",
+                        document_name="Устав", status=status, verification_status=verification_status)
+    db.add(document)
+    return document
+
+
+def counters(db, establishment_id=1) -> dict:
+    return stats_from_counts(db.execute(counters_query(establishment_id)).all())
+
+
+def recount(db, establishment_id=1) -> dict:
+    rows = [row[1:] for query in aggregate_queries(establishment_id) for row in db.execute(query)]
+    return stats_from_counts(rows)
+
+
+def test_insert_counted(db):
+    add_document(db, verification_status="update_required")
+    add_document(db, status="verified")
+    add_document(db, establishment_id=2)
+    db.commit()
+
+    assert counters(db) == {"total": 2, "pending": 1, "verified": 1, "rejected": 0,
+                            "verification_status": {"verified": 1, "update_required": 1}}
+    assert counters(db, 2)["total"] == 1
+    assert counters(db) == recount(db)
+
+
+def test_status_change_moves_count(db):
+    document = add_document(db)
+    db.commit()
+
+    # После коммита объект просрочен: прежнее значение еще не загружено
+    document.status = "rejected"
+    document.verification_status = "expired"
+    db.commit()
+
+    assert counters(db) == {"total": 1, "pending": 0, "verified": 0, "rejected": 1,
+                            "verification_status": {"expired": 1}}
+    assert counters(db) == recount(db)
+
+
+def test_same_value_assignment_not_counted(db):
+    document = add_document(db)
+    db.commit()
+
+    document.status = "pending"
+    db.commit()
+
+    assert counters(db)["pending"] == 1
+
+
+def test_several_flushes_in_one_transaction(db):
+    document = add_document(db)
+    db.flush()
+    document.status = "verified"
+    db.flush()
+    document.status = "rejected"
+    db.commit()
+
+    assert counters(db) == recount(db)
+    assert counters(db)["rejected"] == 1
+
+
+def test_delete_counted(db):
+    document = add_document(db, status="verified")
+    add_document(db, verification_status="invalid")
+    db.commit()
+
+    db.delete(document)
+    db.commit()
+
+    assert counters(db) == {"total": 1, "pending": 1, "verified": 0, "rejected": 0,
+                            "verification_status": {"invalid": 1}}
+
+
+def test_rollback_discards_counter_changes(db):
+    add_document(db)
+    db.commit()
+
+    add_document(db)
+    db.flush()
+    db.rollback()
+
+    assert counters(db)["total"] == 1
+
+
+def test_rebuild_matches_maintained_counters(db):
+    for status in ("pending", "verified", "verified", "rejected"):
+        add_document(db, status=status)
+    db.commit()
+    maintained = counters(db)
+
+    assert not counters_need_rebuild(db)
+    rebuild_document_counters(db)
+
+    assert counters(db) == maintained
+
+
+def test_rebuild_needed_when_counters_missing(db):
+    add_document(db)
+    db.commit()
+    db.execute(Base.metadata.tables["document_counters"].delete())
+    db.commit()
+
+    assert counters_need_rebuild(db)
+    rebuild_document_counters(db)
+    assert counters(db)["total"] == 1
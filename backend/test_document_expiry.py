@@ -0,0 +1,149 @@
+"""
+Сроки действия документов (document_expiry.py): переходы по порогам,
+водяной знак между запусками, пачки, счетчики и пробный запуск
+
+База - SQLite в памяти. Сервер не нужен.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import document_expiry
+from database import Base, Document, MaintenanceState
+from document_expiry import EXPIRED_STATUS, WARNING_STATUS, apply_expiry, check_expiry, run_expiry_check
+from document_stats import aggregate_queries, counters_query, stats_from_counts
+
+NOW = datetime(2024, 6, 1, 12, 0)
+
+
+@pytest.fixture
+def session_factory(monkeypatch):
+    monkeypatch.setattr(document_expiry, "EXPIRY_WARNING_DAYS", 7)
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def db(session_factory):
+    session = session_factory()
+    yield session
+    session.close()
+
+
+def add_document(db, expiry_date, verification_status="verified") -> int:
+    document = Document(establishment_id=1, document_group="licenses", document_type="license",
+                        document_name="Лицензия", expiry_date=expiry_date, verification_status=verification_status)
+    db.add(document)
+    db.commit()
+    return document.id
+
+
+def statuses(db) -> dict:
+    db.expire_all()
+    return {document.id: document.verification_status for document in db.query(Document)}
+
+
+def test_first_run_applies_both_thresholds(db):
+    expired = add_document(db, NOW - timedelta(days=30))
+    expired_rejected = add_document(db, NOW - timedelta(days=1), "update_required")
+    soon = add_document(db, NOW + timedelta(days=3))
+    soon_not_verified = add_document(db, NOW + timedelta(days=3), "update_required")
+    later = add_document(db, NOW + timedelta(days=30))
+    no_date = add_document(db, None)
+
+    report = check_expiry(db, NOW)
+
+    assert (report["expired"], report["warned"]) == (2, 1)
+    assert statuses(db) == {
+        expired: EXPIRED_STATUS,
+        expired_rejected: EXPIRED_STATUS,
+        soon: WARNING_STATUS,
+        soon_not_verified: "update_required",
+        later: "verified",
+        no_date: "verified",
+    }
+
+
+def test_next_run_only_handles_new_crossings(db):
+    later = add_document(db, NOW + timedelta(days=10))
+    check_expiry(db, NOW)
+    assert statuses(db)[later] == "verified"
+
+    # Через 5 дней документ вошел в окно предупреждения, еще через 6 - истек
+    report = check_expiry(db, NOW + timedelta(days=5))
+    assert (report["warned"], report["expired"]) == (1, 0)
+    assert statuses(db)[later] == WARNING_STATUS
+
+    report = check_expiry(db, NOW + timedelta(days=11))
+    assert (report["warned"], report["expired"]) == (0, 1)
+    assert statuses(db)[later] == EXPIRED_STATUS
+
+
+def test_watermark_saved_and_rerun_is_noop(db):
+    add_document(db, NOW - timedelta(days=1))
+    check_expiry(db, NOW)
+
+    assert db.get(MaintenanceState, document_expiry.WATERMARK_KEY).value == NOW.isoformat()
+    report = check_expiry(db, NOW)
+    assert (report["warned"], report["expired"]) == (0, 0)
+
+
+def test_dry_run_changes_nothing(db):
+    document_id = add_document(db, NOW - timedelta(days=1))
+
+    report = check_expiry(db, NOW, dry_run=True)
+
+    assert report["expired"] == 1
+    assert statuses(db)[document_id] == "verified"
+    assert db.get(MaintenanceState, document_expiry.WATERMARK_KEY) is None
+
+
+def test_small_batches_cover_all_documents(db, monkeypatch):
+    monkeypatch.setattr(document_expiry, "EXPIRY_BATCH_SIZE", 2)
+    # Одинаковые даты: пачки идут по (expiry_date, id) и не теряют строки на границе
+    ids = [add_document(db, NOW - timedelta(days=1)) for _ in range(5)]
+
+    assert check_expiry(db, NOW)["expired"] == 5
+    assert all(statuses(db)[document_id] == EXPIRED_STATUS for document_id in ids)
+
+
+def test_counters_follow_bulk_update(db):
+    add_document(db, NOW - timedelta(days=1))
+    add_document(db, NOW + timedelta(days=3))
+    add_document(db, NOW + timedelta(days=30))
+
+    check_expiry(db, NOW)
+
+    maintained = stats_from_counts(db.execute(counters_query(1)).all())
+    recount = stats_from_counts([row[1:] for query in aggregate_queries(1) for row in db.execute(query)])
+    assert maintained == recount
+    assert maintained["verification_status"] == {EXPIRED_STATUS: 1, WARNING_STATUS: 1, "verified": 1}
+
+
+def test_run_expiry_check_uses_own_session(session_factory, db):
+    document_id = add_document(db, datetime.utcnow() - timedelta(days=1))
+
+    report = run_expiry_check(session_factory)
+
+    assert report["expired"] == 1
+    assert statuses(db)[document_id] == EXPIRED_STATUS
+
+
+@pytest.mark.parametrize("expiry_days, status, expected", [
+    (-1, "update_required", EXPIRED_STATUS),
+    (3, "verified", WARNING_STATUS),
+    (3, "update_required", "update_required"),
+    (30, "verified", "verified"),
+])
+def test_apply_expiry(monkeypatch, expiry_days, status, expected):
+    monkeypatch.setattr(document_expiry, "EXPIRY_WARNING_DAYS", 7)
+    document = Document(expiry_date=NOW + timedelta(days=expiry_days), verification_status=status)
+
+    apply_expiry(document, NOW)
+
+    assert document.verification_status == expected
@@ -0,0 +1,132 @@
+"""
+Постраничная выдача документов (document_listing.py): курсор по
+(uploaded_at, id), в том числе с NULL uploaded_at, и проекция fields=
+
+База - SQLite во временном файле через aiosqlite. Сервер не нужен.
+"""
+import asyncio
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, Document
+from document_listing import decode_cursor, encode_cursor, list_documents_page, parse_fields
+
+DAY_1, DAY_2 = datetime(2024, 1, 1, 12, 0), datetime(2024, 1, 2, 12, 0)
+
+# (uploaded_at, document_group): не загруженные (NULL), одинаковые и разные даты
+DOCUMENTS = [
+    (DAY_2, "founding"), (None, "founding"), (DAY_1, "licenses"), (None, "licenses"),
+    (DAY_1, "founding"), (DAY_2, "licenses"), (None, "founding"),
+]
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = tmp_path / "ebar.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    for uploaded_at, group in DOCUMENTS:
+        session.add(Document(establishment_id=1, document_group=group, document_type="charter",
+                             document_name="Устав", uploaded_at=uploaded_at, uploaded=uploaded_at is not None))
+    # Документ другого заведения не должен попасть в выдачу
+    session.add(Document(establishment_id=2, document_group="founding", document_type="charter",
+                         document_name="Устав"))
+    session.commit()
+    session.close()
+    engine.dispose()
+    return path
+
+
+def run(db_path, scenario):
+    async def main():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        try:
+            async with async_sessionmaker(bind=engine)() as db:
+                return await scenario(db)
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(main())
+
+
+def all_pages(db_path, limit, **filters):
+    """Проходит все страницы по курсору; возвращает страницы документов"""
+    async def scenario(db):
+        pages, cursor = [], None
+        while True:
+            page, cursor = await list_documents_page(db, 1, limit=limit, cursor=cursor, **filters)
+            pages.append(page)
+            if cursor is None:
+                return pages
+
+    return run(db_path, scenario)
+
+
+def expected_order(group=None):
+    """id в порядке (uploaded_at, id), NULL первыми"""
+    rows = [(uploaded_at, index + 1) for index, (uploaded_at, row_group) in enumerate(DOCUMENTS)
+            if group is None or row_group == group]
+    return [document_id for _, document_id in sorted(rows, key=lambda row: (row[0] is not None, row[0] or DAY_1, row[1]))]
+
+
+@pytest.mark.parametrize("uploaded_at", [None, DAY_1, datetime(2024, 1, 1, 12, 0, 0, 123456)])
+def test_cursor_round_trip(uploaded_at):
+    assert decode_cursor(encode_cursor(uploaded_at, 42)) == (uploaded_at, 42)
+
+
+@pytest.mark.parametrize("cursor", ["not base64!", encode_cursor(DAY_1, 1)[:-3], "WzEsMiwzXQ"])
+def test_invalid_cursor_rejected(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor)
+    assert error.value.status_code == 400
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 7, 100])
+def test_pages_cover_all_rows_once(db_path, limit):
+    pages = all_pages(db_path, limit, fields="id")
+
+    ids = [document["id"] for page in pages for document in page]
+    assert ids == expected_order()
+    assert all(len(page) <= limit for page in pages)
+
+
+def test_page_boundary_inside_null_rows(db_path):
+    # Первая страница заканчивается на документе без uploaded_at
+    pages = all_pages(db_path, 2, fields="id,uploaded_at")
+
+    assert pages[0][-1]["uploaded_at"] is None
+    assert [document["id"] for page in pages for document in page] == expected_order()
+
+
+def test_filter_applies_on_every_page(db_path):
+    pages = all_pages(db_path, 2, fields="id", document_group="founding")
+
+    assert [document["id"] for page in pages for document in page] == expected_order("founding")
+
+
+def test_fields_projection(db_path):
+    async def scenario(db):
+        return await list_documents_page(db, 1, limit=2, fields="document_name, status")
+
+    page, cursor = run(db_path, scenario)
+
+    # id и uploaded_at читаются для курсора, но в ответ не попадают
+    assert all(set(document) == {"document_name", "status"} for document in page)
+    assert cursor is not None
+
+
+def test_fields_order_and_duplicates():
+    assert parse_fields("status,id,status") == ["id", "status"]
+    assert parse_fields(None) == parse_fields("")
+
+
+def test_unknown_field_rejected():
+    with pytest.raises(HTTPException) as error:
+        parse_fields("id,password")
+    assert error.value.status_code == 400
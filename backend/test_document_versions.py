@@ -0,0 +1,121 @@
+"""
+Версии документов: id не переиспользуются (AUTOINCREMENT, миграция 6) и
+удаление старых версий освобождает их файлы в хранилище
+
+База - SQLite в памяти или во временном файле. Сервер не нужен.
+"""
+import hashlib
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import migrations
+from database import Base, Document, DocumentHistory, FileBlob
+from document_versions import prune_history
+from storage import BlobStore
+
+CONTENT = b"%PDF-1.4 old version"
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+@pytest.fixture
+def session_factory():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+def add_document(db) -> Document:
+    document = Document(establishment_id=1, document_group="founding", document_type="charter",
+                        document_name="Устав", uploaded=True)
+    db.add(document)
+    db.commit()
+    return document
+
+
+def add_version(db, file_path: str, superseded_at: datetime) -> None:
+    db.add(DocumentHistory(document_id=1, establishment_id=1, document_type="charter", version=1,
+                           document_group="founding", document_name="Устав", file_path=file_path,
+                           superseded_at=superseded_at))
+    db.commit()
+
+
+def test_deleted_document_id_not_reused(session_factory):
+    db = session_factory()
+    last = add_document(db)
+    last_id = last.id
+    db.delete(last)
+    db.commit()
+
+    assert add_document(db).id == last_id + 1
+    db.close()
+
+
+def test_prune_releases_old_versions(session_factory, tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"))
+    temp_path = tmp_path / "upload.part"
+    temp_path.write_bytes(CONTENT)
+    db = session_factory()
+    file_path = store.put(db, str(temp_path), SHA256, len(CONTENT), ".pdf")
+    db.commit()
+    add_version(db, file_path, datetime.utcnow() - timedelta(days=10))
+    add_version(db, "/uploads/recent.pdf", datetime.utcnow())
+    db.close()
+
+    assert prune_history(store, session_factory, retention_days=5) == 1
+
+    db = session_factory()
+    assert [entry.file_path for entry in db.query(DocumentHistory)] == ["/uploads/recent.pdf"]
+    # Ссылок на файл не осталось - его удалит сборщик мусора
+    assert db.query(FileBlob).filter(FileBlob.sha256 == SHA256).one().ref_count == 0
+    db.close()
+
+
+def test_prune_disabled(session_factory, tmp_path):
+    db = session_factory()
+    add_version(db, "/uploads/old.pdf", datetime(2000, 1, 1))
+    db.close()
+
+    assert prune_history(BlobStore(str(tmp_path)), session_factory, retention_days=0) == 0
+
+
+def test_autoincrement_migration(tmp_path):
+    db_path = str(tmp_path / "ebar.db")
+    engine = create_engine(f"sqlite:///{db_path}")
+    Base.metadata.create_all(engine)
+    engine.dispose()
+
+    # Таблица documents в том виде, в каком ее создавали до AUTOINCREMENT
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    old_sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'documents'").fetchone()[0]
+    old_sql = old_sql.replace(" PRIMARY KEY AUTOINCREMENT", "").replace(
+        "created_at DATETIME, ", "created_at DATETIME, \n\tPRIMARY KEY (id), ")
+    conn.execute("DROP TABLE documents")
+    conn.execute(old_sql)
+    conn.execute("CREATE INDEX ix_documents_file_path ON documents (file_path)")
+    conn.execute("INSERT INTO documents (id, establishment_id, document_group, document_type, document_name) "
+                 "VALUES (3, 1, 'founding', 'charter', 'Устав')")
+    conn.execute("INSERT INTO document_history (document_id, establishment_id, document_type, version, "
+                 "document_group, document_name) VALUES (7, 1, 'inn', 1, 'founding', 'ИНН')")
+    conn.close()
+
+    conn = migrations.connect(db_path)
+    try:
+        migrations.apply_schema(conn)
+        create_sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'documents'").fetchone()[0]
+        assert "AUTOINCREMENT" in create_sql
+        assert conn.execute("SELECT id, document_name FROM documents").fetchall() == [(3, "Устав")]
+        assert conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ix_documents_file_path'"
+        ).fetchone()
+        # id 7 уже упоминается в истории - новый документ получит следующий
+        conn.execute("INSERT INTO documents (establishment_id, document_group, document_type, document_name) "
+                     "VALUES (1, 'founding', 'ogrn', 'ОГРН')")
+        assert conn.execute("SELECT MAX(id) FROM documents").fetchone()[0] == 8
+    finally:
+        conn.close()
@@ -0,0 +1,131 @@
+"""
+Отдача файлов (downloads.py): условные запросы, Range, If-Range
+
+Ответ формируется и отправляется напрямую через ASGI send. Сервер не нужен.
+"""
+import asyncio
+import os
+
+import pytest
+from starlette.requests import Request
+
+import downloads
+from downloads import file_download_response
+
+CONTENT = bytes(range(256)) * 4
+SHA256 = "ab" * 32
+ETAG = f'"{SHA256}"'
+
+
+@pytest.fixture
+def path(tmp_path):
+    file_path = tmp_path / "doc.pdf"
+    file_path.write_bytes(CONTENT)
+    return str(file_path)
+
+
+def make_request(headers: dict = None, method: str = "GET") -> Request:
+    return Request({
+        "type": "http",
+        "method": method,
+        "path": "/api/documents/1/download",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+    })
+
+
+def fetch(path: str, headers: dict = None, method: str = "GET"):
+    """Статус, заголовки и тело ответа"""
+    request = make_request(headers, method)
+    response = file_download_response(request, path, "doc.pdf", root_dir=os.path.dirname(path),
+                                      content_hash=SHA256)
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(response(request.scope, receive, send))
+    start = messages[0]
+    response_headers = {name.decode(): value.decode() for name, value in start["headers"]}
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+    return start["status"], response_headers, body
+
+
+def test_full_file(path):
+    status, headers, body = fetch(path)
+    assert status == 200
+    assert body == CONTENT
+    assert headers["etag"] == ETAG
+    assert headers["accept-ranges"] == "bytes"
+    assert headers["content-length"] == str(len(CONTENT))
+
+
+def test_if_none_match_returns_304(path):
+    status, headers, body = fetch(path, {"If-None-Match": f'"other", W/{ETAG}'})
+    assert status == 304
+    assert body == b""
+    assert headers["etag"] == ETAG
+
+
+def test_if_modified_since_returns_304(path):
+    _, headers, _ = fetch(path)
+    status, _, _ = fetch(path, {"If-Modified-Since": headers["last-modified"]})
+    assert status == 304
+
+
+@pytest.mark.parametrize("range_header, start, end", [
+    ("bytes=0-99", 0, 99),
+    ("bytes=1000-", 1000, 1023),
+    ("bytes=-24", 1000, 1023),
+    ("bytes=1000-5000", 1000, 1023),
+])
+def test_range_returns_206(path, range_header, start, end):
+    status, headers, body = fetch(path, {"Range": range_header})
+    assert status == 206
+    assert body == CONTENT[start:end + 1]
+    assert headers["content-range"] == f"bytes {start}-{end}/{len(CONTENT)}"
+    assert headers["content-length"] == str(end - start + 1)
+
+
+@pytest.mark.parametrize("range_header", ["bytes=2000-", "bytes=-0", "bytes=10-5"])
+def test_unsatisfiable_range_returns_416(path, range_header):
+    status, headers, body = fetch(path, {"Range": range_header})
+    assert status == 416
+    assert headers["content-range"] == f"bytes */{len(CONTENT)}"
+    assert body == b""
+
+
+def test_unsupported_range_returns_full_file(path):
+    status, _, body = fetch(path, {"Range": "bytes=0-1,5-6"})
+    assert status == 200
+    assert body == CONTENT
+
+
+def test_if_range_matching_etag_returns_206(path):
+    status, _, body = fetch(path, {"Range": "bytes=0-9", "If-Range": ETAG})
+    assert status == 206
+    assert body == CONTENT[:10]
+
+
+def test_if_range_stale_etag_returns_full_file(path):
+    status, headers, body = fetch(path, {"Range": "bytes=0-9", "If-Range": '"stale"'})
+    assert status == 200
+    assert body == CONTENT
+    assert "content-range" not in headers
+
+
+def test_head_has_no_body(path):
+    status, headers, body = fetch(path, method="HEAD")
+    assert status == 200
+    assert body == b""
+    assert headers["content-length"] == str(len(CONTENT))
+
+
+def test_sendfile_header_hands_body_to_front_server(path, monkeypatch):
+    monkeypatch.setattr(downloads, "SENDFILE_HEADER", "X-Accel-Redirect")
+    status, headers, body = fetch(path, {"Range": "bytes=0-9"})
+    assert status == 200
+    assert headers["x-accel-redirect"] == "/protected-uploads/doc.pdf"
+    assert body == b""
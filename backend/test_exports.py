@@ -0,0 +1,83 @@
+"""
+Потоковая выгрузка ZIP (exports.py): архив читается zipfile и потоковым
+разбором локальных заголовков, как это делает java.util.zip.ZipInputStream
+
+Сервер не нужен.
+"""
+import asyncio
+import io
+import struct
+import zipfile
+import zlib
+from datetime import datetime
+
+import pytest
+
+from exports import ZipEntry, ZipStream, ZIP_DEFLATED, ZIP_STORED
+
+FILES = {
+    "founding/Устав - charter.pdf": b"%PDF-1.4 charter " * 300,
+    "finance/ИНН - inn.pdf": b"%PDF-1.4 inn",
+}
+
+
+def build(tmp_path, method: int):
+    entries = []
+    for index, (arcname, content) in enumerate(FILES.items()):
+        path = tmp_path / f"{index}.pdf"
+        path.write_bytes(content)
+        entries.append(ZipEntry(str(path), arcname, len(content), datetime(2024, 5, 1, 12, 30)))
+    archive = ZipStream(entries, method)
+
+    async def collect():
+        return b"".join([chunk async for chunk in archive])
+
+    return archive, asyncio.run(collect())
+
+
+@pytest.mark.parametrize("method", [ZIP_STORED, ZIP_DEFLATED])
+def test_archive_readable(tmp_path, method):
+    _, data = build(tmp_path, method)
+
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        assert {name: archive.read(name) for name in archive.namelist()} == FILES
+
+
+def test_stored_size_matches(tmp_path):
+    archive, data = build(tmp_path, ZIP_STORED)
+    assert archive.stored_size() == len(data)
+
+
+def test_stored_entries_have_sizes_in_local_header(tmp_path):
+    _, data = build(tmp_path, ZIP_STORED)
+
+    # Читаем только локальные заголовки, без центрального каталога
+    offset = 0
+    for arcname, content in FILES.items():
+        signature, _, flags, method, _, _, crc, compressed_size, size, name_length, extra_length = struct.unpack_from(
+            "<IHHHHHIIIHH", data, offset)
+        assert signature == 0x04034B50
+        assert method == ZIP_STORED
+        assert not flags & 0x0008
+        assert (crc, compressed_size, size) == (zlib.crc32(content), len(content), len(content))
+        offset += 30 + name_length + extra_length
+        assert data[offset:offset + size] == content
+        offset += size
+
+
+def test_changed_file_detected(tmp_path):
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(b"%PDF-1.4 first")
+    archive = ZipStream([ZipEntry(str(path), "doc.pdf", 14)], ZIP_STORED)
+
+    async def collect():
+        stream = archive.__aiter__()
+        await stream.__anext__()
+        # Файл подменили после того, как заголовок с CRC ушел клиенту
+        path.write_bytes(b"%PDF-1.4 other")
+        async for _ in stream:
+            pass
+
+    with pytest.raises(IOError):
+        asyncio.run(collect())
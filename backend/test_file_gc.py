@@ -0,0 +1,155 @@
+"""
+Сборщик мусора (file_gc.py): какие файлы он считает используемыми и в каком
+порядке удаляет записи хранилища и файлы
+
+База - SQLite в памяти, UPLOAD_DIR подменяется временным каталогом. Сервер не нужен.
+"""
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import file_gc
+from database import Base, Document, Establishment, FileBlob
+
+
+@pytest.fixture
+def upload_dir(tmp_path, monkeypatch):
+    path = tmp_path / "uploads"
+    path.mkdir()
+    monkeypatch.setattr(file_gc, "UPLOAD_DIR", str(path))
+    return path
+
+
+@pytest.fixture
+def session_factory():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+def make_file(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"data")
+    return path
+
+
+def add_document(db, file_path: str):
+    if db.get(Establishment, 1) is None:
+        db.add(Establishment(id=1, name="Test", username="test", password="x", position="owner",
+                             phone="+79990000000", email="test@test.com", business_name="Test",
+                             business_type="bar", address="Test", inn="7700000000", ogrn="1027700000000"))
+    db.add(Document(establishment_id=1, document_group="founding", document_type="charter",
+                    document_name="Устав", file_path=file_path, uploaded=True))
+    db.commit()
+
+
+def test_paths_compared_after_normalization(upload_dir, session_factory):
+    absolute = make_file(upload_dir / "ab" / "cd" / "absolute.pdf")
+    relative = make_file(upload_dir / "ab" / "cd" / "relative.pdf")
+    orphan = make_file(upload_dir / "ab" / "cd" / "orphan.pdf")
+    db = session_factory()
+    add_document(db, str(absolute))
+    # Так записывали пути старые версии: относительно каталога backend
+    add_document(db, "uploads/ab/./cd/relative.pdf")
+    db.close()
+
+    report = file_gc.collect_garbage(session_factory, grace=0)
+
+    assert absolute.exists()
+    assert relative.exists()
+    assert not orphan.exists()
+    assert report["removed"] == 1
+
+
+def test_upload_key_outside_root_is_none(upload_dir):
+    assert file_gc.upload_key(str(upload_dir / "a" / "b.pdf")) == os.path.join("a", "b.pdf")
+    assert file_gc.upload_key("uploads/../ebar.db") is None
+    assert file_gc.upload_key("/etc/passwd") is None
+
+
+def test_stale_blob_removed_after_commit(upload_dir, session_factory):
+    blob_file = make_file(upload_dir / "blobs" / "aa" / "bb" / "aabb.pdf")
+    db = session_factory()
+    db.add(FileBlob(sha256="aabb", file_path=str(blob_file), size=4, ref_count=0,
+                    created_at=datetime.utcnow() - timedelta(days=1)))
+    db.commit()
+    db.close()
+
+    report = file_gc.collect_garbage(session_factory, grace=0)
+
+    assert report["stale_blobs"] == 1
+    assert not blob_file.exists()
+    db = session_factory()
+    assert db.query(FileBlob).count() == 0
+    db.close()
+
+
+def test_recreated_blob_keeps_file(upload_dir, session_factory):
+    blob_file = make_file(upload_dir / "blobs" / "aa" / "bb" / "aabb.pdf")
+    db = session_factory()
+    # Запись удалена и закоммичена, но put() того же содержимого успел создать ее заново
+    db.add(FileBlob(sha256="aabb", file_path=str(blob_file), size=4, ref_count=1))
+    db.commit()
+
+    report = {"reclaimed_bytes": 0}
+    file_gc._remove_blob_files(db, [("aabb", str(blob_file))], report)
+    db.close()
+
+    assert blob_file.exists()
+    assert report["reclaimed_bytes"] == 0
+
+
+def test_blob_path_outside_root_not_deleted(upload_dir, tmp_path, session_factory):
+    outside = make_file(tmp_path / "outside.pdf")
+    db = session_factory()
+
+    file_gc._remove_blob_files(db, [("ccdd", str(outside))], {"reclaimed_bytes": 0})
+    db.close()
+
+    assert outside.exists()
+
+
+def test_stale_blob_thumbnails_removed(upload_dir, session_factory):
+    blob_file = make_file(upload_dir / "blobs" / "aa" / "bb" / "aabb.png")
+    thumbnail = make_file(upload_dir / "blobs" / "aa" / "bb" / "aabb.png.thumb128.jpg")
+    db = session_factory()
+    db.add(FileBlob(sha256="aabb", file_path=str(blob_file), size=4, ref_count=0,
+                    created_at=datetime.utcnow() - timedelta(days=1)))
+    db.commit()
+    db.close()
+
+    report = file_gc.collect_garbage(session_factory, grace=0)
+
+    assert not blob_file.exists()
+    assert not thumbnail.exists()
+    assert report["reclaimed_bytes"] == 8
+
+
+def test_session_per_batch(upload_dir, session_factory, monkeypatch):
+    monkeypatch.setattr(file_gc, "GC_BATCH_SIZE", 2)
+    orphans = [make_file(upload_dir / "ab" / f"orphan{i}.pdf") for i in range(5)]
+    opened, open_now = [], []
+
+    def counting_factory():
+        # Сколько сессий открыто одновременно: проход не должен держать свою,
+        # пока открывает следующую
+        db = session_factory()
+        opened.append(db)
+        open_now.append(db)
+        close = db.close
+        db.close = lambda: (open_now.remove(db) if db in open_now else None, close())
+        assert len(open_now) == 1
+        return db
+
+    report = file_gc.collect_garbage(counting_factory, grace=0)
+
+    assert report["removed"] == 5
+    assert not any(path.exists() for path in orphans)
+    # Курсор и ссылки, три пачки файлов, пачки записей БД
+    assert len(opened) > 4
+    assert open_now == []
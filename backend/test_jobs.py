@@ -0,0 +1,94 @@
+"""
+Очередь задач (jobs.py): продление аренды и очистка завершенных задач
+
+База - SQLite в памяти или во временном файле. Сервер не нужен.
+"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import jobs
+from database import Base, Job
+
+
+@pytest.fixture
+def session_factory():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+def test_finished_jobs_purged_after_retention(session_factory, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_RETENTION_DAYS", 7)
+    monkeypatch.setattr(jobs, "JOB_FAILED_RETENTION_DAYS", 30)
+    now = datetime.utcnow()
+    db = session_factory()
+    for kind, status, days in [
+        ("old_done", "done", 10),
+        ("recent_done", "done", 1),
+        ("old_failed", "failed", 40),
+        ("recent_failed", "failed", 10),
+        ("queued", "queued", 0),
+    ]:
+        db.add(Job(kind=kind, status=status, finished_at=now - timedelta(days=days) if days else None))
+    db.commit()
+    db.close()
+
+    jobs.JobQueue(session_factory)._recover_expired()
+
+    db = session_factory()
+    assert sorted(job.kind for job in db.query(Job)) == ["queued", "recent_done", "recent_failed"]
+    db.close()
+
+
+def test_lease_renewed_while_handler_runs(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_LEASE_SECONDS", 0.3)
+    engine = create_engine(f"sqlite:///{tmp_path / 'jobs.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    queue = jobs.JobQueue(session_factory)
+    recovered = []
+
+    @queue.handler("slow")
+    async def slow(job):
+        # Обработчик работает в несколько раз дольше аренды
+        for _ in range(5):
+            await asyncio.sleep(0.2)
+            recovered.append(await asyncio.to_thread(queue._recover_expired))
+
+    db = session_factory()
+    db.add(Job(kind="slow", status="queued", run_after=datetime.utcnow() - timedelta(seconds=1)))
+    db.commit()
+    db.close()
+
+    job = queue._claim_next()
+    asyncio.run(queue._run(job))
+
+    assert recovered == [0] * 5
+    db = session_factory()
+    assert db.query(Job).one().status == "done"
+    db.close()
+    engine.dispose()
+
+
+def test_lease_not_extended_after_recovery(session_factory):
+    db = session_factory()
+    db.add(Job(kind="slow", status="running", attempts=2, locked_until=datetime.utcnow()))
+    db.commit()
+    job = db.query(Job).one()
+    db.expunge(job)
+    db.close()
+    queue = jobs.JobQueue(session_factory)
+
+    assert queue._extend_lease(job)
+    # Задачу вернули в очередь и снова захватили - аренда уже не этого запуска
+    db = session_factory()
+    db.query(Job).update({"attempts": 3})
+    db.commit()
+    db.close()
+    assert not queue._extend_lease(job)
@@ -0,0 +1,66 @@
+"""
+Перенос файлов в хешированное дерево (migrate_storage_layout.py): остатки
+прерванного запуска и миниатюры
+
+База - SQLite во временном файле. Сервер не нужен.
+"""
+import hashlib
+import sqlite3
+
+import pytest
+
+from migrate_storage_layout import link_or_copy, move_file
+
+CONTENT = b"%PDF-1.4 charter"
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "ebar.db"))
+    for table in ("file_blobs", "documents", "document_history"):
+        conn.execute(f"CREATE TABLE {table} (file_path TEXT)")
+    yield conn
+    conn.close()
+
+
+def test_leftover_with_same_size_replaced(tmp_path):
+    old_path, new_path = tmp_path / f"{SHA256}.pdf", tmp_path / "ab" / f"{SHA256}.pdf"
+    old_path.write_bytes(CONTENT)
+    new_path.parent.mkdir()
+    # Обрывок копии: размер совпадает, содержимое - нет
+    new_path.write_bytes(b"\0" * len(CONTENT))
+
+    link_or_copy(str(old_path), str(new_path), SHA256)
+
+    assert new_path.read_bytes() == CONTENT
+
+
+def test_complete_leftover_kept(tmp_path):
+    old_path, new_path = tmp_path / "old.pdf", tmp_path / "ab" / "old.pdf"
+    old_path.write_bytes(CONTENT)
+    new_path.parent.mkdir()
+    new_path.write_bytes(CONTENT)
+    inode = new_path.stat().st_ino
+
+    link_or_copy(str(old_path), str(new_path))
+
+    assert new_path.stat().st_ino == inode
+
+
+def test_thumbnails_moved_with_file(tmp_path, conn):
+    old_path, new_path = tmp_path / f"{SHA256}.pdf", tmp_path / "ab" / "cd" / f"{SHA256}.pdf"
+    old_path.write_bytes(CONTENT)
+    old_thumbnail = tmp_path / f"{SHA256}.pdf.thumb256.jpg"
+    old_thumbnail.write_bytes(b"jpeg")
+    conn.execute("INSERT INTO file_blobs VALUES (?)", (str(old_path),))
+    conn.execute("INSERT INTO document_history VALUES (?)", (str(old_path),))
+    conn.commit()
+
+    assert move_file(conn, "blobs", str(old_path), str(new_path), sha256=SHA256) == "moved"
+
+    assert new_path.read_bytes() == CONTENT
+    assert (tmp_path / "ab" / "cd" / f"{SHA256}.pdf.thumb256.jpg").read_bytes() == b"jpeg"
+    assert not old_path.exists() and not old_thumbnail.exists()
+    for table in ("file_blobs", "document_history"):
+        assert conn.execute(f"SELECT file_path FROM {table}").fetchone()[0] == str(new_path)
@@ -0,0 +1,189 @@
+"""
+Версионные миграции (migrations.py): применение по версиям, повторный запуск,
+откат неудачной миграции, backfill пачками с продолжением после сбоя и
+перенос документов в историю версий
+
+База - SQLite во временном файле. Сервер не нужен.
+"""
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine
+
+import migrations
+from database import Base
+from migrations import Backfill, Migration, apply_schema, connect, run_backfill
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "ebar.db")
+
+
+@pytest.fixture
+def conn(db_path):
+    conn = connect(db_path)
+    yield conn
+    conn.close()
+
+
+def migration_state(conn, version):
+    return conn.execute(
+        "SELECT backfill_last_id, completed_at FROM schema_migrations WHERE version = ?", (version,)
+    ).fetchone()
+
+
+@pytest.fixture
+def numbers(conn, monkeypatch):
+    """Таблица t из 10 строк и миграция, которая добавляет колонку и заполняет ее пачками"""
+    conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, v INTEGER)")
+    conn.executemany("INSERT INTO t (id, v) VALUES (?, ?)", [(i, i) for i in range(1, 11)])
+    fail_above = [None]
+
+    def check(hi):
+        if fail_above[0] is not None and hi > fail_above[0]:
+            raise ValueError("backfill interrupted")
+        return 0
+
+    conn.create_function("check_batch", 1, check)
+    migration = Migration(
+        1, "t: touched", lambda c: migrations.add_column(c, "t", "touched", "INTEGER"),
+        Backfill("t", [
+            "UPDATE t SET touched = COALESCE(touched, 0) + 1 + check_batch(:hi) WHERE id > :lo AND id <= :hi"
+        ])
+    )
+    monkeypatch.setattr(migrations, "MIGRATIONS", [migration])
+    return migration, fail_above
+
+
+def test_schema_applied_once(conn, numbers):
+    assert apply_schema(conn) == [1]
+    assert apply_schema(conn) == []
+    assert migrations.column_exists(conn, "t", "touched")
+    # Backfill еще впереди: прогресс с нуля, миграция не завершена
+    assert migration_state(conn, 1) == (0, None)
+
+
+def test_failed_upgrade_rolled_back(conn, monkeypatch):
+    conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY)")
+
+    def upgrade(c):
+        migrations.add_column(c, "t", "extra", "INTEGER")
+        raise RuntimeError("broken migration")
+
+    monkeypatch.setattr(migrations, "MIGRATIONS", [Migration(1, "broken", upgrade)])
+
+    with pytest.raises(RuntimeError):
+        apply_schema(conn)
+    assert not migrations.column_exists(conn, "t", "extra")
+    assert migration_state(conn, 1) is None
+
+
+def test_backfill_in_batches(conn, numbers):
+    migration, _ = numbers
+    apply_schema(conn)
+
+    run_backfill(conn, migration, batch_size=3, pause=0)
+
+    assert conn.execute("SELECT COUNT(*) FROM t WHERE touched = 1").fetchone()[0] == 10
+    last_id, completed_at = migration_state(conn, 1)
+    assert last_id == 10 and completed_at is not None
+    # Завершенный backfill повторно не выполняется
+    run_backfill(conn, migration, batch_size=3, pause=0)
+    assert conn.execute("SELECT MAX(touched) FROM t").fetchone()[0] == 1
+
+
+def test_backfill_resumes_after_failure(conn, numbers):
+    migration, fail_above = numbers
+    apply_schema(conn)
+    fail_above[0] = 6
+
+    with pytest.raises(sqlite3.OperationalError):
+        run_backfill(conn, migration, batch_size=3, pause=0)
+    # Две пачки закоммичены, третья откатилась целиком
+    assert migration_state(conn, 1) == (6, None)
+    assert conn.execute("SELECT COUNT(*) FROM t WHERE touched IS NULL").fetchone()[0] == 4
+
+    fail_above[0] = None
+    run_backfill(conn, migration, batch_size=3, pause=0)
+
+    # Уже перенесенные строки не обрабатываются второй раз
+    assert [row[0] for row in conn.execute("SELECT touched FROM t ORDER BY id")] == [1] * 10
+    assert migration_state(conn, 1)[1] is not None
+
+
+def test_real_migrations_on_new_database(db_path, conn):
+    engine = create_engine(f"sqlite:///{db_path}")
+    Base.metadata.create_all(engine)
+    engine.dispose()
+
+    assert apply_schema(conn) == [migration.version for migration in migrations.MIGRATIONS]
+    assert apply_schema(conn) == []
+    # Идемпотентные upgrade ничего не сломали: индексы на месте, documents - с AUTOINCREMENT
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'ix_documents_establishment_uploaded'").fetchone()
+    assert "AUTOINCREMENT" in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'documents'"
+    ).fetchone()[0].upper()
+
+
+def test_document_versions_backfill(db_path, conn):
+    engine = create_engine(f"sqlite:///{db_path}")
+    Base.metadata.create_all(engine)
+    engine.dispose()
+    apply_schema(conn)
+    # Как до версий: несколько строк одного типа у заведения
+    conn.executemany(
+        "INSERT INTO documents (id, establishment_id, document_group, document_type, document_name, status, "
+        "verification_status, uploaded_at) VALUES (?, ?, 'founding', ?, 'Устав', ?, 'verified', ?)",
+        [
+            (1, 1, "charter", "rejected", "2024-01-01"),
+            (2, 1, "charter", "pending", "2024-01-03"),
+            (3, 1, "charter", "rejected", "2024-01-02"),
+            (4, 1, "inn", "verified", "2024-01-01"),
+            (5, 2, "charter", "pending", "2024-01-01"),
+        ]
+    )
+    conn.execute("UPDATE schema_migrations SET backfill_last_id = 0, completed_at = NULL WHERE version = 3")
+    migration = next(migration for migration in migrations.MIGRATIONS if migration.version == 3)
+
+    run_backfill(conn, migration, batch_size=1, pause=0)
+
+    assert sorted(conn.execute("SELECT id FROM documents")) == [(2,), (4,), (5,)]
+    assert sorted(conn.execute(
+        "SELECT establishment_id, document_type, document_id, version FROM current_documents"
+    )) == [(1, "charter", 2, 3), (1, "inn", 4, 1), (2, "charter", 5, 1)]
+    # Старые версии - в истории с номерами по порядку загрузки
+    assert list(conn.execute(
+        "SELECT document_id, version FROM document_history ORDER BY version"
+    )) == [(1, 1), (3, 2)]
+    # Счетчики пересчитаны по оставшимся документам
+    assert sorted(conn.execute(
+        "SELECT establishment_id, dimension, value, count FROM document_counters WHERE dimension != 'verification_status'"
+    )) == [(1, "status", "pending", 1), (1, "status", "verified", 1), (1, "total", "", 2),
+           (2, "status", "pending", 1), (2, "total", "", 1)]
+
+
+def test_documents_autoincrement_continues_after_referenced_ids(conn):
+    conn.execute(
+        "CREATE TABLE documents (id INTEGER NOT NULL, establishment_id INTEGER, document_type VARCHAR, "
+        "PRIMARY KEY (id))"
+    )
+    conn.execute("CREATE INDEX ix_documents_establishment_id ON documents (establishment_id)")
+    conn.execute("CREATE TABLE document_history (document_id INTEGER)")
+    conn.execute("CREATE TABLE jobs (document_id INTEGER)")
+    conn.execute("INSERT INTO documents (id, establishment_id, document_type) VALUES (3, 1, 'charter')")
+    # Удаленный документ 9 остался в истории, а 7 - в очереди задач
+    conn.execute("INSERT INTO document_history VALUES (9)")
+    conn.execute("INSERT INTO jobs VALUES (7)")
+
+    migrations._documents_autoincrement(conn)
+
+    assert "AUTOINCREMENT" in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'documents'"
+    ).fetchone()[0].upper()
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'ix_documents_establishment_id'").fetchone()
+    conn.execute("INSERT INTO documents (establishment_id, document_type) VALUES (1, 'inn')")
+    assert conn.execute("SELECT MAX(id) FROM documents").fetchone()[0] == 10
+    # Повторный запуск ничего не меняет
+    migrations._documents_autoincrement(conn)
+    assert conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0] == 2
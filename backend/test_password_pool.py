@@ -0,0 +1,126 @@
+"""
+Пул потоков bcrypt (password_pool.py): работа вне event loop, ограничение
+очереди, отмененные запросы и метрики
+
+Сервер не нужен; bcrypt - с минимальной стоимостью.
+"""
+import asyncio
+import threading
+
+import pytest
+
+import auth_utils
+import password_pool
+from password_pool import PasswordHasherPool, PasswordPoolBusy
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(auth_utils, "_rounds", auth_utils.BCRYPT_MIN_ROUNDS)
+    pool = PasswordHasherPool(workers=1, max_queue=1)
+    yield pool
+    pool.shutdown()
+
+
+def test_hash_and_verify(pool):
+    async def run():
+        hashed = await pool.hash("secret")
+        return hashed, await pool.verify("secret", hashed), await pool.verify("wrong", hashed)
+
+    hashed, correct, wrong = asyncio.run(run())
+
+    assert hashed.startswith("$2b$10$")
+    assert correct and not wrong
+    assert pool.stats()["completed"] == 3
+
+
+def test_event_loop_not_blocked(pool):
+    release = threading.Event()
+    ticks = []
+
+    async def run():
+        task = asyncio.ensure_future(pool._run(release.wait, 5))
+        # Пока поток пула занят, event loop обслуживает другие корутины
+        for _ in range(3):
+            await asyncio.sleep(0.01)
+            ticks.append(pool.stats()["in_flight"])
+        release.set()
+        return await task
+
+    assert asyncio.run(run()) is True
+    assert ticks == [1, 1, 1]
+
+
+def test_full_queue_rejected_with_retry_after(pool):
+    release = threading.Event()
+
+    async def run():
+        # Один поток занят, одна задача ждет в очереди - третьей места нет
+        running = asyncio.ensure_future(pool._run(release.wait, 5))
+        queued = asyncio.ensure_future(pool._run(release.wait, 5))
+        await asyncio.sleep(0)
+        with pytest.raises(PasswordPoolBusy) as error:
+            await pool._run(release.wait, 5)
+        stats = pool.stats()
+        release.set()
+        await asyncio.gather(running, queued)
+        return error.value, stats
+
+    error, stats = asyncio.run(run())
+
+    assert error.status_code == 503
+    assert error.headers["Retry-After"] == "1"
+    assert (stats["in_flight"], stats["queued"], stats["rejected"]) == (2, 1, 1)
+
+
+def test_cancelled_request_keeps_slot_until_done(pool):
+    release = threading.Event()
+
+    async def run():
+        task = asyncio.ensure_future(pool._run(release.wait, 5))
+        await asyncio.sleep(0.01)
+        # Клиент отключился, но bcrypt в потоке не прервать
+        task.cancel()
+        await asyncio.sleep(0.01)
+        in_flight = pool.stats()["in_flight"]
+        release.set()
+        for _ in range(100):
+            if pool.stats()["in_flight"] == 0:
+                break
+            await asyncio.sleep(0.01)
+        return in_flight
+
+    assert asyncio.run(run()) == 1
+    assert pool.stats()["in_flight"] == 0
+
+
+def test_failed_task_frees_slot(pool):
+    def fail():
+        raise ValueError("broken hash")
+
+    async def run():
+        with pytest.raises(ValueError):
+            await pool._run(fail)
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+
+    assert pool.stats()["in_flight"] == 0
+
+
+def test_stats_and_calibration(pool, monkeypatch):
+    monkeypatch.setattr(password_pool, "get_rounds", lambda: 11)
+
+    async def run():
+        await pool.calibrate()
+        await asyncio.gather(*(pool._run(lambda: None) for _ in range(2)))
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    stats = pool.stats()
+
+    assert stats["bcrypt_rounds"] == 11
+    assert stats["completed"] == 3
+    assert stats["max_in_flight"] == 2
+    assert stats["queue_wait_ms"]["p50"] is not None
+    assert stats["run_ms"]["max"] is not None
@@ -0,0 +1,122 @@
+"""
+Кеш аутентифицированных заведений (principal_cache.py): время жизни записи,
+вытеснение давно не использованных, инвалидация, метрики и отсоединенные копии
+
+База и сервер не нужны; часы подменяются.
+"""
+import pytest
+from sqlalchemy import inspect
+
+import principal_cache
+from database import Establishment
+from principal_cache import PrincipalCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(principal_cache.time, "monotonic", clock)
+    return clock
+
+
+def make_establishment(establishment_id=1, **overrides) -> Establishment:
+    values = dict(id=establishment_id, name="Test", username=f"test{establishment_id}", password="x",
+                  position="owner", phone="+79990000000", email="test@test.com", business_name="Test",
+                  business_type="bar", address="Test", inn="7700000000", ogrn="1027700000000",
+                  status="draft")
+    values.update(overrides)
+    return Establishment(**values)
+
+
+def test_hit_returns_cached_copy(clock):
+    cache = PrincipalCache(maxsize=10, ttl=30)
+    principal = cache.put(make_establishment())
+
+    assert cache.get(1) is principal
+    assert cache.get(2) is None
+
+
+def test_entry_expires_after_ttl(clock):
+    cache = PrincipalCache(maxsize=10, ttl=30)
+    cache.put(make_establishment())
+
+    clock.now += 30
+    assert cache.get(1) is not None
+    clock.now += 0.001
+    assert cache.get(1) is None
+    # Просроченная запись удалена, а не просто пропущена
+    assert cache.stats()["size"] == 0
+
+
+def test_put_refreshes_ttl(clock):
+    cache = PrincipalCache(maxsize=10, ttl=30)
+    cache.put(make_establishment(status="draft"))
+    clock.now += 20
+    cache.put(make_establishment(status="pending"))
+    clock.now += 20
+
+    assert cache.get(1).status == "pending"
+
+
+def test_least_recently_used_evicted(clock):
+    cache = PrincipalCache(maxsize=2, ttl=30)
+    cache.put(make_establishment(1))
+    cache.put(make_establishment(2))
+    # Чтение делает запись 1 свежей - вытесняется 2
+    cache.get(1)
+    cache.put(make_establishment(3))
+
+    assert cache.get(2) is None
+    assert cache.get(1) is not None and cache.get(3) is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_invalidate(clock):
+    cache = PrincipalCache(maxsize=10, ttl=30)
+    cache.put(make_establishment())
+
+    cache.invalidate(1)
+    cache.invalidate(1)
+
+    assert cache.get(1) is None
+    # Повторная инвалидация отсутствующей записи не считается
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_stats(clock):
+    cache = PrincipalCache(maxsize=10, ttl=30)
+    assert cache.stats()["hit_ratio"] is None
+
+    cache.put(make_establishment())
+    cache.get(1)
+    cache.get(1)
+    cache.get(1)
+    cache.get(2)
+    stats = cache.stats()
+
+    assert (stats["hits"], stats["misses"], stats["hit_ratio"]) == (3, 1, 0.75)
+    assert (stats["size"], stats["maxsize"], stats["ttl_seconds"]) == (1, 10, 30)
+    cache.clear()
+    assert cache.stats()["size"] == 0
+
+
+def test_snapshot_is_detached_copy(clock):
+    cache = PrincipalCache(maxsize=10, ttl=30)
+    establishment = make_establishment(status="pending")
+
+    principal = cache.put(establishment)
+    establishment.status = "verified"
+
+    assert principal is not establishment
+    assert principal.status == "pending"
+    assert inspect(principal).transient
+    assert all(getattr(principal, column.key) == getattr(make_establishment(status="pending"), column.key)
+               for column in Establishment.__mapper__.column_attrs)
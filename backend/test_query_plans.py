@@ -0,0 +1,164 @@
+"""
+Проверка планов запросов: ни один запрос обработчиков и фоновых задач не должен
+читать таблицу целиком (SCAN), все должны идти через индексы (SEARCH).
+
+Проверяются сами функции приложения (queries.py, document_listing.py, jobs.py и
+т.д.), а не копии запросов. Запросы выполняются на пустой базе в памяти, созданной
+из моделей, а каждый SELECT/UPDATE/DELETE/INSERT перед выполнением прогоняется
+через EXPLAIN QUERY PLAN (у INSERT ... SELECT план есть у выборки).
+Сервер для этих тестов не нужен.
+"""
+import asyncio
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from database import Base, CurrentDocument, DocumentHistory
+from document_listing import encode_cursor, list_documents_page
+from document_expiry import check_expiry
+from document_stats import aggregate_queries, counters_query
+from document_versions import history_page, prune_history
+from file_gc import noncanonical_keys, referenced_keys, sweep_orphan_documents, sweep_stale_blobs
+from jobs import JobQueue, jobs_for_document
+from queries import (
+    blob_by_path_query, document_query, establishment_by_email_query, establishment_exists_query,
+    export_documents_query, history_version_query, login_query, required_documents_query, reset_token_query
+)
+from refresh_tokens import issue_refresh_token, purge_auth_tokens, revoke_establishment_sessions, revoke_family, rotate_refresh_token
+from reset_tokens import issue_reset_token, purge_reset_tokens
+from storage import BlobStore
+from token_revocation import RevocationList
+
+TABLES = set(Base.metadata.tables)
+
+
+def capture_plans(engine, plans):
+    """Перед каждым запросом записывает его план"""
+    @event.listens_for(engine, "before_cursor_execute")
+    def explain(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "INSERT")):
+            cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            plans.append((statement, [row[3] for row in cursor.fetchall()]))
+
+
+def full_scans(plans):
+    """Строки планов вида "SCAN <таблица>" - полный проход по таблице или индексу"""
+    found = []
+    for statement, details in plans:
+        for detail in details:
+            words = detail.split()
+            if len(words) > 1 and words[0] == "SCAN" and words[1] in TABLES:
+                found.append(f"{detail}\n    in: {' '.join(statement.split())}")
+    return found
+
+
+@pytest.fixture
+def plans():
+    return []
+
+
+@pytest.fixture
+def db(plans):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    capture_plans(engine, plans)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def run_async(plans, query_func):
+    """Выполняет асинхронный запрос на отдельной базе в памяти"""
+    async def run():
+        engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        capture_plans(engine.sync_engine, plans)
+        async with async_sessionmaker(bind=engine)() as session:
+            await query_func(session)
+        await engine.dispose()
+    asyncio.run(run())
+
+
+NOW = datetime(2024, 1, 1)
+
+# Запросы обработчиков (queries.py) и фоновых задач - те же функции, что вызывает приложение
+SYNC_QUERIES = {
+    "document_by_id": lambda db: db.scalars(document_query(1)).first(),
+    "registration_document": lambda db: db.scalars(document_query(1, 1)).first(),
+    "blob_by_file_path": lambda db: db.scalars(blob_by_path_query("/x")).first(),
+    "establishment_exists": lambda db: db.execute(establishment_exists_query("a@b.c", "user")).first(),
+    "login_lookup": lambda db: db.scalars(login_query("user")).first(),
+    "forgot_password_lookup": lambda db: db.scalars(establishment_by_email_query("a@b.c")).first(),
+    "reset_token_lookup": lambda db: db.scalars(reset_token_query("123456")).first(),
+    "history_version_download": lambda db: db.scalars(history_version_query(1, 1)).first(),
+    "export_latest_documents": lambda db: db.scalars(export_documents_query(1)).all(),
+    "submit_required_documents": lambda db: db.scalars(required_documents_query(1)).all(),
+    "reset_token_issue": lambda db: issue_reset_token(db, 1),
+    "reset_token_purge": lambda db: purge_reset_tokens(lambda: db),
+    "refresh_token_rotate": lambda db: rotate_refresh_token(db, issue_refresh_token(db, 1)[0]),
+    "refresh_family_revoke": lambda db: revoke_family(db, "family"),
+    "establishment_sessions_revoke": lambda db: revoke_establishment_sessions(db, 1),
+    "revocation_lookup": lambda db: (revocations := RevocationList(lambda: db)).revoke(db, "jti", NOW)
+    or revocations.is_revoked(db, "jti", "family"),
+    "revocation_filter_rebuild": lambda db: RevocationList(lambda: db).rebuild(),
+    "auth_token_purge": lambda db: purge_auth_tokens(lambda: db),
+    "gc_referenced_keys": lambda db: referenced_keys(db, {"/a", "/b"}),
+    "gc_noncanonical_keys": lambda db: noncanonical_keys(db),
+    "gc_orphan_documents": lambda db: sweep_orphan_documents(lambda: db, BlobStore("/nonexistent"), True,
+                                                             {"orphan_documents": 0}),
+    "gc_stale_blobs": lambda db: sweep_stale_blobs(lambda: db, 0, True, {"stale_blobs": 0}),
+    "jobs_for_document": lambda db: jobs_for_document(db, 1),
+    "job_claim": lambda db: JobQueue(lambda: db)._claim_next(),
+    "job_enqueue_periodic": lambda db: JobQueue(lambda: db).enqueue_periodic("gc", 3600),
+    "job_recover_and_purge": lambda db: JobQueue(lambda: db)._recover_expired(),
+    "stats_counters": lambda db: db.execute(counters_query(1)).all(),
+    "stats_aggregates": lambda db: [db.execute(query).all() for query in aggregate_queries(1)],
+    "current_document_pointer": lambda db: db.get(CurrentDocument, (1, "charter")),
+    "expiry_first_run": lambda db: check_expiry(db, NOW),
+    "expiry_since_watermark": lambda db: [check_expiry(db, NOW), check_expiry(db, datetime(2024, 1, 2))],
+}
+
+
+@pytest.mark.parametrize("name", sorted(SYNC_QUERIES))
+def test_query_uses_index(name, db, plans):
+    SYNC_QUERIES[name](db)
+    assert plans, "query was not executed"
+    assert not full_scans(plans), "\n".join(full_scans(plans))
+
+
+@pytest.mark.parametrize("filters", [
+    {},
+    {"document_group": "founding"},
+    {"verification_status": "invalid"},
+    {"cursor": encode_cursor(NOW, 10)},
+    {"cursor": encode_cursor(None, 10), "fields": "id,document_type"},
+])
+def test_document_listing_uses_index(filters, plans):
+    run_async(plans, lambda session: list_documents_page(session, 1, limit=50, **filters))
+    assert plans, "query was not executed"
+    assert not full_scans(plans), "\n".join(full_scans(plans))
+
+
+@pytest.mark.parametrize("cursor", [None, "5"])
+def test_document_history_uses_index(cursor, plans):
+    run_async(plans, lambda session: history_page(session, 1, "charter", limit=20, cursor=cursor))
+    assert plans, "query was not executed"
+    assert not full_scans(plans), "\n".join(full_scans(plans))
+
+
+def test_history_prune_uses_index(db, plans, tmp_path):
+    db.add(DocumentHistory(document_id=1, establishment_id=1, document_type="charter", version=1,
+                           document_group="founding", document_name="Устав", file_path="/x",
+                           superseded_at=datetime(2000, 1, 1)))
+    db.commit()
+    plans.clear()
+
+    assert prune_history(BlobStore(str(tmp_path)), lambda: db, retention_days=1) == 1
+    assert plans, "query was not executed"
+    assert not full_scans(plans), "\n".join(full_scans(plans))
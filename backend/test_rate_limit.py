@@ -0,0 +1,112 @@
+"""
+Ограничение частоты запросов (rate_limit.py): формат лимитов, корзины
+в памяти и в файле SQLite, ответ 429 с Retry-After
+
+Сервер не нужен: проверки вызываются напрямую.
+"""
+import asyncio
+import os
+
+import pytest
+
+import rate_limit
+from rate_limit import MemoryBackend, RateLimit, RateLimitExceeded, RateLimiter, SQLiteBackend
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "ratelimit.db")
+    # Бэкенд по умолчанию тоже смотрит во временный файл
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_DB", path)
+    return path
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, db_path):
+    if request.param == "memory":
+        return MemoryBackend()
+    return SQLiteBackend(db_path)
+
+
+@pytest.mark.parametrize("value, capacity, period", [
+    ("5/minute", 5, 60),
+    ("3/15minutes", 3, 900),
+    ("100 / hour", 100, 3600),
+])
+def test_limit_format(value, capacity, period):
+    limit = RateLimit(value)
+    assert limit.capacity == capacity
+    assert limit.period == period
+
+
+def test_invalid_limit_format():
+    with pytest.raises(ValueError):
+        RateLimit("5 per minute")
+
+
+def test_bucket_empties_and_refills(backend):
+    limit = RateLimit("3/minute")
+    results = [backend.hit("key", limit, 1, 1000.0)[0] for _ in range(4)]
+    assert results == [True, True, True, False]
+
+    # Через 20 секунд корзина пополнилась на один токен
+    assert backend.hit("key", limit, 1, 1020.0)[0] is True
+    assert backend.hit("key", limit, 1, 1020.0)[0] is False
+
+    # Другой ключ - другая корзина
+    assert backend.hit("other", limit, 1, 1020.0)[0] is True
+
+
+def test_sqlite_buckets_shared_between_connections(db_path):
+    limit = RateLimit("2/minute")
+    first, second = SQLiteBackend(db_path), SQLiteBackend(db_path)
+
+    assert first.hit("login:ip:1", limit, 1, 1000.0)[0] is True
+    assert second.hit("login:ip:1", limit, 1, 1000.0)[0] is True
+    assert first.hit("login:ip:1", limit, 1, 1000.0)[0] is False
+
+
+def test_purge_idle_buckets(backend):
+    limit = RateLimit("2/minute")
+    backend.hit("old", limit, 1, 1000.0)
+    backend.hit("new", limit, 1, 5000.0)
+    assert backend.purge(2000.0) == 1
+
+
+def test_check_raises_429_with_retry_after(backend):
+    limiter = RateLimiter(backend)
+    limit = RateLimit("2/minute")
+
+    async def run():
+        await limiter.check("key", limit)
+        await limiter.check("key", limit)
+        await limiter.check("key", limit, detail="Too many")
+
+    with pytest.raises(RateLimitExceeded) as error:
+        asyncio.run(run())
+    assert error.value.status_code == 429
+    assert error.value.detail == "Too many"
+    assert 1 <= int(error.value.headers["Retry-After"]) <= 30
+    assert limiter.stats()["rejected"] == 1
+
+
+def test_storage_error_does_not_reject(db_path):
+    backend = SQLiteBackend(db_path)
+    backend._connect().execute("DROP TABLE rate_limit_buckets")
+    limiter = RateLimiter(backend)
+
+    asyncio.run(limiter.check("key", RateLimit("1/minute")))
+    assert limiter.stats()["errors"] == 1
+
+
+def test_file_created_on_first_check(db_path):
+    backend = rate_limit.create_backend("sqlite")
+    assert backend.path == db_path
+    assert not os.path.exists(db_path)
+
+    assert backend.hit("key", RateLimit("1/minute"), 1, 1000.0)[0] is True
+    assert os.path.exists(db_path)
+
+
+def test_default_path_independent_of_cwd():
+    assert os.path.isabs(rate_limit.RATE_LIMIT_DB)
@@ -0,0 +1,78 @@
+"""
+Refresh-токены (refresh_tokens.py): обмен, повторное предъявление и
+содержимое access-токена
+
+База - SQLite в памяти. Сервер не нужен.
+"""
+import pytest
+from fastapi import HTTPException
+from jose import jwt
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from auth import ALGORITHM, SECRET_KEY, create_access_token, decode_access_token
+from database import Base, Establishment, RefreshToken
+from refresh_tokens import issue_refresh_token, rotate_refresh_token
+from token_revocation import revocation_list
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def test_rotation_issues_token_of_same_family(db):
+    token, row = issue_refresh_token(db, 1)
+    db.commit()
+
+    new_token, new_row = rotate_refresh_token(db, token)
+    db.commit()
+
+    assert new_token != token
+    assert new_row.family_id == row.family_id
+    assert db.get(RefreshToken, row.id).rotated_at is not None
+
+
+def test_reuse_revokes_family(db):
+    token, row = issue_refresh_token(db, 1)
+    db.commit()
+    new_token, _ = rotate_refresh_token(db, token)
+    db.commit()
+
+    # Старый токен предъявили еще раз: отзыв цепочки коммитит вызывающий код
+    reused_token, reused_row = rotate_refresh_token(db, token)
+    db.commit()
+
+    assert reused_token is None
+    assert reused_row.family_id == row.family_id
+    assert db.query(RefreshToken).filter(RefreshToken.revoked_at.is_(None)).count() == 0
+    # Вместе с цепочкой отозваны ее access-токены
+    assert revocation_list.is_revoked(db, None, row.family_id)
+    # Токен, выданный при обмене, тоже больше не действует
+    with pytest.raises(HTTPException) as error:
+        rotate_refresh_token(db, new_token)
+    assert error.value.status_code == 401
+
+
+def test_unknown_token_rejected(db):
+    with pytest.raises(HTTPException) as error:
+        rotate_refresh_token(db, "unknown")
+    assert error.value.status_code == 401
+
+
+def test_access_token_carries_claims():
+    establishment = Establishment(id=5, status="draft", business_type="bar")
+
+    token = create_access_token(establishment, "family")
+
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    assert (payload["status"], payload["business_type"]) == ("draft", "bar")
+    # Обработчику хватает токена: статус и тип бизнеса без обращения к БД
+    claims = decode_access_token(token)
+    assert (claims.id, claims.status, claims.business_type, claims.session_id) == (5, "draft", "bar", "family")
@@ -0,0 +1,67 @@
+"""
+Токены восстановления пароля (reset_tokens.py): коды из счетчика выдач
+
+База - SQLite в памяти. Сервер не нужен.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import reset_tokens
+from database import Base, PasswordResetToken
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def add_token(db, token: str, expires_at: datetime) -> None:
+    db.add(PasswordResetToken(token=token, establishment_id=1, expires_at=expires_at, used=False))
+    db.commit()
+
+
+def test_permutation_is_collision_free():
+    codes = {reset_tokens.permute_code(number) for number in range(10 ** reset_tokens.TOKEN_DIGITS)}
+    assert len(codes) == 10 ** reset_tokens.TOKEN_DIGITS
+    assert all(len(code) == 6 and code.isdigit() for code in codes)
+
+
+def test_codes_depend_on_key():
+    first = [reset_tokens.permute_code(number, b"key-1") for number in range(100)]
+    second = [reset_tokens.permute_code(number, b"key-2") for number in range(100)]
+    assert first != second
+    # Соседние выдачи не дают соседних кодов
+    assert first != sorted(first)
+
+
+def test_issued_codes_follow_counter(db):
+    codes = [reset_tokens.issue_reset_token(db, 1).token for _ in range(20)]
+    db.commit()
+    assert codes == [reset_tokens.permute_code(number) for number in range(20)]
+    assert db.query(PasswordResetToken).count() == 20
+
+
+def test_counter_wrap_reuses_expired_code(db):
+    add_token(db, reset_tokens.permute_code(0), datetime.utcnow() - timedelta(minutes=1))
+
+    reset_token = reset_tokens.issue_reset_token(db, 2)
+    db.commit()
+
+    assert reset_token.establishment_id == 2
+    assert db.query(PasswordResetToken).count() == 1
+
+
+def test_code_in_use_is_reported(db):
+    add_token(db, reset_tokens.permute_code(0), datetime.utcnow() + timedelta(hours=1))
+
+    with pytest.raises(RuntimeError):
+        reset_tokens.issue_reset_token(db, 2)
@@ -0,0 +1,162 @@
+"""
+Хранилище файлов (storage.BlobStore): дедупликация, счетчик ссылок и то,
+что файлы меняются только после коммита транзакции
+
+База - SQLite в памяти, файлы - во временном каталоге. Сервер не нужен.
+"""
+import hashlib
+import os
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from database import Base, FileBlob
+from storage import BlobStore
+from thumbnails import THUMBNAIL_SIZES, thumbnail_path
+
+CONTENT = b"%PDF-1.4 test document"
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(str(tmp_path / "blobs"))
+
+
+@pytest.fixture
+def make_temp(tmp_path):
+    """Временный файл загрузки с содержимым CONTENT"""
+    counter = iter(range(1000))
+
+    def make() -> str:
+        path = tmp_path / f"upload_{next(counter)}.part"
+        path.write_bytes(CONTENT)
+        return str(path)
+
+    return make
+
+
+def ref_count(db) -> int:
+    db.expire_all()
+    blob = db.query(FileBlob).filter(FileBlob.sha256 == SHA256).first()
+    return blob.ref_count if blob else None
+
+
+def test_same_content_stored_once(db, store, make_temp):
+    first_temp, second_temp = make_temp(), make_temp()
+
+    first = store.put(db, first_temp, SHA256, len(CONTENT), ".pdf")
+    db.commit()
+    second = store.put(db, second_temp, SHA256, len(CONTENT), ".PDF")
+    db.commit()
+
+    assert first == second == store.blob_path(SHA256, ".pdf")
+    assert open(first, "rb").read() == CONTENT
+    assert ref_count(db) == 2
+    # Повторное содержимое не занимает места: временный файл удален
+    assert not os.path.exists(first_temp)
+    assert not os.path.exists(second_temp)
+
+
+def test_rollback_between_put_and_commit_keeps_upload(db, store, make_temp):
+    temp_path = make_temp()
+
+    store.put(db, temp_path, SHA256, len(CONTENT), ".pdf")
+    db.rollback()
+
+    # Ни записи, ни перенесенного файла; временный файл на месте для повтора
+    assert ref_count(db) is None
+    assert not os.path.exists(store.blob_path(SHA256, ".pdf"))
+    assert os.path.exists(temp_path)
+
+    # Повтор той же записи (так делает write_queue после отката пачки)
+    file_path = store.put(db, temp_path, SHA256, len(CONTENT), ".pdf")
+    db.commit()
+    assert ref_count(db) == 1
+    assert open(file_path, "rb").read() == CONTENT
+    assert not os.path.exists(temp_path)
+
+
+def test_release_keeps_file_until_gc(db, store, make_temp):
+    file_path = store.put(db, make_temp(), SHA256, len(CONTENT), ".pdf")
+    store.put(db, make_temp(), SHA256, len(CONTENT), ".pdf")
+    db.commit()
+
+    store.release(db, file_path)
+    db.commit()
+    assert ref_count(db) == 1
+
+    store.release(db, file_path)
+    db.commit()
+    # Ссылок нет, но файл удалит только сборщик мусора
+    assert ref_count(db) == 0
+    assert os.path.exists(file_path)
+
+    # Лишний release не уводит счетчик в минус
+    store.release(db, file_path)
+    db.commit()
+    assert ref_count(db) == 0
+
+
+def test_release_rolled_back_keeps_reference(db, store, make_temp):
+    file_path = store.put(db, make_temp(), SHA256, len(CONTENT), ".pdf")
+    db.commit()
+
+    store.release(db, file_path)
+    db.rollback()
+
+    assert ref_count(db) == 1
+    assert os.path.exists(file_path)
+
+
+def test_legacy_file_removed_only_after_commit(db, store, tmp_path):
+    legacy = tmp_path / "legacy.pdf"
+    legacy.write_bytes(CONTENT)
+
+    store.release(db, str(legacy))
+    db.rollback()
+    assert legacy.exists()
+
+    store.release(db, str(legacy))
+    db.commit()
+    assert not legacy.exists()
+
+
+def test_legacy_file_thumbnails_removed(db, store, tmp_path):
+    legacy = tmp_path / "legacy.png"
+    legacy.write_bytes(CONTENT)
+    thumbnails = [tmp_path / f"legacy.png.thumb{size}.jpg" for size in THUMBNAIL_SIZES]
+    for thumbnail in thumbnails:
+        thumbnail.write_bytes(b"jpeg")
+
+    store.release(db, str(legacy))
+    db.commit()
+
+    assert not legacy.exists()
+    assert not any(thumbnail.exists() for thumbnail in thumbnails)
+
+
+def test_blob_thumbnails_kept_on_release(db, store, make_temp):
+    file_path = store.put(db, make_temp(), SHA256, len(CONTENT), ".png")
+    db.commit()
+    thumbnail = thumbnail_path(file_path, THUMBNAIL_SIZES[0])
+    open(thumbnail, "wb").write(b"jpeg")
+
+    store.release(db, file_path)
+    db.commit()
+
+    # Файл и миниатюры остаются до сборщика мусора: содержимое могут загрузить снова
+    assert os.path.exists(file_path)
+    assert os.path.exists(thumbnail)
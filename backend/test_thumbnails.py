@@ -0,0 +1,67 @@
+"""
+Миниатюры (thumbnails.py): построение, выбор размера и построение по запросу
+
+Изображения создаются Pillow во временном каталоге. Сервер не нужен.
+"""
+import asyncio
+import os
+
+import pytest
+from PIL import Image
+
+import thumbnails
+from thumbnails import THUMBNAIL_SIZES, pick_size, render_thumbnails, supports_thumbnails, thumbnail_path
+
+
+@pytest.fixture
+def image(tmp_path):
+    path = tmp_path / "photo.png"
+    Image.new("RGBA", (1200, 600), (200, 10, 10, 255)).save(path)
+    return str(path)
+
+
+def test_all_sizes_rendered(image):
+    paths = render_thumbnails(image, THUMBNAIL_SIZES)
+
+    assert paths == [thumbnail_path(image, size) for size in THUMBNAIL_SIZES]
+    for size, path in zip(THUMBNAIL_SIZES, paths):
+        with Image.open(path) as thumbnail:
+            assert thumbnail.format == "JPEG"
+            # По длинной стороне, с сохранением пропорций
+            assert thumbnail.size == (size, size // 2)
+    assert not [name for name in os.listdir(os.path.dirname(image)) if name.endswith(".tmp")]
+
+
+def test_existing_thumbnail_not_rebuilt(image):
+    existing = thumbnail_path(image, THUMBNAIL_SIZES[0])
+    with open(existing, "wb") as f:
+        f.write(b"cached")
+
+    render_thumbnails(image, THUMBNAIL_SIZES)
+
+    assert open(existing, "rb").read() == b"cached"
+    assert os.path.exists(thumbnail_path(image, THUMBNAIL_SIZES[-1]))
+
+
+@pytest.mark.parametrize("requested, expected", [(1, 128), (128, 128), (129, 256), (300, 512), (5000, 512)])
+def test_pick_size(requested, expected):
+    assert pick_size(requested) == expected
+
+
+@pytest.mark.parametrize("file_name, expected", [
+    ("scan.JPG", True), ("photo.png", True), ("charter.pdf", False), ("", False), (None, False)
+])
+def test_supports_thumbnails(file_name, expected):
+    assert supports_thumbnails(file_name) is expected
+
+
+def test_missing_thumbnail_built_on_demand(image, monkeypatch):
+    # Пул потоков по умолчанию вместо пула процессов
+    monkeypatch.setattr(thumbnails, "_get_executor", lambda: None)
+
+    path = asyncio.run(thumbnails.get_thumbnail(image, 256))
+
+    assert path == thumbnail_path(image, 256)
+    assert os.path.exists(path)
+    # Построена только запрошенная миниатюра
+    assert not os.path.exists(thumbnail_path(image, 128))
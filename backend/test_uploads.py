@@ -0,0 +1,195 @@
+"""
+Прием загрузок (uploads.py): потоковый разбор multipart с параллельной записью
+файлов и сессии возобновляемой загрузки
+
+Тело запроса подается кусками через поддельный Request. Сервер не нужен.
+"""
+import asyncio
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import uploads
+from database import Base, FileBlob
+from storage import BlobStore
+from uploads import StreamingUpload, UploadSessionStore
+
+BOUNDARY = "test-boundary"
+
+
+class FakeRequest:
+    """Запрос с заголовками и телом, которое приходит кусками по chunk_size байт"""
+
+    def __init__(self, body: bytes, chunk_size: int = 7):
+        self.headers = {"content-type": f"multipart/form-data; boundary={BOUNDARY}"}
+        self.body = body
+        self.chunk_size = chunk_size
+
+    async def stream(self):
+        for start in range(0, len(self.body), self.chunk_size):
+            yield self.body[start:start + self.chunk_size]
+            await asyncio.sleep(0)
+
+
+def multipart_body(fields: dict, files: dict) -> bytes:
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode()
+            + value.encode() + b"\r\n"
+        )
+    for name, (filename, content) in files.items():
+        parts.append(
+            f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: application/pdf\r\n\r\n'.encode()
+            + content + b"\r\n"
+        )
+    return b"".join(parts) + f"--{BOUNDARY}--\r\n".encode()
+
+
+def receive(body: bytes, upload_dir, **kwargs) -> StreamingUpload:
+    upload = StreamingUpload(FakeRequest(body), str(upload_dir), max_files=5, **kwargs)
+    asyncio.run(upload.receive())
+    return upload
+
+
+def test_files_and_fields_written(tmp_path, monkeypatch):
+    # Маленькая очередь: запись отстает от приема и упирается в ограничение
+    monkeypatch.setattr(uploads, "WRITE_BUFFER_CHUNKS", 1)
+    contents = {"a": b"%PDF-1.4 first" * 50, "b": b"%PDF-1.4 second" * 70}
+    body = multipart_body(
+        {"documents": "[]"},
+        {name: (f"{name}.pdf", content) for name, content in contents.items()}
+    )
+
+    upload = receive(body, tmp_path)
+
+    assert upload.fields == {"documents": "[]"}
+    for name, content in contents.items():
+        streamed_file = upload.files[name]
+        assert open(streamed_file.temp_path, "rb").read() == content
+        assert streamed_file.size == len(content)
+        assert streamed_file.sha256 == hashlib.sha256(content).hexdigest()
+
+
+def test_incomplete_part_rejected(tmp_path):
+    body = multipart_body({}, {"a": ("a.pdf", b"%PDF-1.4 content")})
+    # Тело оборвано посреди файла
+    truncated = body[:body.index(b"content") + 3]
+
+    with pytest.raises(HTTPException) as error:
+        receive(truncated, tmp_path)
+
+    assert error.value.status_code == 400
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_too_large_file_removed(tmp_path):
+    body = multipart_body({}, {"a": ("a.pdf", b"x" * 100), "b": ("b.pdf", b"y" * 1000)})
+
+    with pytest.raises(HTTPException) as error:
+        receive(body, tmp_path, max_file_size=500)
+
+    assert error.value.status_code == 413
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_write_error_propagates(tmp_path):
+    body = multipart_body({}, {"a": ("a.pdf", b"%PDF-1.4 data")})
+
+    with pytest.raises(OSError):
+        receive(body, tmp_path / "missing")
+
+
+# ---- сессии возобновляемой загрузки ----
+
+SCAN = b"%PDF-1.4 scan " * 1000
+
+
+def append(store: UploadSessionStore, upload_id: str, offset: int, chunk: bytes) -> int:
+    async def run():
+        async with store.lock(upload_id):
+            session = store.get(upload_id)
+            return await store.append(session, offset, FakeRequest(chunk, chunk_size=4096))
+    return asyncio.run(run())
+
+
+def test_chunks_from_different_workers_finalize(tmp_path):
+    # Два экземпляра хранилища - как два воркера с общим каталогом сессий
+    first, second = UploadSessionStore(str(tmp_path)), UploadSessionStore(str(tmp_path))
+    upload_id = first.create(1, "charter", "scan.pdf", len(SCAN))["upload_id"]
+
+    assert append(first, upload_id, 0, SCAN[:5000]) == 5000
+    assert append(second, upload_id, 5000, SCAN[5000:]) == len(SCAN)
+    assert first.get(upload_id)["offset"] == len(SCAN)
+
+    # Завершение: хеш по файлу на диске, файл уходит в хранилище
+    sha256 = asyncio.run(second.sha256(upload_id))
+    assert sha256 == hashlib.sha256(SCAN).hexdigest()
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    file_path = BlobStore(str(tmp_path / "blobs")).put(db, second.data_path(upload_id), sha256, len(SCAN), ".pdf")
+    db.commit()
+    second.delete(upload_id)
+
+    assert open(file_path, "rb").read() == SCAN
+    assert db.query(FileBlob).one().ref_count == 1
+    assert first.get(upload_id) is None
+    db.close()
+    engine.dispose()
+
+
+def test_offset_mismatch(tmp_path):
+    store = UploadSessionStore(str(tmp_path))
+    upload_id = store.create(1, "charter", "scan.pdf", len(SCAN))["upload_id"]
+    append(store, upload_id, 0, SCAN[:100])
+
+    with pytest.raises(HTTPException) as error:
+        append(store, upload_id, 0, SCAN[:100])
+
+    assert error.value.status_code == 409
+    assert error.value.headers["Upload-Offset"] == "100"
+
+
+def test_busy_session_rejected_across_workers(tmp_path):
+    first, second = UploadSessionStore(str(tmp_path)), UploadSessionStore(str(tmp_path))
+    upload_id = first.create(1, "charter", "scan.pdf", len(SCAN))["upload_id"]
+
+    async def run():
+        async with first.lock(upload_id):
+            with pytest.raises(HTTPException) as error:
+                async with second.lock(upload_id):
+                    pass
+            assert error.value.status_code == 409
+            # Истекшую, но занятую сессию очистка не трогает
+            assert second.try_lock(upload_id) is None
+        async with second.lock(upload_id):
+            pass
+
+    asyncio.run(run())
+
+
+def test_expired_sessions_purged_only_by_gc(tmp_path):
+    store = UploadSessionStore(str(tmp_path))
+    upload_id = store.create(1, "charter", "scan.pdf", len(SCAN))["upload_id"]
+    meta_path = tmp_path / f"{upload_id}.json"
+    meta = json.loads(meta_path.read_text())
+    meta["expires_at"] = (datetime.utcnow() - timedelta(minutes=1)).isoformat()
+    meta_path.write_text(json.dumps(meta))
+
+    # Новая сессия и чтение истекшей ничего не удаляют
+    store.create(1, "charter", "other.pdf", len(SCAN))
+    assert store.get(upload_id) is None
+    assert os.path.exists(store.data_path(upload_id))
+
+    assert store.purge_expired() == 1
+    assert not os.path.exists(store.data_path(upload_id))
+    assert not meta_path.exists()
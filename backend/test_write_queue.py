@@ -0,0 +1,156 @@
+"""
+Групповой коммит (write_queue.py): пачки, результаты по запросам, изоляция
+ошибок через SAVEPOINT, отмененные запросы и метрики
+
+База - SQLite во временном файле через aiosqlite, с профилем писателя
+из database.py. Сервер не нужен.
+"""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from database import Base, MaintenanceState, apply_sqlite_profile, run_after_commit
+from write_queue import WriteCoalescer
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = tmp_path / "queue.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    engine.dispose()
+    return path
+
+
+def run_queue(db_path, scenario, **kwargs):
+    """Выполняет scenario(queue) на своем event loop и возвращает его результат и имена в таблице"""
+    async def run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+        apply_sqlite_profile(engine.sync_engine)
+        queue = WriteCoalescer(async_sessionmaker(bind=engine, expire_on_commit=False), **kwargs)
+        try:
+            result = await scenario(queue)
+            await queue.stop()
+            async with engine.connect() as conn:
+                names = set((await conn.execute(select(MaintenanceState.name))).scalars())
+            return queue, result, names
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(run())
+
+
+def add_state(name, calls=None):
+    def op(session):
+        if calls is not None:
+            calls.append(name)
+        session.add(MaintenanceState(name=name, value=name))
+        return name
+    return op
+
+
+def test_concurrent_writes_share_one_commit(db_path):
+    async def scenario(queue):
+        return await asyncio.gather(*(queue.submit(add_state(f"k{i}")) for i in range(5)))
+
+    queue, results, names = run_queue(db_path, scenario)
+
+    assert results == [f"k{i}" for i in range(5)]
+    assert names == {f"k{i}" for i in range(5)}
+    assert queue.batches == 1
+    assert queue.writes == 5
+
+
+def test_batch_limited_by_max_batch(db_path):
+    async def scenario(queue):
+        return await asyncio.gather(*(queue.submit(add_state(f"k{i}")) for i in range(5)))
+
+    queue, _, names = run_queue(db_path, scenario, max_batch=2)
+
+    assert len(names) == 5
+    assert queue.batches == 3
+    assert queue.max_batch_size == 2
+
+
+def test_failed_write_rolls_back_only_itself(db_path):
+    calls = []
+    done = []
+
+    def not_found(session):
+        calls.append("missing")
+        session.add(MaintenanceState(name="missing", value="x"))
+        run_after_commit(session, lambda: done.append("missing"))
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    def first(session):
+        run_after_commit(session, lambda: done.append("first"))
+        return add_state("first", calls)(session)
+
+    async def scenario(queue):
+        return await asyncio.gather(
+            queue.submit(first),
+            queue.submit(not_found),
+            queue.submit(add_state("second", calls)),
+            # Нарушение PRIMARY KEY обнаруживается при flush - тоже внутри точки сохранения
+            queue.submit(add_state("first", calls)),
+            return_exceptions=True
+        )
+
+    queue, results, names = run_queue(db_path, scenario)
+
+    assert results[0] == "first" and results[2] == "second"
+    assert isinstance(results[1], HTTPException) and results[1].status_code == 404
+    assert isinstance(results[3], IntegrityError)
+    assert names == {"first", "second"}
+    # Каждая запись выполнена ровно один раз, пачка не повторялась
+    assert calls == ["first", "missing", "second", "first"]
+    # Действия после коммита откатившейся записи не выполняются
+    assert done == ["first"]
+    assert queue.batches == 1
+    assert queue.writes == 2
+    assert queue.failed_writes == 2
+    assert queue.failed_batches == 0
+
+
+def test_cancelled_request_not_written(db_path):
+    calls = []
+
+    async def scenario(queue):
+        cancelled = asyncio.create_task(queue.submit(add_state("cancelled", calls)))
+        kept = asyncio.create_task(queue.submit(add_state("kept", calls)))
+        await asyncio.sleep(0)
+        # Клиент отключился, пока запись ждала своей пачки
+        cancelled.cancel()
+        return await kept
+
+    queue, result, names = run_queue(db_path, scenario, window_ms=50)
+
+    assert result == "kept"
+    assert names == {"kept"}
+    assert calls == ["kept"]
+    assert queue.writes == 1
+
+
+def test_stats(db_path):
+    def forbidden(session):
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    async def scenario(queue):
+        await asyncio.gather(*(queue.submit(add_state(f"k{i}")) for i in range(3)))
+        with pytest.raises(HTTPException):
+            await queue.submit(forbidden)
+        return queue.stats()
+
+    _, stats, _ = run_queue(db_path, scenario)
+
+    assert stats["batches"] == 2
+    assert stats["writes"] == 3
+    assert stats["failed_writes"] == 1
+    assert stats["pending"] == 0
+    assert stats["max_batch_size"] == 3
+    assert stats["avg_batch_size"] == 2.0
+    assert stats["commit_latency_ms"]["p50"] is not None
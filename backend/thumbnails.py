@@ -0,0 +1,103 @@
+"""
+Миниатюры загруженных изображений (Pillow)
+
+Для каждого загруженного .jpg/.jpeg/.png заранее строятся миниатюры нескольких
+фиксированных размеров (фоновой задачей из очереди jobs). Работа идет в отдельном
+пуле процессов, поэтому не занимает ни event loop, ни GIL процесса с запросами.
+Миниатюры лежат рядом с оригиналом: {file_path}.thumb{size}.jpg
+"""
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from PIL import Image, ImageOps
+
+# Размеры миниатюр (по длинной стороне, пиксели)
+THUMBNAIL_SIZES = [128, 256, 512]
+
+# Расширения, для которых строятся миниатюры
+THUMBNAIL_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+
+# Количество процессов для генерации миниатюр
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def supports_thumbnails(file_name: Optional[str]) -> bool:
+    """Можно ли построить миниатюру для файла с таким именем"""
+    return bool(file_name) and os.path.splitext(file_name)[1].lower() in THUMBNAIL_EXTENSIONS
+
+
+def thumbnail_path(file_path: str, size: int) -> str:
+    return f"{file_path}.thumb{size}.jpg"
+
+
+def thumbnail_paths(file_path: str) -> List[str]:
+    """Пути всех возможных миниатюр файла"""
+    return [thumbnail_path(file_path, size) for size in THUMBNAIL_SIZES]
+
+
+def pick_size(requested: int) -> int:
+    """Наименьший из фиксированных размеров, не меньший запрошенного"""
+    for size in THUMBNAIL_SIZES:
+        if size >= requested:
+            return size
+    return THUMBNAIL_SIZES[-1]
+
+
+def render_thumbnails(file_path: str, sizes: List[int]) -> List[str]:
+    """
+    Строит недостающие миниатюры файла (выполняется в процессе пула)
+
+    Returns:
+        Пути к миниатюрам запрошенных размеров
+    """
+    missing = [size for size in sizes if not os.path.exists(thumbnail_path(file_path, size))]
+    if missing:
+        with Image.open(file_path) as img:
+            # Для JPEG декодируем сразу в уменьшенном масштабе - это в разы быстрее
+            img.draft("RGB", (max(missing), max(missing)))
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            # От большего размера к меньшему: каждую следующую строим из предыдущей
+            for size in sorted(missing, reverse=True):
+                img.thumbnail((size, size))
+                target = thumbnail_path(file_path, size)
+                tmp_path = f"{target}.{os.getpid()}.tmp"
+                img.save(tmp_path, "JPEG", quality=85, optimize=True)
+                os.replace(tmp_path, target)
+    return [thumbnail_path(file_path, size) for size in sizes]
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+    return _executor
+
+
+async def generate_thumbnails(file_path: str) -> List[str]:
+    """Строит все миниатюры файла в пуле процессов"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), render_thumbnails, file_path, THUMBNAIL_SIZES)
+
+
+async def get_thumbnail(file_path: str, size: int) -> str:
+    """Возвращает путь к миниатюре, при необходимости строит ее сейчас"""
+    path = thumbnail_path(file_path, size)
+    if os.path.exists(path):
+        return path
+    loop = asyncio.get_running_loop()
+    paths = await loop.run_in_executor(_get_executor(), render_thumbnails, file_path, [size])
+    return paths[0]
+
+
+def shutdown() -> None:
+    """Останавливает пул процессов (при остановке приложения)"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,227 @@
+"""
+Список отзыва токенов
+
+Access-токен живет недолго (ACCESS_TOKEN_EXPIRE_MINUTES), но до истечения его
+все равно нужно уметь отозвать: выход, сброс пароля, украденный refresh-токен.
+Отозванные идентификаторы (jti отдельного токена или sid - вся цепочка входа)
+хранятся в таблице revoked_tokens до истечения последнего access-токена,
+который мог их нести.
+
+Проверять таблицу на каждом запросе - это снова поход в БД. Поэтому каждый
+воркер держит в памяти фильтр Блума по всем действующим записям таблицы:
+- "нет в фильтре" - токен точно не отозван, БД не нужна (почти все запросы);
+- "есть в фильтре" - возможно ложное срабатывание, ответ уточняется по таблице.
+
+Свои отзывы воркер добавляет в фильтр сразу, чужие - при перестроении фильтра
+из таблицы раз в REVOCATION_SYNC_SECONDS. Перестроение же выкидывает
+истекшие записи, так что фильтр не засоряется.
+"""
+import asyncio
+import hashlib
+import math
+import os
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Optional
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from database import ReadSessionLocal, RevokedToken, SessionLocal
+
+# Период перестроения фильтра из таблицы (секунды) - задержка, с которой
+# отзыв из другого воркера начинает действовать в этом
+REVOCATION_SYNC_SECONDS = float(os.getenv("REVOCATION_SYNC_SECONDS", "5"))
+
+# На сколько записей рассчитан фильтр (при большем числе он растет при перестроении)
+REVOCATION_FILTER_CAPACITY = int(os.getenv("REVOCATION_FILTER_CAPACITY", "10000"))
+
+# Доля ложных срабатываний фильтра (каждое - один запрос к таблице)
+REVOCATION_FILTER_ERROR_RATE = float(os.getenv("REVOCATION_FILTER_ERROR_RATE", "0.001"))
+
+
+class BloomFilter:
+    """
+    Фильтр Блума над строками
+
+    Args:
+        capacity: Ожидаемое число элементов
+        error_rate: Допустимая доля ложных срабатываний при capacity элементах
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(capacity, 1)
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str) -> Iterable[int]:
+        # Двойное хеширование: k позиций из двух 64-битных половин одного дайджеста
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RevocationList:
+    """
+    Отозванные jti/sid: фильтр Блума в памяти + таблица revoked_tokens
+
+    Args:
+        session_factory: Фабрика синхронных сессий для перестроения фильтра (только
+            чтение: пул чтения, а не соединение писателя)
+        sync_interval: Период перестроения фильтра (секунды)
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session] = ReadSessionLocal,
+        sync_interval: float = REVOCATION_SYNC_SECONDS
+    ):
+        self.session_factory = session_factory
+        self.sync_interval = sync_interval
+        self._filter = BloomFilter(REVOCATION_FILTER_CAPACITY, REVOCATION_FILTER_ERROR_RATE)
+        self._lock = threading.Lock()
+        # Свои отзывы до истечения: перестроение могло прочитать таблицу до их коммита
+        self._local: Dict[str, datetime] = {}
+        self._task: Optional[asyncio.Task] = None
+        # Метрики
+        self.rebuilds = 0
+        self.last_rebuild_at: Optional[datetime] = None
+        self.filter_positives = 0
+        self.confirmed = 0
+
+    def might_be_revoked(self, *token_ids: Optional[str]) -> bool:
+        """Проверка в памяти: False - точно не отозван"""
+        bloom = self._filter
+        for token_id in token_ids:
+            if token_id and token_id in bloom:
+                self.filter_positives += 1
+                return True
+        return False
+
+    def _revoked_query(self, token_ids: Iterable[Optional[str]]):
+        return select(RevokedToken.token_id).where(
+            RevokedToken.token_id.in_([token_id for token_id in token_ids if token_id]),
+            RevokedToken.expires_at > datetime.utcnow()
+        ).limit(1)
+
+    def is_revoked(self, db: Session, *token_ids: Optional[str]) -> bool:
+        """Фильтр, а при срабатывании - уточнение по таблице"""
+        if not self.might_be_revoked(*token_ids):
+            return False
+        revoked = db.execute(self._revoked_query(token_ids)).first() is not None
+        if revoked:
+            self.confirmed += 1
+        return revoked
+
+    async def is_revoked_async(self, db: AsyncSession, *token_ids: Optional[str]) -> bool:
+        """То же, что is_revoked, с асинхронной сессией"""
+        if not self.might_be_revoked(*token_ids):
+            return False
+        revoked = (await db.execute(self._revoked_query(token_ids))).first() is not None
+        if revoked:
+            self.confirmed += 1
+        return revoked
+
+    def revoke(self, db: Session, token_id: str, expires_at: datetime) -> None:
+        """
+        Отзывает jti или sid до expires_at в текущей транзакции (коммит делает вызывающий код)
+
+        В фильтр этого воркера идентификатор попадает сразу: лишнее срабатывание
+        при откате транзакции только уточнится по таблице.
+        """
+        db.execute(
+            sqlite_insert(RevokedToken)
+            .values(token_id=token_id, expires_at=expires_at, created_at=datetime.utcnow())
+            .on_conflict_do_update(index_elements=["token_id"], set_={"expires_at": expires_at})
+        )
+        with self._lock:
+            self._filter.add(token_id)
+            self._local[token_id] = expires_at
+
+    def rebuild(self) -> int:
+        """Перестраивает фильтр по действующим записям таблицы"""
+        db = self.session_factory()
+        try:
+            token_ids = db.execute(
+                select(RevokedToken.token_id).where(RevokedToken.expires_at > datetime.utcnow())
+            ).scalars().all()
+        finally:
+            db.close()
+        bloom = BloomFilter(max(REVOCATION_FILTER_CAPACITY, len(token_ids) * 2), REVOCATION_FILTER_ERROR_RATE)
+        for token_id in token_ids:
+            bloom.add(token_id)
+        now = datetime.utcnow()
+        with self._lock:
+            self._local = {token_id: expires_at for token_id, expires_at in self._local.items() if expires_at > now}
+            for token_id in self._local:
+                bloom.add(token_id)
+            self._filter = bloom
+        self.rebuilds += 1
+        self.last_rebuild_at = datetime.utcnow()
+        return len(token_ids)
+
+    def purge(self, session_factory: Callable[[], Session] = SessionLocal) -> int:
+        """Удаляет истекшие записи (токены, которые они отзывали, уже истекли сами)"""
+        db = session_factory()
+        try:
+            result = db.execute(delete(RevokedToken).where(RevokedToken.expires_at <= datetime.utcnow()))
+            db.commit()
+            return result.rowcount
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def start(self) -> None:
+        """Строит фильтр до приема запросов и запускает периодическое перестроение"""
+        await asyncio.to_thread(self.rebuild)
+        if self._task is None and self.sync_interval > 0:
+            self._task = asyncio.create_task(self._sync_loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _sync_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await asyncio.to_thread(self.rebuild)
+            except Exception as e:
+                print(f"[revocation] Filter rebuild failed: {e}")
+
+    def stats(self) -> dict:
+        bloom = self._filter
+        return {
+            "entries": bloom.count,
+            "filter_bits": bloom.size,
+            "filter_hashes": bloom.hashes,
+            "sync_interval_seconds": self.sync_interval,
+            "rebuilds": self.rebuilds,
+            "last_rebuild_at": self.last_rebuild_at,
+            "filter_positives": self.filter_positives,
+            "confirmed_revocations": self.confirmed,
+        }
+
+
+# Список отзыва приложения
+revocation_list = RevocationList()
@@ -0,0 +1,534 @@
+"""
+Потоковый прием multipart-загрузок напрямую на диск
+
+Файл не читается целиком в память: куски тела запроса идут из multipart-парсера
+сразу в файл через неблокирующую запись (aiofiles). Проверка расширения и размера
+выполняется во время передачи, поэтому слишком большие файлы отклоняются сразу,
+а потребление памяти не зависит от размера файла.
+
+У каждого файла своя задача записи с ограниченной очередью кусков: прием тела
+не ждет диска, а файлы пакетной загрузки пишутся параллельно друг другу.
+
+Здесь же хранилище сессий возобновляемой (по кускам) загрузки для больших сканов.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Windows (локальная разработка в один процесс) - блокировки внутри процесса
+    fcntl = None
+
+import aiofiles
+from fastapi import HTTPException, Request
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
+
+# Разрешенные расширения документов
+ALLOWED_DOCUMENT_EXTENSIONS = ['.pdf', '.jpg', '.jpeg', '.png', '.doc', '.docx']
+
+# Максимальный размер документа (по умолчанию 250 МБ - сканы уставов бывают большими)
+MAX_DOCUMENT_SIZE = int(os.getenv("MAX_DOCUMENT_SIZE_MB", "250")) * 1024 * 1024
+
+# Логотип заведения: только изображения до 5 МБ
+ALLOWED_LOGO_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.webp']
+ALLOWED_LOGO_TYPES = ["image/jpeg", "image/jpg", "image/png", "image/gif", "image/webp"]
+MAX_LOGO_SIZE = 5 * 1024 * 1024
+
+# Максимальный размер обычного (не файлового) поля формы
+MAX_FIELD_SIZE = 64 * 1024
+
+# Сколько кусков одного файла может ждать записи на диск
+WRITE_BUFFER_CHUNKS = 16
+
+
+class StreamedFile:
+    """Файл, принятый из multipart-запроса и записанный на диск"""
+
+    def __init__(self, field_name: str, filename: str, content_type: Optional[str], temp_path: str):
+        self.field_name = field_name
+        self.filename = filename
+        self.content_type = content_type
+        self.temp_path = temp_path
+        self.size = 0
+        # Хеш считается по мере прихода данных - без отдельного прохода по файлу
+        self._hasher = hashlib.sha256()
+        # Очередь кусков и задача, которая пишет их на диск (None в очереди - конец файла)
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer: Optional[asyncio.Task] = None
+        # Часть multipart дошла до конца
+        self.complete = False
+
+    @property
+    def sha256(self) -> str:
+        return self._hasher.hexdigest()
+
+    def start_writer(self) -> None:
+        """Запускает задачу записи файла"""
+        self._queue = asyncio.Queue(maxsize=WRITE_BUFFER_CHUNKS)
+        self._writer = asyncio.create_task(self._write())
+
+    async def _write(self) -> None:
+        async with aiofiles.open(self.temp_path, "wb") as f:
+            while True:
+                chunk = await self._queue.get()
+                if chunk is None:
+                    return
+                await f.write(chunk)
+
+    async def put(self, chunk: Optional[bytes]) -> None:
+        """
+        Передает кусок на запись (None - конец файла)
+
+        Ждет, только если очередь файла заполнена. Если запись упала,
+        пробрасывает ее ошибку.
+        """
+        if self._writer.done():
+            self._writer.result()
+            return
+        try:
+            self._queue.put_nowait(chunk)
+            return
+        except asyncio.QueueFull:
+            pass
+        put = asyncio.ensure_future(self._queue.put(chunk))
+        try:
+            await asyncio.wait({put, self._writer}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not put.done():
+                put.cancel()
+        if not put.done() or put.cancelled():
+            self._writer.result()
+
+    async def finish(self) -> None:
+        """Ждет, пока файл будет записан целиком"""
+        if self._writer is not None:
+            await self._writer
+
+    async def abort(self) -> None:
+        """Останавливает запись (файл удаляет discard)"""
+        if self._writer is None:
+            return
+        # Не cancel: открытие или запись в потоке завершились бы уже после discard.
+        # Недописанные куски выбрасываем, задача закроет файл и выйдет
+        if not self._writer.done():
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait(None)
+        try:
+            await self._writer
+        except Exception:
+            pass
+
+    def discard(self) -> None:
+        """Удаляет временный файл, если он еще существует"""
+        if self.temp_path and os.path.exists(self.temp_path):
+            try:
+                os.remove(self.temp_path)
+            except OSError as e:
+                print(f"Error removing temp upload {self.temp_path}: {e}")
+        self.temp_path = None
+
+
+class StreamingUpload:
+    """
+    Разбирает multipart-тело запроса потоково, записывая файлы на диск по кускам
+
+    Args:
+        request: Входящий запрос FastAPI
+        upload_dir: Каталог для временных файлов (та же ФС, что и у итоговых файлов)
+        allowed_extensions: Разрешенные расширения файлов (None - любые)
+        max_file_size: Максимальный размер одного файла в байтах
+        max_files: Максимальное количество файлов в запросе
+    """
+
+    def __init__(
+        self,
+        request: Request,
+        upload_dir: str,
+        allowed_extensions: Optional[List[str]] = None,
+        max_file_size: int = MAX_DOCUMENT_SIZE,
+        max_files: int = 1,
+    ):
+        self.request = request
+        self.upload_dir = upload_dir
+        self.allowed_extensions = allowed_extensions
+        self.max_file_size = max_file_size
+        self.max_files = max_files
+        self.fields: Dict[str, str] = {}
+        self.files: Dict[str, StreamedFile] = {}
+
+        self._part_headers: Dict[bytes, bytes] = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._field_name: Optional[str] = None
+        self._field_data = b""
+        self._current_file: Optional[StreamedFile] = None
+        # Операции с файлами, накопленные синхронными колбэками парсера
+        self._pending: List[tuple] = []
+
+    # ---- колбэки multipart-парсера (синхронные) ----
+
+    def _on_part_begin(self) -> None:
+        self._part_headers = {}
+        self._field_name = None
+        self._field_data = b""
+        self._current_file = None
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._part_headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._part_headers.get(b"content-disposition", b""))
+        if b"name" not in options:
+            raise HTTPException(status_code=400, detail="Malformed multipart body: part without name")
+        self._field_name = options[b"name"].decode("utf-8", errors="replace")
+
+        if b"filename" not in options:
+            return
+
+        filename = options[b"filename"].decode("utf-8", errors="replace")
+        if not filename:
+            raise HTTPException(status_code=400, detail="No file provided")
+        if self._field_name in self.files:
+            raise HTTPException(status_code=400, detail=f"Duplicate file field '{self._field_name}'")
+        if len(self.files) >= self.max_files:
+            raise HTTPException(status_code=400, detail=f"Too many files. Maximum number of files is {self.max_files}")
+
+        # Проверяем расширение до того, как на диск попадет хоть один байт
+        if self.allowed_extensions is not None:
+            file_ext = os.path.splitext(filename)[1].lower()
+            if file_ext not in self.allowed_extensions:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"File type not allowed. Allowed types: {', '.join(self.allowed_extensions)}"
+                )
+
+        content_type = self._part_headers.get(b"content-type")
+        temp_path = os.path.join(self.upload_dir, f".{uuid.uuid4()}.part")
+        self._current_file = StreamedFile(
+            self._field_name,
+            filename,
+            content_type.decode("latin-1") if content_type else None,
+            temp_path,
+        )
+        self.files[self._field_name] = self._current_file
+        self._pending.append(("open", self._current_file))
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        chunk = data[start:end]
+        if self._current_file is None:
+            self._field_data += chunk
+            if len(self._field_data) > MAX_FIELD_SIZE:
+                raise HTTPException(status_code=400, detail=f"Form field '{self._field_name}' is too large")
+            return
+
+        self._current_file.size += len(chunk)
+        if self._current_file.size > self.max_file_size:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File size exceeds {self.max_file_size // (1024 * 1024)}MB limit"
+            )
+        self._current_file._hasher.update(chunk)
+        self._pending.append(("data", self._current_file, chunk))
+
+    def _on_part_end(self) -> None:
+        if self._current_file is None:
+            self.fields[self._field_name] = self._field_data.decode("utf-8", errors="replace")
+        else:
+            self._pending.append(("close", self._current_file))
+
+    # ---- асинхронная часть ----
+
+    async def _flush_pending(self) -> None:
+        """Передает накопленные операции с файлами их задачам записи"""
+        for op in self._pending:
+            streamed_file = op[1]
+            if op[0] == "open":
+                streamed_file.start_writer()
+            elif op[0] == "data":
+                await streamed_file.put(op[2])
+            elif op[0] == "close":
+                await streamed_file.put(None)
+                streamed_file.complete = True
+        self._pending.clear()
+
+    async def receive(self) -> "StreamingUpload":
+        """Читает тело запроса и раскладывает поля и файлы"""
+        content_type, params = parse_options_header(self.request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise HTTPException(status_code=400, detail="Expected multipart/form-data request")
+
+        # Если клиент заранее сообщил размер тела - отклоняем запрос, не читая его
+        content_length = self.request.headers.get("content-length")
+        if content_length and content_length.isdigit():
+            if int(content_length) > (self.max_file_size + MAX_FIELD_SIZE * 4) * self.max_files:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"File size exceeds {self.max_file_size // (1024 * 1024)}MB limit"
+                )
+
+        callbacks = {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        }
+        parser = MultipartParser(params[b"boundary"], callbacks)
+
+        try:
+            async for chunk in self.request.stream():
+                parser.write(chunk)
+                await self._flush_pending()
+            parser.finalize()
+            await self._flush_pending()
+            if not all(streamed_file.complete for streamed_file in self.files.values()):
+                raise HTTPException(status_code=400, detail="Malformed multipart body: incomplete file part")
+            # Файлы, которые еще дописываются, пишутся параллельно
+            await asyncio.gather(*(streamed_file.finish() for streamed_file in self.files.values()))
+        except MultipartParseError as e:
+            await self.cleanup()
+            raise HTTPException(status_code=400, detail=f"Malformed multipart body: {e}")
+        except BaseException:
+            await self.cleanup()
+            raise
+
+        return self
+
+    async def cleanup(self) -> None:
+        """Закрывает и удаляет все временные файлы, которые не были перенесены"""
+        self._pending.clear()
+        for streamed_file in self.files.values():
+            await streamed_file.abort()
+            streamed_file.discard()
+
+
+class UploadSessionStore:
+    """
+    Хранилище сессий возобновляемой загрузки на диске
+
+    Каждая сессия - это пара файлов в каталоге сессий:
+    {upload_id}.json (метаданные) и {upload_id}.part (уже принятые байты).
+    Текущее смещение всегда равно размеру .part файла, поэтому после падения
+    процесса загрузку можно продолжить с последнего записанного байта.
+
+    Состояния в памяти процесса нет: куски одной сессии могут прийти в разные
+    воркеры. Запись куска и завершение идут под flock на файле данных, хеш
+    считается при завершении по файлу на диске. Истекшие сессии удаляет
+    сборщик мусора (purge_expired).
+
+    Args:
+        sessions_dir: Каталог для сессий (должен быть на той же ФС, что и UPLOAD_DIR)
+        ttl_hours: Время жизни незавершенной сессии
+    """
+
+    def __init__(self, sessions_dir: str, ttl_hours: int = 24):
+        self.sessions_dir = sessions_dir
+        self.ttl = timedelta(hours=ttl_hours)
+        # Только без fcntl: блокировки на сессию внутри процесса
+        self._locks: Dict[str, asyncio.Lock] = {}
+        os.makedirs(sessions_dir, exist_ok=True)
+
+    def _meta_path(self, upload_id: str) -> str:
+        return os.path.join(self.sessions_dir, f"{upload_id}.json")
+
+    def data_path(self, upload_id: str) -> str:
+        return os.path.join(self.sessions_dir, f"{upload_id}.part")
+
+    @asynccontextmanager
+    async def lock(self, upload_id: str) -> AsyncIterator[None]:
+        """
+        Исключительная блокировка сессии (общая для всех воркеров)
+
+        Не ждет: если сессией занят другой запрос, отвечает 409 - клиент
+        повторит кусок, узнав смещение через GET.
+
+        Raises:
+            HTTPException: 404 - сессии нет; 409 - сессия занята
+        """
+        busy = HTTPException(status_code=409, detail="Upload session is busy, retry later")
+        if fcntl is None:
+            lock = self._locks.setdefault(upload_id, asyncio.Lock())
+            if lock.locked():
+                raise busy
+            async with lock:
+                yield
+            return
+
+        try:
+            fd = os.open(self.data_path(upload_id), os.O_RDONLY)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Upload session not found or expired")
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise busy
+            yield
+        finally:
+            # Закрытие дескриптора снимает блокировку
+            os.close(fd)
+
+    def try_lock(self, upload_id: str) -> Optional[int]:
+        """
+        Блокировка для фоновой очистки (без ожидания)
+
+        Returns:
+            Дескриптор, который нужно закрыть (-1 - закрывать нечего),
+            или None, если сессия занята
+        """
+        if fcntl is None:
+            lock = self._locks.get(upload_id)
+            return -1 if lock is None or not lock.locked() else None
+        try:
+            fd = os.open(self.data_path(upload_id), os.O_RDONLY)
+        except FileNotFoundError:
+            return -1
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def create(self, establishment_id: int, document_type: str, file_name: str, file_size: int) -> dict:
+        """Создает новую сессию загрузки и пустой файл данных"""
+        upload_id = uuid.uuid4().hex
+        now = datetime.utcnow()
+        session = {
+            "upload_id": upload_id,
+            "establishment_id": establishment_id,
+            "document_type": document_type,
+            "file_name": file_name,
+            "file_size": file_size,
+            "created_at": now.isoformat(),
+            "expires_at": (now + self.ttl).isoformat(),
+        }
+        open(self.data_path(upload_id), "wb").close()
+        self._write_meta(session)
+        session["offset"] = 0
+        return session
+
+    def get(self, upload_id: str) -> Optional[dict]:
+        """Возвращает сессию с текущим смещением или None, если ее нет или она истекла"""
+        # upload_id попадает в путь к файлу - принимаем только то, что выдали сами
+        if len(upload_id) != 32 or any(c not in "0123456789abcdef" for c in upload_id):
+            return None
+        try:
+            with open(self._meta_path(upload_id), "r", encoding="utf-8") as f:
+                session = json.load(f)
+            session["offset"] = os.path.getsize(self.data_path(upload_id))
+        except (OSError, ValueError):
+            return None
+        # Файлы истекшей сессии удалит сборщик мусора
+        if datetime.fromisoformat(session["expires_at"]) < datetime.utcnow():
+            return None
+        return session
+
+    async def append(self, session: dict, offset: int, request: Request) -> int:
+        """
+        Дописывает тело запроса в файл сессии, начиная с offset (под lock)
+
+        Returns:
+            Новое смещение (количество принятых байт)
+        """
+        upload_id = session["upload_id"]
+        file_size = session["file_size"]
+        if offset != session["offset"]:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Offset mismatch: expected {session['offset']}, got {offset}",
+                headers={"Upload-Offset": str(session["offset"])}
+            )
+
+        written = offset
+        async with aiofiles.open(self.data_path(upload_id), "r+b") as f:
+            await f.seek(offset)
+            try:
+                async for chunk in request.stream():
+                    if written + len(chunk) > file_size:
+                        raise HTTPException(status_code=413, detail="Chunk exceeds declared file size")
+                    await f.write(chunk)
+                    written += len(chunk)
+            finally:
+                # Оставляем только целиком записанные байты - с них и продолжим
+                await f.truncate(written)
+        return written
+
+    async def sha256(self, upload_id: str) -> str:
+        """
+        SHA-256 принятого файла
+
+        Считается по файлу на диске: куски могли прийти в разные воркеры.
+        """
+        hasher = hashlib.sha256()
+        async with aiofiles.open(self.data_path(upload_id), "rb") as f:
+            while True:
+                chunk = await f.read(1024 * 1024)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def delete(self, upload_id: str) -> None:
+        """Удаляет сессию вместе с данными"""
+        for path in (self._meta_path(upload_id), self.data_path(upload_id)):
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"Error removing upload session file {path}: {e}")
+        if fcntl is None:
+            self._locks.pop(upload_id, None)
+
+    def purge_expired(self) -> int:
+        """Удаляет истекшие сессии, возвращает их количество"""
+        removed = 0
+        now = datetime.utcnow()
+        for name in os.listdir(self.sessions_dir):
+            if not name.endswith(".json"):
+                continue
+            upload_id = name[:-len(".json")]
+            try:
+                with open(self._meta_path(upload_id), "r", encoding="utf-8") as f:
+                    expires_at = datetime.fromisoformat(json.load(f)["expires_at"])
+            except (OSError, ValueError, KeyError):
+                continue
+            if expires_at >= now:
+                continue
+            # Сессию, в которую прямо сейчас пишут, оставляем до следующего прохода
+            fd = self.try_lock(upload_id)
+            if fd is None:
+                continue
+            try:
+                self.delete(upload_id)
+            finally:
+                if fd >= 0:
+                    os.close(fd)
+            removed += 1
+        return removed
+
+    def _write_meta(self, session: dict) -> None:
+        meta_path = self._meta_path(session["upload_id"])
+        tmp_path = meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(session, f)
+        os.replace(tmp_path, meta_path)
@@ -0,0 +1,178 @@
+"""
+Групповой коммит записей в SQLite
+
+SQLite допускает только одного писателя, и каждый отдельный COMMIT - это
+отдельный fsync. Когда много запросов одновременно добавляют документы или
+меняют их статус, записи выгоднее собрать в одну транзакцию.
+
+Запрос отдает в очередь функцию записи (получает Session, возвращает результат)
+и ждет ее результата. Раз в несколько миллисекунд накопившиеся функции
+выполняются по очереди в одной транзакции на соединении писателя и коммитятся
+одним COMMIT. Каждая функция выполняется в своей точке сохранения (SAVEPOINT):
+если она падает (в том числе ожидаемым HTTPException 404/403), откатывается
+только ее запись, ошибка достается только ее запросу, а соседи по пачке
+коммитятся без повторного выполнения.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Callable, Deque, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import Session
+
+from database import AsyncSessionLocal
+
+# Сколько ждать накопления пачки (миллисекунды)
+WRITE_BATCH_WINDOW_MS = float(os.getenv("WRITE_BATCH_WINDOW_MS", "3"))
+
+# Максимум записей в одной транзакции
+WRITE_BATCH_MAX = int(os.getenv("WRITE_BATCH_MAX", "64"))
+
+WriteOp = Callable[[Session], Any]
+
+
+class WriteCoalescer:
+    """
+    Очередь записей с групповым коммитом
+
+    Args:
+        session_factory: Фабрика асинхронных сессий писателя
+        window_ms: Окно накопления пачки
+        max_batch: Максимальный размер пачки
+    """
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker = AsyncSessionLocal,
+        window_ms: float = WRITE_BATCH_WINDOW_MS,
+        max_batch: int = WRITE_BATCH_MAX
+    ):
+        self.session_factory = session_factory
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._pending: List[Tuple[WriteOp, asyncio.Future]] = []
+        self._task: Optional[asyncio.Task] = None
+        # Метрики
+        self.batches = 0
+        self.writes = 0
+        self.failed_writes = 0
+        self.failed_batches = 0
+        self.max_batch_size = 0
+        self._recent_sizes: Deque[int] = deque(maxlen=1000)
+        self._recent_latencies: Deque[float] = deque(maxlen=1000)
+
+    async def submit(self, op: WriteOp) -> Any:
+        """
+        Ставит запись в очередь и ждет коммита ее пачки
+
+        Returns:
+            То, что вернула op (объекты остаются читаемыми после коммита)
+
+        Raises:
+            Исключение, брошенное op, или ошибка коммита
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((op, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+        return await future
+
+    async def stop(self) -> None:
+        """Дожидается записи всего, что уже стоит в очереди"""
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    def stats(self) -> dict:
+        """Метрики: размеры пачек и время коммита"""
+        latencies = sorted(self._recent_latencies)
+        sizes = self._recent_sizes
+
+        def percentile(p: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000, 2)
+
+        return {
+            "batches": self.batches,
+            "writes": self.writes,
+            "failed_writes": self.failed_writes,
+            "failed_batches": self.failed_batches,
+            "pending": len(self._pending),
+            "max_batch_size": self.max_batch_size,
+            "avg_batch_size": round(sum(sizes) / len(sizes), 2) if sizes else None,
+            "commit_latency_ms": {
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+                "max": round(latencies[-1] * 1000, 2) if latencies else None,
+            },
+        }
+
+    async def _flush_loop(self) -> None:
+        while self._pending:
+            # Даем набраться пачке, если очередь еще не заполнена
+            if len(self._pending) < self.max_batch:
+                await asyncio.sleep(self.window)
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            # Записи отмененных запросов не выполняем
+            batch = [item for item in batch if not item[1].done()]
+            if batch:
+                await self._commit(batch)
+
+    async def _commit(self, batch: List[Tuple[WriteOp, asyncio.Future]]) -> None:
+        started = time.perf_counter()
+        try:
+            async with self.session_factory() as db:
+                outcomes = await db.run_sync(lambda session: [_run_op(session, op) for op, _ in batch])
+                await db.commit()
+        except Exception as e:
+            # Ошибка самого коммита касается всей пачки
+            self.failed_batches += 1
+            for _, future in batch:
+                _resolve(future, error=e)
+            return
+
+        latency = time.perf_counter() - started
+        failed = sum(1 for _, error in outcomes if error is not None)
+        self.batches += 1
+        self.writes += len(batch) - failed
+        self.failed_writes += failed
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        self._recent_sizes.append(len(batch))
+        self._recent_latencies.append(latency)
+        for (_, future), (result, error) in zip(batch, outcomes):
+            _resolve(future, result=result, error=error)
+
+
+def _run_op(session: Session, op: WriteOp) -> Tuple[Any, Optional[Exception]]:
+    """Выполняет op в точке сохранения; при ошибке откатывается только ее запись"""
+    # Действия после коммита (файлы), которые op успела запланировать
+    actions = session.info.setdefault("after_commit", [])
+    mark = len(actions)
+    try:
+        # При выходе из блока - flush в точке сохранения: ошибки ограничений
+        # тоже достаются op и откатывают только ее
+        with session.begin_nested():
+            result = op(session)
+    except Exception as e:
+        del actions[mark:]
+        return None, e
+    return result, None
+
+
+def _resolve(future: asyncio.Future, result: Any = None, error: Optional[BaseException] = None) -> None:
+    # Запрос мог быть отменен (клиент отключился), пока ждал коммита
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+# Очередь записей приложения
+write_queue = WriteCoalescer()
@@ -19,10 +19,18 @@ export const documentsApi = {
   },
 
   async getDocuments(establishmentId: number): Promise<Document[]> {
-    const response = await axios.get(`${API_BASE_URL}/documents`, {
-      params: { establishment_id: establishmentId }
-    })
-    return response.data.documents
+    // Список отдается постранично - проходим по курсорам до конца
+    const documents: Document[] = []
+    let cursor: string | null = null
+    do {
+      const response: { data: { documents: Document[]; next_cursor: string | null } } = await axios.get(
+        `${API_BASE_URL}/documents`,
+        { params: { establishment_id: establishmentId, limit: 500, cursor: cursor ?? undefined } }
+      )
+      documents.push(...response.data.documents)
+      cursor = response.data.next_cursor
+    } while (cursor)
+    return documents
   },
 
   async getDocument(id: number): Promise<Document> {
@@ -50,8 +50,17 @@ export const registrationApi = {
   },
 
   async getDocuments(establishmentId: number) {
-    const response = await axios.get(`${API_BASE_URL}/establishments/${establishmentId}/documents`)
-    return response.data
+    // Список отдается постранично: курсор следующей страницы - в заголовке X-Next-Cursor
+    const documents: any[] = []
+    let cursor: string | undefined
+    do {
+      const response = await axios.get(`${API_BASE_URL}/establishments/${establishmentId}/documents`, {
+        params: { limit: 500, cursor }
+      })
+      documents.push(...response.data)
+      cursor = response.headers['x-next-cursor'] || undefined
+    } while (cursor)
+    return documents
   },
 
   async submitEstablishment(establishmentId: number) {
@@ -169,8 +169,7 @@ export default function ProfilePage({ establishment, onUpdate }: ProfilePageProp
       
       // Обновляем logo_path из ответа для постоянного отображения
       if (response.data.logo_path) {
-        const logoUrl = `/api/uploads/logos/${response.data.logo_path.split('/').pop()}`
-        setLogoPreview(logoUrl)
+        setLogoPreview(getLogoUrl(response.data.logo_path))
       }
 
       setSuccess(true)